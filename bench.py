@@ -0,0 +1,536 @@
+# Бенчмарки бота без сети:
+#   python bench.py dispatch [--updates N] [--fail-on-block] [--block-threshold MS]
+#   python bench.py replay capture.jsonl [--speed 1|0] [--poll] [--json out.json] [--compare base.json]
+#                   [--fail-on-block] [--block-threshold MS]
+#   python bench.py memory [--records N]
+#   python bench.py coldstart [--runs N]
+import os
+import sys
+import json
+import random
+import subprocess
+import threading
+import time
+import asyncio
+import argparse
+import tracemalloc
+import statistics
+from datetime import datetime, timedelta, timezone
+
+import logging
+logging.disable(logging.CRITICAL)
+
+from aiohttp import web
+from aiogram import Bot, types
+
+import testquikbotcrm as crm
+from standin import FakeTelegramSession, AirtableStandin
+
+BENCH_USER_ID = 1000
+
+# Обязательные настройки для create_app; переменные окружения имеют приоритет
+BENCH_CONFIG = {
+    'TELEGRAM_API_TOKEN': '123456:BENCHMARK',
+    'AIRTABLE_API_KEY': 'bench',
+    'AIRTABLE_BASE_ID': 'appBench',
+    'TEAMLEAD_ID': '1'
+}
+
+# Сценарий заявки без обращений к Airtable (до сохранения); "cb:" — нажатие inline-кнопки
+DISPATCH_SCENARIO = [
+    "Создать заявку",
+    "Кастомный товар",
+    "Футболка с логотипом",
+    "Иванов Иван",
+    "+7 900 000-00-00",
+    "Москва, ул. Тестовая, 1",
+    "Вернуться назад",
+    "Москва, ул. Тестовая, 2",
+    "101000",
+    "Свой вариант",
+    "Вернуться назад",
+    "Вернуться назад",
+    "Начать заново",
+    "cb:clear_all",
+    "Существующий товар",
+    "Вернуться назад",
+    "Начать заново",
+]
+
+
+def make_message_update(bot, update_id, text):
+    user = {"id": BENCH_USER_ID, "is_bot": False, "first_name": "Bench"}
+    return types.Update.model_validate({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": BENCH_USER_ID, "type": "private"},
+            "from": user,
+            "text": text
+        }
+    }, context={"bot": bot})
+
+
+def make_callback_update(bot, update_id, data):
+    user = {"id": BENCH_USER_ID, "is_bot": False, "first_name": "Bench"}
+    return types.Update.model_validate({
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": user,
+            "chat_instance": "bench",
+            "data": data,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": BENCH_USER_ID, "type": "private"},
+                "text": "bench"
+            }
+        }
+    }, context={"bot": bot})
+
+
+def build_updates(bot, count):
+    updates = []
+    for update_id in range(1, count + 1):
+        step = DISPATCH_SCENARIO[(update_id - 1) % len(DISPATCH_SCENARIO)]
+        if step.startswith("cb:"):
+            updates.append(make_callback_update(bot, update_id, step[3:]))
+        else:
+            updates.append(make_message_update(bot, update_id, step))
+    return updates
+
+
+# Время и выделения памяти на один апдейт через dp.feed_update
+async def bench_dispatch(count):
+    bot = Bot(token=crm.tenant.settings.API_TOKEN, session=FakeTelegramSession())
+    crm.tenant.allowed_users[str(BENCH_USER_ID)] = {'record_id': 'recBench', 'department': 'Бенч'}
+    updates = build_updates(bot, count)
+
+    for update in updates[:50]:
+        await crm.dp.feed_update(bot, update)
+
+    timings = []
+    for update in updates:
+        # Как при polling: между апдейтами цикл успевает выполнить таймеры (в т.ч. сторожа)
+        await asyncio.sleep(0)
+        started = time.perf_counter()
+        await crm.dp.feed_update(bot, update)
+        timings.append((time.perf_counter() - started) * 1e6)
+
+    tracemalloc.start()
+    peaks = []
+    for update in updates[:min(count, 2000)]:
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        await crm.dp.feed_update(bot, update)
+        peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+    tracemalloc.stop()
+
+    timings.sort()
+    print(f"updates: {count}")
+    print(f"mean: {statistics.mean(timings):.1f} us/update")
+    print(f"p50: {timings[len(timings) // 2]:.1f} us, p99: {timings[int(len(timings) * 0.99)]:.1f} us")
+    print(f"peak allocation: {statistics.mean(peaks) / 1024:.1f} KiB/update")
+    print(f"telegram calls: {len(bot.session.calls)}")
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+
+# Заглушка Airtable в отдельном потоке со своим event loop: синхронные запросы бота
+# к Airtable не блокируют ее
+def start_standin_thread(standin):
+    started = threading.Event()
+    address = {}
+
+    def serve():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        runner = web.AppRunner(standin.make_app())
+        loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        loop.run_until_complete(site.start())
+        address['port'] = runner.addresses[0][1]
+        started.set()
+        loop.run_forever()
+
+    threading.Thread(target=serve, name='airtable-standin', daemon=True).start()
+    started.wait()
+    return address['port']
+
+
+def print_latency_table(results, baseline=None):
+    print(f"{'state':<40} {'count':>6} {'mean ms':>9} {'p50 ms':>8} {'p99 ms':>8}" + ("   delta mean" if baseline else ""))
+    for key, stats in sorted(results.items(), key=lambda item: -item[1]['count']):
+        line = f"{key:<40} {stats['count']:>6} {stats['mean_ms']:>9.2f} {stats['p50_ms']:>8.2f} {stats['p99_ms']:>8.2f}"
+        if baseline and key in baseline:
+            base_mean = baseline[key]['mean_ms']
+            line += f"   {(stats['mean_ms'] - base_mean) / base_mean * 100 if base_mean else 0.0:+.1f}%"
+        print(line)
+
+
+# Воспроизведение записанного трафика (CAPTURE_FILE) через dp.feed_update против заглушек.
+# speed=1 — исходные интервалы между апдейтами и задержки Airtable, speed=0 — максимально быстро
+async def bench_replay(capture_path, speed, poll, json_path=None, compare_path=None):
+    with open(capture_path, encoding='utf-8') as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    updates = [entry for entry in entries if entry['kind'] == 'update']
+    standin = AirtableStandin()
+    standin.load_capture(entries)
+    standin.recorded_latency = speed > 0
+    # На максимальной скорости ограничение частоты запросов к Airtable не применяется
+    if speed <= 0:
+        crm.get_rate_limiter().rate = 0
+    crm.tenant.settings.AIRTABLE_API_URL = f"http://127.0.0.1:{start_standin_thread(standin)}"
+
+    crm.tenant.allowed_users = await asyncio.to_thread(crm.load_users)
+    crm.tenant.record_id_to_telegram_id = {
+        data['record_id']: telegram_id for telegram_id, data in crm.tenant.allowed_users.items()
+    }
+    bot = Bot(token=crm.tenant.settings.API_TOKEN, session=FakeTelegramSession())
+    crm.tenant.bot = bot
+
+    latencies = {}
+
+    async def feed(entry):
+        update = types.Update.model_validate(entry['update'], context={"bot": bot})
+        started = time.perf_counter()
+        await crm.dp.feed_update(bot, update)
+        latencies.setdefault(entry.get('state') or 'none', []).append((time.perf_counter() - started) * 1000)
+
+    # Как при polling: каждый апдейт — отдельная задача, порядок внутри чата держит планировщик
+    replay_started = time.perf_counter()
+    first_t = updates[0]['t'] if updates else 0.0
+    tasks = []
+    for entry in updates:
+        if speed > 0:
+            delay = (entry['t'] - first_t) / speed - (time.perf_counter() - replay_started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(feed(entry)))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - replay_started
+
+    results = {
+        key: {
+            'count': len(values),
+            'mean_ms': statistics.mean(values),
+            'p50_ms': percentile(values, 0.5),
+            'p99_ms': percentile(values, 0.99)
+        }
+        for key, values in latencies.items()
+    }
+    all_values = [value for values in latencies.values() for value in values]
+    if all_values:
+        results['ALL'] = {
+            'count': len(all_values),
+            'mean_ms': statistics.mean(all_values),
+            'p50_ms': percentile(all_values, 0.5),
+            'p99_ms': percentile(all_values, 0.99)
+        }
+
+    if poll:
+        crm.tenant.request_statuses.clear()
+        scheduler = crm.tenant.status_poll_scheduler
+        for tier in [scheduler.RECONCILE_TIER] + [name for name in scheduler.tiers if name != scheduler.RECONCILE_TIER]:
+            started = time.perf_counter()
+            records_count, _ = await crm.poll_status_tier(tier)
+            duration = (time.perf_counter() - started) * 1000
+            results[f"poll:{tier}"] = {'count': records_count, 'mean_ms': duration, 'p50_ms': duration, 'p99_ms': duration}
+
+    baseline = None
+    if compare_path:
+        with open(compare_path, encoding='utf-8') as f:
+            baseline = json.load(f)
+    print(f"updates: {len(updates)}, airtable responses: {sum(len(r) for r in standin.recorded.values())}, "
+          f"elapsed: {elapsed:.2f} s, telegram calls: {len(bot.session.calls)}")
+    print_latency_table(results, baseline)
+    if json_path:
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+# Бенчмарк под сторожем event loop: блокировки цикла дольше threshold_ms со стеком и обработчиком
+async def run_watched(coro, threshold_ms):
+    watchdog = crm.LOOP_WATCHDOG
+    watchdog.threshold = threshold_ms / 1000
+    watchdog.interval = min(crm.tenant.settings.LOOP_WATCHDOG_INTERVAL, watchdog.threshold / 2)
+    watchdog.reset()
+    watchdog.start(crm.get_handler_names())
+    try:
+        await coro
+    finally:
+        watchdog.stop()
+    return watchdog.snapshot()
+
+
+def print_blocking_report(snapshot, threshold_ms):
+    print(f"event loop: max lag {snapshot['max_lag_ms']:.1f} ms, stalls > {threshold_ms:g} ms: {snapshot['stalls']} "
+          f"(in handlers: {snapshot['update_stalls']}), blocked {snapshot['blocked_seconds']:.3f} s")
+    for stall in snapshot['stalls_by_handler']:
+        print(f"  {stall['count']:6d}  {stall['handler']}  [{stall['state'] or '-'}]")
+    for stall in snapshot['recent_stalls']:
+        if stall['update_id'] is None or not stall['stack']:
+            continue
+        print(f"  update {stall['update_id']}, {stall['duration_ms']} ms, {stall['handler']}:")
+        for line in stall['stack'][-8:]:
+            print(f"      {line}")
+
+
+MEMORY_STATUSES = [('Доставлено', 70), ('Отменено', 10), ('Отправлено', 12), ('В обработке', 8)]
+MEMORY_DELIVERY_METHODS = ['Почта', 'Курьер', 'CDEK']
+
+
+def make_synthetic_requests(count, seed=1):
+    rng = random.Random(seed)
+    alphabet = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ234567'
+    statuses = [status for status, weight in MEMORY_STATUSES for _ in range(weight)]
+    records = []
+    for number in range(1, count + 1):
+        status = rng.choice(statuses)
+        fields = {'Номер_заявки': number, 'Статус': status, 'Пользователь': ['recBench'],
+                  'Способ_отправки': rng.choice(MEMORY_DELIVERY_METHODS)}
+        if status in ('Отправлено', 'Доставлено'):
+            fields['Трек-номер'] = f"RA{rng.randrange(10 ** 9):09d}RU"
+        created = datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(seconds=rng.randrange(365 * 86400))
+        records.append({
+            'id': 'rec' + ''.join(rng.choice(alphabet) for _ in range(14)),
+            'createdTime': created.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+            'fields': fields
+        })
+    return records
+
+
+# Страницы по 100 записей, каждая заново разбирается из JSON, как ответ Airtable
+def synthetic_pages(records):
+    def iter_records(table, params=None):
+        if table != 'Заявки':
+            return
+        for i in range(0, len(records), 100):
+            yield json.loads(json.dumps(records[i:i + 100], ensure_ascii=False))
+    return iter_records
+
+
+def measure(func):
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = func()
+    duration = time.perf_counter() - started
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, current, peak, duration
+
+
+# Память хранилища последних состояний заявок, агрегатов /stats и пик цикла сверки:
+# словарь словарей и словарь кортежей (как до компактных хранилищ) против RequestFingerprints
+# и RequestStats с потоковым сравнением. Первый цикл сверки заполняет оба хранилища,
+# второй только сравнивает
+async def bench_memory(count):
+    records = make_synthetic_requests(count)
+    crm.iter_airtable_records = synthetic_pages(records)
+    crm.tenant.bot = Bot(token=crm.tenant.settings.API_TOKEN, session=FakeTelegramSession())
+
+    def build_legacy():
+        store = {}
+        for page in synthetic_pages(records)('Заявки'):
+            for record in page:
+                fields = record['fields']
+                store[record['id']] = {
+                    'status': fields.get('Статус', 'Неизвестно'),
+                    'tracking_number': fields.get('Трек-номер', None),
+                    'request_number': fields.get('Номер_заявки', 'Неизвестно')
+                }
+        return store
+
+    def build_fingerprints():
+        store = crm.RequestFingerprints()
+        for page in synthetic_pages(records)('Заявки'):
+            for record in page:
+                fields = record['fields']
+                store.put(record['id'], fields.get('Статус', 'Неизвестно'), fields.get('Трек-номер', None))
+        return store
+
+    # Агрегаты /stats: кортежи строк из разобранного JSON по record_id против RequestStats
+    def stats_entries():
+        for page in synthetic_pages(records)('Заявки'):
+            for record in page:
+                fields = record['fields']
+                yield record['id'], (
+                    fields.get('Статус', 'Неизвестно'), 'Без отдела', fields.get('Способ_отправки', 'Не указано'),
+                    record['createdTime'][:10], None
+                )
+
+    def build_legacy_stats():
+        return dict(stats_entries())
+
+    def build_compact_stats():
+        store = crm.RequestStats()
+        for record_id, entry in stats_entries():
+            store.upsert(record_id, *entry)
+        return store
+
+    legacy, legacy_bytes, _, legacy_time = measure(build_legacy)
+    del legacy
+    fingerprints, fingerprint_bytes, _, fingerprint_time = measure(build_fingerprints)
+    del fingerprints
+    legacy_stats, legacy_stats_bytes, _, legacy_stats_time = measure(build_legacy_stats)
+    del legacy_stats
+    stats, stats_bytes, _, stats_time = measure(build_compact_stats)
+    del stats
+
+    # Первый цикл сверки заполняет хранилище отпечатков и агрегаты /stats: замеряется
+    # память, которая остается после него, второй цикл сравнивает 100к записей
+    crm.tenant.request_statuses.clear()
+    crm.tenant.request_stats = crm.RequestStats()
+    tracemalloc.start()
+    started = time.perf_counter()
+    await crm.poll_status_tier(crm.StatusPollScheduler.RECONCILE_TIER)
+    first_cycle_time = time.perf_counter() - started
+    first_cycle_retained, first_cycle_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    tracemalloc.start()
+    started = time.perf_counter()
+    _, changes = await crm.poll_status_tier(crm.StatusPollScheduler.RECONCILE_TIER)
+    cycle_time = time.perf_counter() - started
+    _, cycle_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # Прежний цикл: весь requests_data в памяти до сравнения
+    def legacy_cycle():
+        requests_data = {}
+        for page in crm.iter_airtable_records('Заявки'):
+            for record in page:
+                requests_data[record['id']] = crm.request_data_from_record(record)
+        return len(requests_data)
+
+    _, _, legacy_cycle_peak, legacy_cycle_time = measure(legacy_cycle)
+
+    print(f"records: {count}")
+    print(f"state store, dict of dicts:   {legacy_bytes / 2 ** 20:8.1f} MiB ({legacy_bytes / count:.0f} B/record), "
+          f"build {legacy_time:.2f} s")
+    print(f"state store, fingerprints:    {fingerprint_bytes / 2 ** 20:8.1f} MiB ({fingerprint_bytes / count:.0f} B/record), "
+          f"build {fingerprint_time:.2f} s")
+    print(f"stats store, dict of tuples:  {legacy_stats_bytes / 2 ** 20:8.1f} MiB "
+          f"({legacy_stats_bytes / count:.0f} B/record), build {legacy_stats_time:.2f} s")
+    print(f"stats store, RequestStats:    {stats_bytes / 2 ** 20:8.1f} MiB ({stats_bytes / count:.0f} B/record), "
+          f"build {stats_time:.2f} s")
+    print(f"first reconcile, retained:          {first_cycle_retained / 2 ** 20:8.1f} MiB "
+          f"(fingerprints + stats), peak {first_cycle_peak / 2 ** 20:.1f} MiB, {first_cycle_time:.2f} s")
+    print(f"reconcile cycle peak, materialized: {legacy_cycle_peak / 2 ** 20:8.1f} MiB, {legacy_cycle_time:.2f} s")
+    print(f"reconcile cycle peak, streaming:    {cycle_peak / 2 ** 20:8.1f} MiB, {cycle_time:.2f} s, changes: {changes}")
+
+
+# Холодный старт в отдельном процессе: импорт модуля бота, create_app, запуск тенанта
+# (загрузка пользователей из заглушки Airtable) и обработка первого апдейта (/start).
+# Окружение процесса — только PATH и PYTHONPATH: импорт не должен требовать секретов
+COLDSTART_CHILD = r"""
+import asyncio, json, sys, time
+started = time.perf_counter()
+import testquikbotcrm as crm
+imported = time.perf_counter()
+from aiogram import types
+from standin import FakeTelegramSession
+
+crm.TELEGRAM_SESSION = FakeTelegramSession()
+app = crm.create_app(json.loads(sys.argv[1]))
+created = time.perf_counter()
+
+async def first_update():
+    await app.start()
+    tenant_started = time.perf_counter()
+    bot = next(iter(app.tenants.values())).bot
+    update = types.Update.model_validate({
+        "update_id": 1,
+        "message": {
+            "message_id": 1, "date": int(time.time()), "text": "/start",
+            "chat": {"id": int(sys.argv[2]), "type": "private"},
+            "from": {"id": int(sys.argv[2]), "is_bot": False, "first_name": "Bench"}
+        }
+    }, context={"bot": bot})
+    await app.dispatcher.feed_update(bot, update)
+    return tenant_started, time.time(), len(bot.session.calls)
+
+tenant_started, done_wall, telegram_calls = asyncio.run(first_update())
+print(json.dumps({
+    "import_ms": (imported - started) * 1000,
+    "create_app_ms": (created - imported) * 1000,
+    "start_ms": (tenant_started - created) * 1000,
+    "done_wall": done_wall,
+    "telegram_calls": telegram_calls
+}))
+"""
+
+
+def bench_coldstart(runs):
+    standin = AirtableStandin()
+    standin.seed({'Пользователи': [{'fields': {'Telegram_ID': BENCH_USER_ID, 'Отдел': 'Бенч'}}]})
+    port = start_standin_thread(standin)
+    config = dict(BENCH_CONFIG, AIRTABLE_API_URL=f"http://127.0.0.1:{port}", LOG_LEVEL='WARNING',
+                  LOOP_BLOCK_THRESHOLD='0')
+    env = {'PATH': os.environ.get('PATH', ''), 'PYTHONPATH': os.path.dirname(os.path.abspath(__file__))}
+    results = {'import_ms': [], 'create_app_ms': [], 'start_ms': [], 'first_update_ms': []}
+    for _ in range(runs):
+        spawned = time.time()
+        output = subprocess.run(
+            [sys.executable, '-c', COLDSTART_CHILD, json.dumps(config), str(BENCH_USER_ID)],
+            env=env, capture_output=True, text=True, check=True
+        ).stdout
+        child = json.loads(output.strip().splitlines()[-1])
+        if not child['telegram_calls']:
+            raise RuntimeError("первый апдейт не дошел до обработчика")
+        for key in ('import_ms', 'create_app_ms', 'start_ms'):
+            results[key].append(child[key])
+        results['first_update_ms'].append((child['done_wall'] - spawned) * 1000)
+    print(f"runs: {runs}")
+    for key, label in (('import_ms', 'import'), ('create_app_ms', 'create_app'), ('start_ms', 'tenant start'),
+                       ('first_update_ms', 'spawn -> first update')):
+        values = results[key]
+        print(f"{label:24s} median {statistics.median(values):8.1f} ms, min {min(values):8.1f} ms, max {max(values):8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки бота")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    dispatch_parser = subparsers.add_parser('dispatch', help="стоимость маршрутизации апдейтов")
+    dispatch_parser.add_argument('--updates', type=int, default=20000)
+    replay_parser = subparsers.add_parser('replay', help="воспроизведение записанного трафика (CAPTURE_FILE)")
+    replay_parser.add_argument('capture')
+    replay_parser.add_argument('--speed', type=float, default=0.0, help="1 — исходная скорость, 0 — максимальная")
+    replay_parser.add_argument('--poll', action='store_true', help="также замерить цикл опроса заявок")
+    replay_parser.add_argument('--json', help="сохранить результаты для сравнения версий")
+    replay_parser.add_argument('--compare', help="результаты предыдущего прогона (--json)")
+    memory_parser = subparsers.add_parser('memory', help="память хранилища состояний заявок и цикла сверки")
+    memory_parser.add_argument('--records', type=int, default=100000)
+    coldstart_parser = subparsers.add_parser('coldstart', help="импорт модуля и время до первого апдейта")
+    coldstart_parser.add_argument('--runs', type=int, default=5)
+    for watched_parser in (dispatch_parser, replay_parser):
+        watched_parser.add_argument('--fail-on-block', action='store_true',
+                                    help="код возврата 1, если обработчик заблокировал event loop")
+        watched_parser.add_argument('--block-threshold', type=float, default=50.0,
+                                    help="блокировка event loop, мс (по умолчанию 50)")
+    args = parser.parse_args()
+
+    if args.command == 'coldstart':
+        bench_coldstart(args.runs)
+        return 0
+    crm.create_app({**BENCH_CONFIG, **os.environ})
+    if args.command == 'memory':
+        asyncio.run(bench_memory(args.records))
+        return 0
+    if args.command == 'dispatch':
+        bench = bench_dispatch(args.updates)
+    else:
+        bench = bench_replay(args.capture, args.speed, args.poll, args.json, args.compare)
+    snapshot = asyncio.run(run_watched(bench, args.block_threshold))
+    print_blocking_report(snapshot, args.block_threshold)
+    if args.fail_on_block and snapshot['update_stalls']:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
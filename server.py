@@ -1,22 +1,146 @@
 import os
+import io
+import hmac
+import sys
+import time
 import asyncio
+import cProfile
+import pstats
+import threading
+from collections import Counter
 from aiohttp import web
-from testquikbotcrm import main as bot_main
+from testquikbotcrm import (
+    create_app, get_health, get_metrics, verify_airtable_webhook, handle_airtable_webhook, TENANTS
+)
+
+MAX_PROFILE_SECONDS = 60
+
+# Одновременно может выполняться только одно профилирование
+profile_lock = asyncio.Lock()
+
+# Ссылки на фоновые задачи, чтобы их не собрал сборщик мусора
+background_tasks = set()
 
 async def health_check(request):
     return web.Response(text="Bot is running!")
 
+# Подробное состояние: автоматы защиты Airtable, пользователи, реплика
+async def health_details(request):
+    return web.json_response(get_health())
+
+# Метрики в текстовом формате Prometheus: очередь апдейтов, автоматы защиты, реплика
+async def metrics_handler(request):
+    lines = [f"crmbot_{name} {value}" for name, value in get_metrics().items()]
+    return web.Response(text="\n".join(lines) + "\n")
+
+# Приемник уведомлений Airtable: проверяем подпись и обрабатываем изменения в фоне,
+# чтобы Airtable получил ответ сразу. /airtable/webhook/{tenant} — для нескольких тенантов,
+# /airtable/webhook — если тенант один
+async def airtable_webhook(request):
+    name = request.match_info.get('tenant')
+    if name is None and len(TENANTS) == 1:
+        name = next(iter(TENANTS))
+    tenant = TENANTS.get(name)
+    if tenant is None:
+        return web.Response(status=404, text="Unknown tenant")
+    body = await request.read()
+    if not tenant.run(verify_airtable_webhook, body, request.headers.get('X-Airtable-Content-MAC')):
+        return web.Response(status=401, text="Invalid signature")
+    task = tenant.create_task(handle_airtable_webhook())
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return web.Response(status=200)
+
+# Токен для служебных эндпоинтов (без него они недоступны); читается после загрузки .env.
+# Принимается только из заголовка X-Admin-Token: параметры URL попадают в логи прокси
+def is_admin_request(request):
+    admin_token = os.getenv('ADMIN_TOKEN')
+    token = request.headers.get('X-Admin-Token', '')
+    return bool(admin_token) and hmac.compare_digest(token.encode(), admin_token.encode())
+
+# Профилирование через cProfile: учитываются все вызовы в потоке event loop
+async def run_cprofile(seconds):
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.disable()
+    output = io.StringIO()
+    stats = pstats.Stats(profiler, stream=output)
+    stats.sort_stats('cumulative').print_stats(60)
+    return output.getvalue()
+
+# Сэмплирующее профилирование: стек потока event loop снимается каждые interval секунд
+async def run_sampling_profile(seconds, interval=0.005):
+    target_thread_id = threading.get_ident()
+    samples = Counter()
+    stop = threading.Event()
+
+    def sampler():
+        while not stop.wait(interval):
+            frame = sys._current_frames().get(target_thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+            samples[";".join(reversed(stack))] += 1
+
+    thread = threading.Thread(target=sampler, name='profile-sampler', daemon=True)
+    thread.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        stop.set()
+        thread.join()
+    total = sum(samples.values())
+    lines = [f"samples: {total}, interval: {interval * 1000:.1f} ms"]
+    for stack, count in samples.most_common(100):
+        lines.append(f"{count} {stack}")
+    return "\n".join(lines)
+
+# Профилирование живого процесса: /admin/profile?seconds=10&mode=cprofile|sampling
+async def profile_handler(request):
+    if not is_admin_request(request):
+        return web.Response(status=403, text="Forbidden")
+    try:
+        seconds = min(float(request.query.get('seconds', 10)), MAX_PROFILE_SECONDS)
+    except ValueError:
+        return web.Response(status=400, text="seconds must be a number")
+    mode = request.query.get('mode', 'cprofile')
+    if mode not in ('cprofile', 'sampling'):
+        return web.Response(status=400, text="mode must be cprofile or sampling")
+    if profile_lock.locked():
+        return web.Response(status=409, text="Profiling is already running")
+    async with profile_lock:
+        started = time.time()
+        if mode == 'cprofile':
+            report = await run_cprofile(seconds)
+        else:
+            report = await run_sampling_profile(seconds)
+    header = f"mode: {mode}, duration: {time.time() - started:.1f} s\n\n"
+    return web.Response(text=header + report)
+
 async def start_server():
     app = web.Application()
-    app.add_routes([web.get('/', health_check)])
+    app.add_routes([
+        web.get('/', health_check),
+        web.get('/health', health_details),
+        web.get('/metrics', metrics_handler),
+        web.post('/airtable/webhook', airtable_webhook),
+        web.post('/airtable/webhook/{tenant}', airtable_webhook),
+        web.get('/admin/profile', profile_handler)
+    ])
     runner = web.AppRunner(app)
     await runner.setup()
     site = web.TCPSite(runner, '0.0.0.0', int(os.getenv('PORT', 8080)))
     await site.start()
 
 async def run_app():
+    app = create_app()
     # Запускаем бот и сервер параллельно
-    bot_task = asyncio.create_task(bot_main())
+    bot_task = asyncio.create_task(app.run())
     server_task = asyncio.create_task(start_server())
     await asyncio.gather(bot_task, server_task)
 
@@ -0,0 +1,322 @@
+# Локальные заглушки внешних сервисов для бенчмарков и отладки без сети.
+# Заглушка Airtable запускается отдельно:
+#   python standin.py airtable --port 8081 --seed seed.json \
+#       --webhook-url http://127.0.0.1:8080/airtable/webhook --webhook-secret <base64>
+# и бот направляется на нее через AIRTABLE_API_URL=http://127.0.0.1:8081
+import os
+import re
+import sys
+import hmac
+import json
+import time
+import base64
+import asyncio
+import hashlib
+import argparse
+import itertools
+from urllib.parse import unquote
+from datetime import datetime, timezone
+
+import aiohttp
+from aiohttp import web
+from aiogram.client.session.base import BaseSession
+
+
+# Сессия Telegram Bot API, отвечающая правдоподобными ответами без сетевых запросов
+class FakeTelegramSession(BaseSession):
+    def __init__(self, delay=0.0, **kwargs):
+        super().__init__(**kwargs)
+        self.delay = delay
+        self.calls = []
+        self._ids = itertools.count(1)
+
+    def _message(self, method):
+        chat_id = getattr(method, 'chat_id', None)
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            chat_id = 0
+        return {
+            "message_id": next(self._ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": getattr(method, 'text', None) or ""
+        }
+
+    def _photo_message(self, method):
+        message = self._message(method)
+        file_number = next(self._ids)
+        message["photo"] = [{
+            "file_id": f"standin-file-{file_number}",
+            "file_unique_id": f"standin-unique-{file_number}",
+            "width": 1,
+            "height": 1
+        }]
+        return message
+
+    def _result(self, method):
+        name = type(method).__name__
+        if name == 'GetMe':
+            return {"id": 1, "is_bot": True, "first_name": "Standin", "username": "standin_bot"}
+        if name == 'SendMediaGroup':
+            return [self._photo_message(method) for _ in method.media]
+        if name == 'SendPhoto':
+            return self._photo_message(method)
+        if name == 'GetFile':
+            file_number = next(self._ids)
+            return {"file_id": method.file_id, "file_unique_id": f"standin-unique-{file_number}",
+                    "file_path": f"documents/{file_number}"}
+        if getattr(method, '__returning__', None) is bool:
+            return True
+        return self._message(method)
+
+    async def make_request(self, bot, method, timeout=None):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        self.calls.append(type(method).__name__)
+        content = json.dumps({"ok": True, "result": self._result(method)})
+        response = self.check_response(bot=bot, method=method, status_code=200, content=content)
+        return response.result
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+# Заглушка Airtable REST API: таблицы в памяти, пагинация, фильтр по RECORD_ID(),
+# создание/изменение записей и payload вебхука с подписанными уведомлениями.
+# Ответы из записи трафика (CAPTURE_FILE) отдаются в записанном порядке, остальные
+# запросы обслуживаются таблицами, заполненными записями из этих ответов.
+class AirtableStandin:
+    REQUEST_TABLES = ('Заявки', 'Кастомные_заказы')
+    RECORD_ID_PATTERN = re.compile(r"RECORD_ID\(\)\s*=\s*'([^']+)'")
+    BASE_PATTERN = re.compile(r'^/v0/(bases/)?[^/]+')
+
+    def __init__(self, base_id='appStandin', webhook_id='achStandin', webhook_secret=None, webhook_url=None, latency=0.0):
+        self.base_id = base_id
+        self.webhook_id = webhook_id
+        self.webhook_secret = webhook_secret or base64.b64encode(os.urandom(32)).decode()
+        self.webhook_url = webhook_url
+        self.latency = latency
+        self.tables = {}
+        # (метод, путь, параметры) -> [(статус, тело, задержка)] и позиция воспроизведения
+        self.recorded = {}
+        self.recorded_positions = {}
+        self.recorded_latency = False
+        self.payloads = []
+        self._request_numbers = itertools.count(1)
+        self._transactions = itertools.count(1)
+
+    @staticmethod
+    def table_id(table):
+        return 'tbl' + hashlib.sha1(table.encode()).hexdigest()[:14]
+
+    @staticmethod
+    def new_record_id():
+        return 'rec' + base64.b32encode(os.urandom(10)).decode().rstrip('=')[:14]
+
+    def seed(self, data):
+        for table, records in data.items():
+            for record in records:
+                record.setdefault('id', self.new_record_id())
+                record.setdefault('createdTime', datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z'))
+                record.setdefault('fields', {})
+                self.tables.setdefault(table, {})[record['id']] = record
+
+    @classmethod
+    def recorded_key(cls, method, path, params):
+        return method, cls.BASE_PATTERN.sub(r'/v0/\1{base}', unquote(path)), tuple(tuple(item) for item in params)
+
+    # Загрузка ответов Airtable из записи трафика; записи из ответов попадают в таблицы
+    def load_capture(self, entries):
+        for entry in entries:
+            if entry.get('kind') != 'airtable':
+                continue
+            key = self.recorded_key(entry['method'], entry['path'], entry['params'])
+            self.recorded.setdefault(key, []).append((entry['status'], entry['body'], entry.get('latency', 0.0)))
+            body = entry['body']
+            parts = key[1].split('/')
+            if entry['method'] != 'GET' or not isinstance(body, dict) or parts[2] == 'bases' or len(parts) < 4:
+                continue
+            records = body.get('records', [body] if 'fields' in body else [])
+            self.seed({parts[3]: [dict(record) for record in records if record.get('id') not in self.tables.get(parts[3], {})]})
+
+    @web.middleware
+    async def recorded_middleware(self, request, handler):
+        params = sorted([key, value] for key, value in request.query.items())
+        key = self.recorded_key(request.method, request.path, params)
+        responses = self.recorded.get(key)
+        if not responses:
+            return await handler(request)
+        position = self.recorded_positions.get(key, 0)
+        self.recorded_positions[key] = position + 1
+        status, body, latency = responses[min(position, len(responses) - 1)]
+        if self.recorded_latency and latency:
+            await asyncio.sleep(latency)
+        return web.json_response(body, status=status)
+
+    def create(self, table, fields):
+        fields = dict(fields)
+        if table in self.REQUEST_TABLES:
+            fields.setdefault('Номер_заявки', next(self._request_numbers))
+        record = {
+            'id': self.new_record_id(),
+            'createdTime': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+            'fields': fields
+        }
+        self.tables.setdefault(table, {})[record['id']] = record
+        self._record_change(table, created=[record['id']])
+        return record
+
+    def update(self, table, record_id, fields):
+        record = self.tables[table][record_id]
+        record['fields'].update(fields)
+        self._record_change(table, changed=[record_id])
+        return record
+
+    def delete(self, table, record_id):
+        del self.tables[table][record_id]
+        self._record_change(table, destroyed=[record_id])
+
+    def _record_change(self, table, created=(), changed=(), destroyed=()):
+        table_changes = {}
+        if created:
+            table_changes['createdRecordsById'] = {record_id: {} for record_id in created}
+        if changed:
+            table_changes['changedRecordsById'] = {record_id: {} for record_id in changed}
+        if destroyed:
+            table_changes['destroyedRecordIds'] = list(destroyed)
+        self.payloads.append({
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'baseTransactionNumber': next(self._transactions),
+            'changedTablesById': {self.table_id(table): table_changes}
+        })
+
+    # Отправка подписанного уведомления о новых payload на webhook_url бота
+    async def emit_webhook(self):
+        if not self.webhook_url:
+            return None
+        body = json.dumps({
+            'base': {'id': self.base_id},
+            'webhook': {'id': self.webhook_id},
+            'timestamp': datetime.now(timezone.utc).isoformat()
+        }).encode()
+        mac = hmac.new(base64.b64decode(self.webhook_secret), body, hashlib.sha256).hexdigest()
+        headers = {'Content-Type': 'application/json', 'X-Airtable-Content-MAC': f'hmac-sha256={mac}'}
+        async with aiohttp.ClientSession() as session:
+            async with session.post(self.webhook_url, data=body, headers=headers) as response:
+                return response.status
+
+    def _find_table(self, table):
+        if table in self.tables:
+            return table
+        for name in self.tables:
+            if self.table_id(name) == table:
+                return name
+        return table
+
+    async def _delay(self):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def list_records(self, request):
+        await self._delay()
+        table = self._find_table(request.match_info['table'])
+        records = list(self.tables.get(table, {}).values())
+        record_ids = self.RECORD_ID_PATTERN.findall(request.query.get('filterByFormula', ''))
+        if record_ids:
+            wanted = set(record_ids)
+            records = [record for record in records if record['id'] in wanted]
+        page_size = int(request.query.get('pageSize', 100))
+        offset = int(request.query.get('offset', 0))
+        result = {'records': records[offset:offset + page_size]}
+        if offset + page_size < len(records):
+            result['offset'] = str(offset + page_size)
+        return web.json_response(result)
+
+    async def get_record(self, request):
+        await self._delay()
+        table = self._find_table(request.match_info['table'])
+        record = self.tables.get(table, {}).get(request.match_info['record_id'])
+        if record is None:
+            return web.json_response({'error': 'NOT_FOUND'}, status=404)
+        return web.json_response(record)
+
+    async def create_records(self, request):
+        await self._delay()
+        table = self._find_table(request.match_info['table'])
+        payload = await request.json()
+        records = [self.create(table, item.get('fields', {})) for item in payload.get('records', [])]
+        asyncio.create_task(self.emit_webhook())
+        return web.json_response({'records': records})
+
+    async def update_records(self, request):
+        await self._delay()
+        table = self._find_table(request.match_info['table'])
+        payload = await request.json()
+        records = []
+        for item in payload.get('records', []):
+            if item.get('id') not in self.tables.get(table, {}):
+                return web.json_response({'error': 'NOT_FOUND', 'id': item.get('id')}, status=404)
+            records.append(self.update(table, item['id'], item.get('fields', {})))
+        asyncio.create_task(self.emit_webhook())
+        return web.json_response({'records': records})
+
+    async def list_payloads(self, request):
+        cursor = int(request.query.get('cursor', 1))
+        limit = 50
+        payloads = self.payloads[cursor - 1:cursor - 1 + limit]
+        next_cursor = cursor + len(payloads)
+        return web.json_response({
+            'payloads': payloads,
+            'cursor': next_cursor,
+            'mightHaveMore': next_cursor <= len(self.payloads)
+        })
+
+    # Тестовое изменение записи с отправкой вебхука: POST /_standin/{table}/{record_id} {"Статус": "..."}
+    async def standin_update(self, request):
+        table = self._find_table(request.match_info['table'])
+        record = self.update(table, request.match_info['record_id'], await request.json())
+        status = await self.emit_webhook()
+        return web.json_response({'record': record, 'webhook_status': status})
+
+    def make_app(self):
+        app = web.Application(middlewares=[self.recorded_middleware])
+        app.add_routes([
+            web.get('/v0/bases/{base}/webhooks/{webhook}/payloads', self.list_payloads),
+            web.post('/_standin/{table}/{record_id}', self.standin_update),
+            web.get('/v0/{base}/{table}', self.list_records),
+            web.post('/v0/{base}/{table}', self.create_records),
+            web.patch('/v0/{base}/{table}', self.update_records),
+            web.get('/v0/{base}/{table}/{record_id}', self.get_record),
+        ])
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальные заглушки внешних сервисов")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    airtable_parser = subparsers.add_parser('airtable', help="заглушка Airtable REST API")
+    airtable_parser.add_argument('--port', type=int, default=8081)
+    airtable_parser.add_argument('--seed', help="JSON-файл {таблица: [записи]}")
+    airtable_parser.add_argument('--webhook-url')
+    airtable_parser.add_argument('--webhook-secret', help="base64-секрет, как AIRTABLE_WEBHOOK_SECRET у бота")
+    airtable_parser.add_argument('--latency', type=float, default=0.0, help="задержка ответа, секунды")
+    args = parser.parse_args()
+
+    if args.command == 'airtable':
+        standin = AirtableStandin(webhook_secret=args.webhook_secret, webhook_url=args.webhook_url, latency=args.latency)
+        if args.seed:
+            with open(args.seed, encoding='utf-8') as f:
+                standin.seed(json.load(f))
+        print(f"AIRTABLE_API_URL=http://127.0.0.1:{args.port}")
+        print(f"AIRTABLE_WEBHOOK_ID={standin.webhook_id}")
+        print(f"AIRTABLE_WEBHOOK_SECRET={standin.webhook_secret}")
+        web.run_app(standin.make_app(), port=args.port, print=None)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,51 +1,529 @@
 import os
+import re
 import requests
 import logging
+import random
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher, types
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton, FSInputFile, InputMediaPhoto
 from aiogram.enums.parse_mode import ParseMode
-from aiogram.filters import Command, StateFilter
+from aiogram.filters import Command
+from aiogram.client.session.aiohttp import AiohttpSession
+from requests.adapters import HTTPAdapter
 import asyncio
+import base64
+import bisect
+import contextvars
+import csv
+import gc
+import hashlib
+import hmac
+import json
+import math
+import shlex
+import sys
+import sqlite3
+import tempfile
+import threading
 import time
+from array import array
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 
-# Загрузка переменных окружения
-load_dotenv()
-
-# Настройка логирования
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[logging.StreamHandler()]
-)
 logger = logging.getLogger(__name__)
 
-# Настройки
-API_TOKEN = os.getenv('TELEGRAM_API_TOKEN')
-AIRTABLE_API_KEY = os.getenv('AIRTABLE_API_KEY')
-AIRTABLE_BASE_ID = os.getenv('AIRTABLE_BASE_ID')
-TEAMLEAD_ID = os.getenv('TEAMLEAD_ID')
+# Настройки из переменных окружения (или явного словаря с теми же именами, см. create_app).
+# Создаются в create_app и хранятся в App.settings и Tenant.settings; импорт модуля окружение не читает
+class Settings:
+    def __init__(self, env):
+        # Настройки тенанта по умолчанию (один бот и одна база). Несколько ботов и баз Airtable
+        # в одном процессе описываются JSON-файлом TENANTS_CONFIG (см. load_tenants)
+        self.TENANTS_CONFIG = env.get('TENANTS_CONFIG', '')
+        self.API_TOKEN = env.get('TELEGRAM_API_TOKEN')
+        self.AIRTABLE_API_KEY = env.get('AIRTABLE_API_KEY')
+        self.AIRTABLE_BASE_ID = env.get('AIRTABLE_BASE_ID')
+        self.TEAMLEAD_ID = env.get('TEAMLEAD_ID')
+        self.AIRTABLE_API_URL = env.get('AIRTABLE_API_URL', 'https://api.airtable.com').rstrip('/')
+        self.LOG_LEVEL = env.get('LOG_LEVEL', 'DEBUG').upper()
+
+        # Таймауты и автомат защиты (circuit breaker) для запросов к Airtable
+        self.AIRTABLE_TIMEOUT = float(env.get('AIRTABLE_TIMEOUT', 10))
+        self.AIRTABLE_SLOW_CALL_SECONDS = float(env.get('AIRTABLE_SLOW_CALL_SECONDS', 3))
+        self.AIRTABLE_BREAKER_FAILURES = int(env.get('AIRTABLE_BREAKER_FAILURES', 5))
+        self.AIRTABLE_BREAKER_WINDOW = int(env.get('AIRTABLE_BREAKER_WINDOW', 20))
+        self.AIRTABLE_BREAKER_SLOW_RATIO = float(env.get('AIRTABLE_BREAKER_SLOW_RATIO', 0.5))
+        self.AIRTABLE_BREAKER_COOLDOWN = int(env.get('AIRTABLE_BREAKER_COOLDOWN', 30))
+        # Время свежести кэша каталога; устаревшие данные отдаются, пока Airtable недоступен
+        self.CATALOG_CACHE_TTL = int(env.get('CATALOG_CACHE_TTL', 120))
+        self.USERS_REFRESH_INTERVAL = int(env.get('USERS_REFRESH_INTERVAL', 600))
+        # Фото товаров: поле вложений в Товары, сколько фото показывать в результатах поиска
+        # и файл реестра file_id Telegram (загруженное однажды фото отправляется повторно без загрузки)
+        self.PRODUCT_PHOTO_FIELD = env.get('PRODUCT_PHOTO_FIELD', 'Фото')
+        self.PRODUCT_PHOTO_LIMIT = int(env.get('PRODUCT_PHOTO_LIMIT', 10))
+        self.PHOTO_FILE_ID_CACHE = env.get('PHOTO_FILE_ID_CACHE', 'photo_file_ids.jsonl')
+        # Поле остатка товара и время, на которое резервируется товар незавершенной заявки
+        self.STOCK_FIELD = env.get('STOCK_FIELD', 'Текущий остаток')
+        self.STOCK_RESERVATION_TTL = int(env.get('STOCK_RESERVATION_TTL', 900))
+        # Лимит запросов к базе Airtable в секунду (у Airtable — 5 на базу)
+        self.AIRTABLE_RATE_LIMIT = float(env.get('AIRTABLE_RATE_LIMIT', 5))
+        # Размер общего для всех тенантов пула соединений с Airtable
+        self.AIRTABLE_POOL_SIZE = int(env.get('AIRTABLE_POOL_SIZE', 20))
+
+        # Вебхук Airtable: при заданном ID опрос заявок выполняется редко, как страховка
+        self.AIRTABLE_WEBHOOK_ID = env.get('AIRTABLE_WEBHOOK_ID', '')
+        self.AIRTABLE_WEBHOOK_SECRET = env.get('AIRTABLE_WEBHOOK_SECRET', '')
+        self.AIRTABLE_WEBHOOK_CURSOR_FILE = env.get('AIRTABLE_WEBHOOK_CURSOR_FILE', 'airtable_webhook_cursor')
+        self.WEBHOOK_SAFETY_POLL_INTERVAL = int(env.get('WEBHOOK_SAFETY_POLL_INTERVAL', 3600))
+
+        # Опрос заявок по уровням статусов: "статус:секунды,..." для активных статусов,
+        # остальные незавершенные — DEFAULT_STATUS_POLL_INTERVAL, завершенные — только в сверке
+        self.STATUS_POLL_INTERVALS = {
+            status.strip(): int(interval)
+            for status, _, interval in (
+                item.rpartition(':') for item in env.get('STATUS_POLL_INTERVALS', 'В обработке:600').split(',')
+            )
+            if status.strip() and interval.strip().isdigit()
+        }
+        self.DEFAULT_STATUS_POLL_INTERVAL = int(env.get('DEFAULT_STATUS_POLL_INTERVAL', 1200))
+        self.TERMINAL_STATUSES = {
+            status.strip()
+            for status in env.get('TERMINAL_STATUSES', 'Доставлено,Выполнено,Отменено').split(',')
+            if status.strip()
+        }
+        # Полная сверка всех заявок: раз в TERMINAL_RECONCILE_INTERVAL или ежедневно в TERMINAL_RECONCILE_HOUR (UTC)
+        self.TERMINAL_RECONCILE_INTERVAL = int(env.get('TERMINAL_RECONCILE_INTERVAL', 86400))
+        self.TERMINAL_RECONCILE_HOUR = env.get('TERMINAL_RECONCILE_HOUR', '')
+        # Интервал уровня подстраивается под частоту изменений в пределах [база * MIN, база * MAX]
+        self.POLL_INTERVAL_MIN_FACTOR = float(env.get('POLL_INTERVAL_MIN_FACTOR', 0.25))
+        self.POLL_INTERVAL_MAX_FACTOR = float(env.get('POLL_INTERVAL_MAX_FACTOR', 4))
+
+        # Планировщик апдейтов: последовательная обработка в пределах чата, общий лимит параллелизма
+        self.UPDATE_MAX_CONCURRENCY = int(env.get('UPDATE_MAX_CONCURRENCY', 32))
+        self.CALLBACK_DEDUP_WINDOW = float(env.get('CALLBACK_DEDUP_WINDOW', 1.5))
+
+        # Сторож event loop: период контрольного таймера и задержка, после которой цикл считается
+        # заблокированным и снимается стек (0 — сторож выключен)
+        self.LOOP_WATCHDOG_INTERVAL = float(env.get('LOOP_WATCHDOG_INTERVAL', 0.1))
+        self.LOOP_BLOCK_THRESHOLD = float(env.get('LOOP_BLOCK_THRESHOLD', 0.25))
+
+        # Трассировка обработки апдейтов: спаны пишутся в JSONL (пустой путь — выключено)
+        self.TRACE_FILE = env.get('TRACE_FILE', '')
+        self.TRACE_SAMPLE_RATE = float(env.get('TRACE_SAMPLE_RATE', 0.1))
+
+        # Запись трафика для воспроизведения (python bench.py replay): апдейты Telegram и ответы
+        # Airtable в JSONL с обезличенными персональными данными (пустой путь — выключено)
+        self.CAPTURE_FILE = env.get('CAPTURE_FILE', '')
+        self.CAPTURE_SALT = env.get('CAPTURE_SALT', '')
+
+        # Режим дайджеста для тимлида: заявки копятся и отправляются одним сообщением
+        self.TEAMLEAD_DIGEST_ENABLED = env.get('TEAMLEAD_DIGEST_ENABLED', '0') == '1'
+        self.TEAMLEAD_DIGEST_INTERVAL = int(env.get('TEAMLEAD_DIGEST_INTERVAL', 600))
+        self.TEAMLEAD_DIGEST_MAX_ITEMS = int(env.get('TEAMLEAD_DIGEST_MAX_ITEMS', 50))
+        self.TEAMLEAD_DIGEST_SPOOL = env.get('TEAMLEAD_DIGEST_SPOOL', 'teamlead_digest.jsonl')
+        self.TEAMLEAD_URGENT_KEYWORDS = [
+            keyword.strip().lower()
+            for keyword in env.get('TEAMLEAD_URGENT_KEYWORDS', 'срочно').split(',')
+            if keyword.strip()
+        ]
+
+        # Локальная SQLite-реплика таблиц Airtable (пустой путь — реплика выключена)
+        self.REPLICA_DB_PATH = env.get('REPLICA_DB_PATH', '')
+        self.REPLICA_SYNC_INTERVAL = int(env.get('REPLICA_SYNC_INTERVAL', 60))
+        self.REPLICA_MAX_STALENESS = int(env.get('REPLICA_MAX_STALENESS', 300))
+        self.REPLICA_FULL_SYNC_EVERY = int(env.get('REPLICA_FULL_SYNC_EVERY', 60))
+
+        # Статусы, которые считаются ожидающими обработки (для /stats)
+        self.PENDING_STATUSES = {
+            status.strip()
+            for status in env.get('PENDING_STATUSES', 'В обработке').split(',')
+            if status.strip()
+        }
 
-# Проверка наличия переменных окружения
-if not all([API_TOKEN, AIRTABLE_API_KEY, AIRTABLE_BASE_ID, TEAMLEAD_ID]):
-    logger.critical("Отсутствуют необходимые переменные окружения")
-    raise ValueError("Необходимо задать TELEGRAM_API_TOKEN, AIRTABLE_API_KEY, AIRTABLE_BASE_ID, TEAMLEAD_ID")
+MAX_MESSAGE_LENGTH = 4000
 
-# Инициализация бота
-bot = Bot(token=API_TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+# Отметки времени изменений заявок (защита от устаревших страниц опроса) чистятся,
+# когда их больше MAX_ENTRIES, от отметок старше HORIZON секунд
+REQUEST_CHANGED_AT_MAX_ENTRIES = 1024
+REQUEST_CHANGED_AT_HORIZON = 3600
 
-# Словарь для хранения пользователей (Telegram ID -> {Record ID, Отдел})
-ALLOWED_USERS = {}
+# Пауза перед повторной отправкой дайджеста при переполнении буфера после ошибки:
+# удваивается с каждой ошибкой, но не дольше TEAMLEAD_DIGEST_INTERVAL
+TEAMLEAD_DIGEST_RETRY_DELAY = 30
 
-# Словарь для отслеживания статуса заявок (record_id -> {'status': status, 'tracking_number': tracking_number})
-REQUEST_STATUSES = {}
+def configure_logging(settings):
+    logging.basicConfig(
+        level=getattr(logging, settings.LOG_LEVEL, logging.DEBUG),
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[logging.StreamHandler()]
+    )
 
-# Словарь для маппинга record_id пользователя в Airtable на Telegram ID
-RECORD_ID_TO_TELEGRAM_ID = {}
+# Общие для всех тенантов соединения: HTTP-сессия Telegram и пул соединений с Airtable.
+# Создаются при первом обращении
+TELEGRAM_SESSION = None
+AIRTABLE_HTTP = None
+
+def get_telegram_session():
+    global TELEGRAM_SESSION
+    if TELEGRAM_SESSION is None:
+        TELEGRAM_SESSION = AiohttpSession()
+        TELEGRAM_SESSION.middleware(trace_telegram_request)
+    return TELEGRAM_SESSION
+
+def get_airtable_http():
+    global AIRTABLE_HTTP
+    if AIRTABLE_HTTP is None:
+        session = requests.Session()
+        pool_size = tenant.settings.AIRTABLE_POOL_SIZE
+        session.mount('https://', HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+        session.mount('http://', HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+        AIRTABLE_HTTP = session
+    return AIRTABLE_HTTP
+
+# Один диспетчер на все боты: хранилище FSM различает их по bot_id
+dp = Dispatcher(storage=MemoryStorage())
+
+# Агрегаты по заявкам для /stats, обновляются поллером при каждом сравнении.
+# Поля заявок хранятся компактно, как в RequestFingerprints: по слоту на заявку, значения
+# полей — коды в массивах, сами строки — один раз в общей таблице значений
+class RequestStats:
+    FIELDS = ('status', 'department', 'delivery_method', 'day')
+
+    def __init__(self):
+        # record_id (интернированная строка) -> номер слота
+        self.slots = {}
+        self.free_slots = []
+        # Коды полей FIELDS по слотам и момент входа в статус (nan — неизвестен)
+        self.columns = tuple(array('I') for _ in self.FIELDS)
+        self.since = array('d')
+        # Значения полей: значение -> код и код -> значение
+        self.value_codes = {}
+        self.values = []
+        self.by_status = Counter()
+        self.by_department = Counter()
+        self.by_delivery = Counter()
+        self.by_day = Counter()
+        # status -> отсортированный массив известных моментов входа в статус (для медианы)
+        self.status_since = {}
+        self.updated_at = None
+
+    def __len__(self):
+        return len(self.slots)
+
+    def _code(self, value):
+        code = self.value_codes.get(value)
+        if code is None:
+            code = self.value_codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    # (status, department, delivery_method, day, status_since) заявки или None
+    def get(self, record_id):
+        slot = self.slots.get(record_id)
+        if slot is None:
+            return None
+        since = self.since[slot]
+        return (*(self.values[column[slot]] for column in self.columns), None if math.isnan(since) else since)
+
+    def _add(self, record_id, entry):
+        status, department, delivery_method, day, since = entry
+        codes = [self._code(value) for value in entry[:4]]
+        if self.free_slots:
+            slot = self.free_slots.pop()
+            for column, code in zip(self.columns, codes):
+                column[slot] = code
+            self.since[slot] = math.nan if since is None else since
+        else:
+            slot = len(self.since)
+            for column, code in zip(self.columns, codes):
+                column.append(code)
+            self.since.append(math.nan if since is None else since)
+        self.slots[sys.intern(record_id)] = slot
+        self.by_status[status] += 1
+        self.by_department[department] += 1
+        self.by_delivery[delivery_method] += 1
+        self.by_day[day] += 1
+        if since is not None:
+            bisect.insort(self.status_since.setdefault(status, array('d')), since)
+
+    def remove(self, record_id):
+        entry = self.get(record_id)
+        if entry is None:
+            return
+        self.free_slots.append(self.slots.pop(record_id))
+        status, department, delivery_method, day, since = entry
+        for counter, key in ((self.by_status, status), (self.by_department, department),
+                             (self.by_delivery, delivery_method), (self.by_day, day)):
+            counter[key] -= 1
+            if counter[key] <= 0:
+                del counter[key]
+        if since is not None:
+            timestamps = self.status_since[status]
+            del timestamps[bisect.bisect_left(timestamps, since)]
+            if not timestamps:
+                del self.status_since[status]
+        self.updated_at = time.time()
+
+    # since — момент входа в статус из Airtable; None, если он неизвестен (заявка впервые
+    # увидена не в ожидающем статусе). Смена статуса, замеченная ботом, отмечается текущим временем
+    def upsert(self, record_id, status, department, delivery_method, day, since=None):
+        now = time.time()
+        old = self.get(record_id)
+        if old is not None and old[:4] == (status, department, delivery_method, day):
+            return
+        if old is not None and old[0] == status:
+            since = old[4]
+        elif old is not None:
+            since = now
+        self.remove(record_id)
+        self._add(record_id, (status, department, delivery_method, day, since))
+        self.updated_at = now
+
+    def pending_count(self, pending_statuses):
+        return sum(self.by_status[status] for status in pending_statuses)
+
+    # Число заявок статуса, для которых известен момент входа в него
+    def known_in_status(self, status):
+        return len(self.status_since.get(status, ()))
+
+    def median_time_in_status(self, status):
+        timestamps = self.status_since.get(status)
+        if not timestamps:
+            return None
+        middle = len(timestamps) // 2
+        if len(timestamps) % 2:
+            median_since = timestamps[middle]
+        else:
+            median_since = (timestamps[middle - 1] + timestamps[middle]) / 2
+        return time.time() - median_since
+
+# Последнее известное состояние заявок для поиска изменений: один 64-битный отпечаток
+# на запись в array('Q') — код статуса (16 бит) и хэш трек-номера (48 бит).
+# Слоты удаленных записей переиспользуются.
+class RequestFingerprints:
+    TRACKING_BITS = 48
+    TRACKING_MASK = (1 << TRACKING_BITS) - 1
+
+    def __init__(self):
+        # record_id (интернированная строка) -> номер слота в values
+        self.slots = {}
+        self.values = array('Q')
+        self.free_slots = []
+        # Коды статусов: статус -> код и код -> статус
+        self.status_codes = {}
+        self.statuses = []
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, record_id):
+        return record_id in self.slots
+
+    def __iter__(self):
+        return iter(list(self.slots))
+
+    def fingerprint(self, status, tracking_number):
+        code = self.status_codes.get(status)
+        if code is None:
+            code = self.status_codes[status] = len(self.statuses)
+            self.statuses.append(status)
+        return (code << self.TRACKING_BITS) | self.tracking_hash(tracking_number)
+
+    # Хэш трек-номера без изменения хранилища (можно вызывать вне event loop)
+    @staticmethod
+    def tracking_hash(tracking_number):
+        if not tracking_number:
+            return 0
+        digest = hashlib.blake2b(str(tracking_number).encode(), digest_size=6).digest()
+        return int.from_bytes(digest, 'big') or 1
+
+    def status_of(self, fingerprint):
+        return self.statuses[fingerprint >> self.TRACKING_BITS]
+
+    def tracking_of(self, fingerprint):
+        return fingerprint & self.TRACKING_MASK
+
+    def get(self, record_id):
+        slot = self.slots.get(record_id)
+        return None if slot is None else self.values[slot]
+
+    def status(self, record_id):
+        fingerprint = self.get(record_id)
+        return None if fingerprint is None else self.status_of(fingerprint)
+
+    def slot(self, record_id):
+        return self.slots.get(record_id)
+
+    def set(self, record_id, fingerprint):
+        slot = self.slots.get(record_id)
+        if slot is not None:
+            self.values[slot] = fingerprint
+        elif self.free_slots:
+            slot = self.slots[sys.intern(record_id)] = self.free_slots.pop()
+            self.values[slot] = fingerprint
+        else:
+            self.slots[sys.intern(record_id)] = len(self.values)
+            self.values.append(fingerprint)
+
+    def put(self, record_id, status, tracking_number):
+        self.set(record_id, self.fingerprint(status, tracking_number))
+
+    def remove(self, record_id):
+        slot = self.slots.pop(record_id, None)
+        if slot is None:
+            return False
+        self.values[slot] = 0
+        self.free_slots.append(slot)
+        return True
+
+    def clear(self):
+        self.slots.clear()
+        self.values = array('Q')
+        self.free_slots.clear()
+
+    # Записи, чей статус удовлетворяет условию, и номер слота каждой
+    def iter_slots(self, status_filter=None):
+        for record_id, slot in list(self.slots.items()):
+            if status_filter is None or status_filter(self.status_of(self.values[slot])):
+                yield record_id, slot
+
+# Тенант: бот Telegram и база Airtable со всем их состоянием. Обработчики и фоновые
+# задачи обращаются к состоянию текущего тенанта через прокси tenant.
+class Tenant:
+    def __init__(self, name, telegram_token, airtable_api_key, airtable_base_id, teamlead_id, settings,
+                 webhook_id='', webhook_secret='', webhook_cursor_file=None, replica_db_path='', digest_spool=None):
+        self.name = name
+        self.settings = settings
+        self.bot = Bot(token=telegram_token, session=get_telegram_session())
+        self.airtable_api_key = airtable_api_key
+        self.airtable_base_id = airtable_base_id
+        self.teamlead_id = teamlead_id
+        self.webhook_id = webhook_id
+        self.webhook_secret = webhook_secret
+        # Файлы тенанта по умолчанию получают суффикс с его именем, чтобы тенанты их не делили
+        suffix = '' if name == 'default' else f'.{name}'
+        self.webhook_cursor_file = webhook_cursor_file or settings.AIRTABLE_WEBHOOK_CURSOR_FILE + suffix
+        self.replica_db_path = replica_db_path
+        self.digest_spool = digest_spool or settings.TEAMLEAD_DIGEST_SPOOL + suffix
+        # file_id принадлежат конкретному боту, поэтому реестр у каждого тенанта свой
+        self.photo_file_ids = PhotoFileIdCache(settings.PHOTO_FILE_ID_CACHE + suffix)
+        # Пользователи (Telegram ID -> {Record ID, Отдел})
+        self.allowed_users = {}
+        # Отпечатки статуса и трек-номера заявок (record_id -> fingerprint)
+        self.request_statuses = RequestFingerprints()
+        # record_id пользователя в Airtable -> Telegram ID
+        self.record_id_to_telegram_id = {}
+        self.request_stats = RequestStats()
+        # Реплика Airtable (создается в main, если задан replica_db_path)
+        self.replica = None
+        # Сериализация сравнения статусов между поллером и вебхуком
+        self.request_changes_lock = asyncio.Lock()
+        # Когда были запрошены данные, давшие последнее изменение заявки (record_id -> monotonic);
+        # данные, запрошенные раньше, устарели и не применяются
+        self.request_changed_at = {}
+        # Курсор payload вебхука Airtable (загружается из файла при первом уведомлении)
+        self.webhook_cursor = None
+        self.webhook_lock = asyncio.Lock()
+        # Буфер заявок для дайджеста тимлида (дублируется в digest_spool)
+        self.digest_buffer = []
+        self.digest_lock = asyncio.Lock()
+        # Неудачные отправки дайджеста подряд и время, раньше которого переполнение буфера
+        # не вызывает повторную отправку (monotonic)
+        self.digest_failures = 0
+        self.digest_retry_at = 0.0
+        self.catalog_search_cache = StaleWhileRevalidateCache('Товары', settings.CATALOG_CACHE_TTL)
+        self.product_cache = StaleWhileRevalidateCache('Товары', settings.CATALOG_CACHE_TTL)
+        # Названия товаров (product_id -> Название)
+        self.product_name_cache = {}
+        # Остатки из каталога и резервы незавершенных заявок
+        self.stock_ledger = StockLedger(settings.STOCK_RESERVATION_TTL)
+        self.status_poll_scheduler = StatusPollScheduler(settings)
+
+    # Копия текущего контекста, в которой текущим тенантом является этот
+    def context(self):
+        context = contextvars.copy_context()
+        context.run(CURRENT_TENANT.set, self)
+        return context
+
+    def run(self, func, *args, **kwargs):
+        return self.context().run(func, *args, **kwargs)
+
+    def create_task(self, coro):
+        return self.context().run(asyncio.create_task, coro)
+
+# Тенанты процесса (имя -> Tenant) и их боты (bot.id -> Tenant)
+TENANTS = {}
+TENANTS_BY_BOT_ID = {}
+CURRENT_TENANT = contextvars.ContextVar('current_tenant', default=None)
+
+def current_tenant():
+    current = CURRENT_TENANT.get()
+    if current is None:
+        # Вне апдейта и фоновых задач тенанта однозначен только единственный тенант
+        if len(TENANTS) != 1:
+            raise RuntimeError("Текущий тенант не задан")
+        current = next(iter(TENANTS.values()))
+    return current
+
+# Прокси к текущему тенанту: tenant.allowed_users, tenant.bot и т.д.
+class CurrentTenant:
+    def __getattr__(self, name):
+        return getattr(current_tenant(), name)
+
+    def __setattr__(self, name, value):
+        setattr(current_tenant(), name, value)
+
+tenant = CurrentTenant()
+
+# Тенанты из TENANTS_CONFIG или один тенант из переменных окружения. Формат файла:
+# {"tenants": [{"name": "marketing", "telegram_token": "${MARKETING_BOT_TOKEN}",
+#   "airtable_base_id": "app...", "teamlead_id": "123", "webhook_id": "...", ...}]}
+# Значения вида ${VAR} подставляются из окружения, airtable_api_key по умолчанию — AIRTABLE_API_KEY.
+# Имена и токены ботов тенантов должны быть уникальны
+TENANT_REQUIRED_KEYS = ('name', 'telegram_token', 'airtable_api_key', 'airtable_base_id', 'teamlead_id')
+TENANT_OPTIONAL_KEYS = ('webhook_id', 'webhook_secret', 'webhook_cursor_file', 'replica_db_path', 'digest_spool')
+
+def load_tenants(settings):
+    if not settings.TENANTS_CONFIG:
+        if not all([settings.API_TOKEN, settings.AIRTABLE_API_KEY, settings.AIRTABLE_BASE_ID, settings.TEAMLEAD_ID]):
+            logger.critical("Отсутствуют необходимые переменные окружения")
+            raise ValueError("Необходимо задать TELEGRAM_API_TOKEN, AIRTABLE_API_KEY, AIRTABLE_BASE_ID, TEAMLEAD_ID")
+        return {'default': Tenant(
+            'default', settings.API_TOKEN, settings.AIRTABLE_API_KEY, settings.AIRTABLE_BASE_ID,
+            settings.TEAMLEAD_ID, settings, webhook_id=settings.AIRTABLE_WEBHOOK_ID,
+            webhook_secret=settings.AIRTABLE_WEBHOOK_SECRET, replica_db_path=settings.REPLICA_DB_PATH
+        )}
+    with open(settings.TENANTS_CONFIG, encoding='utf-8') as f:
+        entries = json.load(f).get('tenants', [])
+    tenants = {}
+    tenant_names_by_token = {}
+    for entry in entries:
+        entry = {key: os.path.expandvars(value) if isinstance(value, str) else value for key, value in entry.items()}
+        entry.setdefault('airtable_api_key', settings.AIRTABLE_API_KEY)
+        name = entry.get('name', '?')
+        unknown = [key for key in entry if key not in TENANT_REQUIRED_KEYS + TENANT_OPTIONAL_KEYS]
+        if unknown:
+            logger.critical(f"Неизвестные параметры тенанта {name}")
+            raise ValueError(f"Тенант {name}: неизвестные параметры {', '.join(unknown)}")
+        missing = [key for key in TENANT_REQUIRED_KEYS if not entry.get(key)]
+        if missing:
+            logger.critical(f"Неполная конфигурация тенанта {name}")
+            raise ValueError(f"Тенант {name}: необходимо задать {', '.join(missing)}")
+        if name in tenants:
+            logger.critical(f"Повторяющееся имя тенанта {name}")
+            raise ValueError(f"Тенант {name} описан в {settings.TENANTS_CONFIG} несколько раз")
+        other = tenant_names_by_token.setdefault(entry['telegram_token'], name)
+        if other != name:
+            logger.critical(f"Тенанты {other} и {name} используют один бот")
+            raise ValueError(f"Тенанты {other} и {name}: у каждого тенанта должен быть свой telegram_token")
+        tenants[name] = Tenant(settings=settings, **entry)
+    if not tenants:
+        raise ValueError(f"В {settings.TENANTS_CONFIG} не описано ни одного тенанта")
+    return tenants
 
 # Состояния для FSM
 class CreateRequest(StatesGroup):
@@ -61,15 +539,746 @@ class CreateRequest(StatesGroup):
     choosing_delivery = State()
     entering_custom_delivery = State()
 
-# Загрузка пользователей из Airtable
-def load_users():
+# Контекст текущей трассы: {'trace_id', 'sampled', 'update_id', 'user_id', 'state'}
+TRACE_CONTEXT = contextvars.ContextVar('trace_context', default=None)
+TRACE_LOCK = threading.Lock()
+TRACE_OUTPUT = None
+
+# Запись спана в файл трассировки
+def write_trace_span(span):
+    global TRACE_OUTPUT
+    with TRACE_LOCK:
+        if TRACE_OUTPUT is None:
+            TRACE_OUTPUT = open(tenant.settings.TRACE_FILE, 'a', encoding='utf-8', buffering=1)
+        TRACE_OUTPUT.write(json.dumps(span, ensure_ascii=False, default=str) + "\n")
+
+# Начало новой трассы (апдейт или цикл фоновой задачи) с решением о сэмплировании
+def start_trace(trace_id, **tags):
+    settings = tenant.settings
+    sampled = bool(settings.TRACE_FILE) and random.random() < settings.TRACE_SAMPLE_RATE
+    return TRACE_CONTEXT.set({'trace_id': trace_id, 'sampled': sampled, **tags})
+
+# Спан трассировки; работает и вокруг синхронного кода, и вокруг await
+@contextmanager
+def trace_span(name, **tags):
+    context = TRACE_CONTEXT.get()
+    if not context or not context['sampled']:
+        yield tags
+        return
+    started = time.time()
+    started_perf = time.perf_counter()
+    error = None
     try:
-        headers = {'Authorization': f'Bearer {AIRTABLE_API_KEY}'}
-        url = f'https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/Пользователи'
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
-        users = response.json().get('records', [])
-        allowed_users = {}
+        yield tags
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        span = dict(context)
+        del span['sampled']
+        span.update(tags)
+        span.update({
+            'span': name,
+            'start': started,
+            'duration_ms': round((time.perf_counter() - started_perf) * 1000, 3),
+            'error': error
+        })
+        try:
+            write_trace_span(span)
+        except Exception as e:
+            logger.error(f"Ошибка записи трассировки: {e}")
+
+# Поля Airtable и состояния FSM с персональными данными: при записи трафика маскируются
+CAPTURE_PERSONAL_FIELDS = ('ФИО', 'Номер_телефона', 'Адрес', 'Индекс', 'Имя', 'Username', 'Телефон', 'Email')
+CAPTURE_PERSONAL_STATES = {
+    CreateRequest.entering_fio.state,
+    CreateRequest.entering_phone.state,
+    CreateRequest.entering_address.state,
+    CreateRequest.entering_index.state,
+    CreateRequest.entering_custom_delivery.state
+}
+
+# Маскирование с сохранением формы: буквы -> x, цифры -> 0 (проверки ввода проходят так же)
+def mask_text(text):
+    return ''.join('0' if c.isdigit() else 'x' if c.isalpha() else c for c in str(text))
+
+# Запись трафика в JSONL. Telegram ID заменяются псевдонимами (HMAC с солью),
+# одинаковыми в апдейтах и в поле Telegram_ID таблицы Пользователи
+class TrafficCapture:
+    def __init__(self, path, salt=''):
+        self.path = path
+        self.salt = salt.encode() if salt else os.urandom(16)
+        self.started = time.monotonic()
+        self.output = None
+        self.lock = threading.Lock()
+
+    def pseudonym(self, value):
+        number = int(value)
+        digest = hmac.new(self.salt, str(abs(number)).encode(), hashlib.sha256).digest()
+        pseudonym = int.from_bytes(digest[:5], 'big') + 1000000
+        return -pseudonym if number < 0 else pseudonym
+
+    def write(self, entry):
+        entry = {'t': round(time.monotonic() - self.started, 4), **entry}
+        line = json.dumps(entry, ensure_ascii=False, default=str)
+        with self.lock:
+            if self.output is None:
+                self.output = open(self.path, 'a', encoding='utf-8', buffering=1)
+            self.output.write(line + "\n")
+
+    def _anonymize_identities(self, value):
+        if isinstance(value, dict):
+            if isinstance(value.get('id'), int) and ('first_name' in value or 'type' in value):
+                value['id'] = self.pseudonym(value['id'])
+                for key in ('first_name', 'last_name', 'username', 'title'):
+                    if key in value:
+                        value[key] = mask_text(value[key])
+            if 'phone_number' in value:
+                value['phone_number'] = mask_text(value['phone_number'])
+            for item in value.values():
+                self._anonymize_identities(item)
+        elif isinstance(value, list):
+            for item in value:
+                self._anonymize_identities(item)
+
+    def record_update(self, update, state):
+        data = update.model_dump(mode='json', exclude_none=True, by_alias=True)
+        self._anonymize_identities(data)
+        message = data.get('message')
+        if message and 'text' in message and state in CAPTURE_PERSONAL_STATES:
+            message['text'] = mask_text(message['text'])
+        # Цитируемые и отредактированные ботом сообщения могут содержать данные из заявки
+        quoted = [
+            (message or {}).get('reply_to_message'),
+            (message or {}).get('quote'),
+            (data.get('callback_query') or {}).get('message')
+        ]
+        for quoted_message in quoted:
+            for key in ('text', 'caption'):
+                if quoted_message and key in quoted_message:
+                    quoted_message[key] = mask_text(quoted_message[key])
+        self.write({'kind': 'update', 'state': state, 'update': data})
+
+    def _anonymize_records(self, body):
+        records = body.get('records', []) if isinstance(body, dict) else []
+        if isinstance(body, dict) and 'fields' in body:
+            records = [body]
+        for record in records:
+            fields = record.get('fields', {})
+            for name in CAPTURE_PERSONAL_FIELDS:
+                if name in fields:
+                    fields[name] = mask_text(fields[name])
+            if 'Telegram_ID' in fields:
+                try:
+                    pseudonym = self.pseudonym(fields['Telegram_ID'])
+                    fields['Telegram_ID'] = str(pseudonym) if isinstance(fields['Telegram_ID'], str) else pseudonym
+                except (TypeError, ValueError):
+                    fields['Telegram_ID'] = mask_text(fields['Telegram_ID'])
+
+    def record_airtable(self, method, url, params, response, latency):
+        try:
+            body = response.json()
+        except ValueError:
+            body = None
+        self._anonymize_records(body)
+        # Путь без ID базы: при воспроизведении заглушка сопоставляет запросы по нему
+        path = re.sub(r'^/v0/(bases/)?[^/]+', r'/v0/\1{base}', requests.utils.urlparse(url).path)
+        query = sorted(
+            [key, str(item)]
+            for key, value in (params or {}).items()
+            for item in (value if isinstance(value, (list, tuple)) else [value])
+        )
+        self.write({
+            'kind': 'airtable', 'method': method, 'path': path, 'params': query,
+            'status': response.status_code, 'latency': round(latency, 4), 'body': body
+        })
+
+# Создается в create_app, если задан CAPTURE_FILE
+CAPTURE = None
+
+# Airtable недоступен: автомат защиты для таблицы разомкнут
+class AirtableUnavailable(requests.exceptions.ConnectionError):
+    pass
+
+# Автомат защиты для одной таблицы Airtable. Размыкается после серии ошибок
+# или если медленных/неудачных вызовов в окне больше AIRTABLE_BREAKER_SLOW_RATIO;
+# через AIRTABLE_BREAKER_COOLDOWN секунд пропускает один пробный запрос.
+class CircuitBreaker:
+    MIN_CALLS = 5
+
+    def __init__(self, name, settings):
+        self.name = name
+        self.settings = settings
+        self.state = 'closed'
+        self.opened_at = None
+        self.consecutive_failures = 0
+        self.recent = deque(maxlen=settings.AIRTABLE_BREAKER_WINDOW)
+        self.last_latency = None
+        self.last_error = None
+        self.trial_in_flight = False
+        self.lock = threading.Lock()
+
+    def _open(self):
+        if self.state != 'open':
+            logger.warning(f"Circuit breaker for Airtable table {self.name} opened")
+        self.state = 'open'
+        self.opened_at = time.time()
+
+    def allow(self):
+        with self.lock:
+            if self.state == 'open':
+                if time.time() - self.opened_at < self.settings.AIRTABLE_BREAKER_COOLDOWN:
+                    return False
+                self.state = 'half_open'
+                self.trial_in_flight = False
+            if self.state == 'half_open':
+                if self.trial_in_flight:
+                    return False
+                self.trial_in_flight = True
+            return True
+
+    def record(self, latency, ok, error=None):
+        with self.lock:
+            slow = latency > self.settings.AIRTABLE_SLOW_CALL_SECONDS
+            self.last_latency = latency
+            if error:
+                self.last_error = error
+            self.recent.append(slow or not ok)
+            self.consecutive_failures = 0 if ok else self.consecutive_failures + 1
+            if self.state == 'half_open':
+                self.trial_in_flight = False
+                if ok and not slow:
+                    logger.info(f"Circuit breaker for Airtable table {self.name} closed")
+                    self.state = 'closed'
+                    self.recent.clear()
+                else:
+                    self._open()
+                return
+            bad_ratio = sum(self.recent) / len(self.recent)
+            if self.consecutive_failures >= self.settings.AIRTABLE_BREAKER_FAILURES or (
+                    len(self.recent) >= self.MIN_CALLS and bad_ratio >= self.settings.AIRTABLE_BREAKER_SLOW_RATIO):
+                self._open()
+
+    # Разомкнут, в пробном режиме или последний вызов был медленным/неудачным
+    def is_degraded(self):
+        return self.state != 'closed' or bool(self.recent and self.recent[-1])
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'state': self.state,
+                'opened_at': self.opened_at,
+                'consecutive_failures': self.consecutive_failures,
+                'bad_calls_in_window': sum(self.recent),
+                'window_size': len(self.recent),
+                'last_latency_ms': round(self.last_latency * 1000, 1) if self.last_latency is not None else None,
+                'last_error': self.last_error
+            }
+
+# Ограничитель частоты запросов (token bucket). Вызывающий поток резервирует слот
+# и ждет его наступления, поэтому порядок запросов сохраняется.
+class RateLimiter:
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.total_wait = 0.0
+        self.lock = threading.Lock()
+
+    # Блокирует вызывающий поток до освобождения токена: вызывается только вне event loop
+    # (обработчики обращаются к Airtable через asyncio.to_thread)
+    def acquire(self):
+        if self.rate <= 0:
+            return 0.0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            self.total_wait += wait
+        if wait:
+            time.sleep(wait)
+        return wait
+
+# Ограничители частоты и автоматы защиты общие для тенантов с одной базой:
+# лимит Airtable действует на базу, а не на бота
+AIRTABLE_RATE_LIMITERS = {}
+AIRTABLE_BREAKERS = {}
+AIRTABLE_BREAKERS_LOCK = threading.Lock()
+
+def get_rate_limiter(base_id=None):
+    base_id = base_id or tenant.airtable_base_id
+    with AIRTABLE_BREAKERS_LOCK:
+        limiter = AIRTABLE_RATE_LIMITERS.get(base_id)
+        if limiter is None:
+            limiter = AIRTABLE_RATE_LIMITERS[base_id] = RateLimiter(tenant.settings.AIRTABLE_RATE_LIMIT)
+        return limiter
+
+def get_airtable_breaker(table, base_id=None):
+    key = (base_id or tenant.airtable_base_id, table)
+    with AIRTABLE_BREAKERS_LOCK:
+        breaker = AIRTABLE_BREAKERS.get(key)
+        if breaker is None:
+            breaker = AIRTABLE_BREAKERS[key] = CircuitBreaker(table, tenant.settings)
+        return breaker
+
+# Запрос к Airtable API по таблице или пути записи: 'Заявки', 'Товары/recXXX'
+def airtable_request(method, path, **kwargs):
+    url = f'{tenant.settings.AIRTABLE_API_URL}/v0/{tenant.airtable_base_id}/{path}'
+    return airtable_call(method, url, path.split('/', 1)[0], **kwargs)
+
+# Вызов Airtable с таймаутом, автоматом защиты (по имени table) и спаном трассировки
+def airtable_call(method, url, table, **kwargs):
+    base_id = tenant.airtable_base_id
+    breaker = get_airtable_breaker(table, base_id)
+    if not breaker.allow():
+        raise AirtableUnavailable(f"Airtable table {table} is unavailable (circuit open)")
+    headers = {'Authorization': f'Bearer {tenant.airtable_api_key}'}
+    if 'json' in kwargs:
+        headers['Content-Type'] = 'application/json'
+    kwargs.setdefault('timeout', tenant.settings.AIRTABLE_TIMEOUT)
+    get_rate_limiter(base_id).acquire()
+    started = time.perf_counter()
+    try:
+        with trace_span('airtable', method=method, table=table) as span:
+            response = get_airtable_http().request(method, url, headers=headers, **kwargs)
+            span['status_code'] = response.status_code
+    except requests.exceptions.RequestException as e:
+        breaker.record(time.perf_counter() - started, ok=False, error=repr(e))
+        raise
+    latency = time.perf_counter() - started
+    ok = response.status_code < 500 and response.status_code != 429
+    breaker.record(latency, ok=ok, error=None if ok else f"HTTP {response.status_code}")
+    if CAPTURE:
+        CAPTURE.record_airtable(method, url, kwargs.get('params'), response, latency)
+    return response
+
+# Фоновые обновления кэшей (stale-while-revalidate)
+REVALIDATION_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix='revalidate')
+
+# Кэш чтений из Airtable: свежие данные отдаются сразу, устаревшие — пока таблица
+# деградировала, с фоновым обновлением; при ошибке загрузки — последние удачные данные
+class StaleWhileRevalidateCache:
+    def __init__(self, table, ttl, max_entries=2000):
+        self.table = table
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.refreshing = set()
+        self.lock = threading.Lock()
+
+    def _store(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.time(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def _revalidate(self, key, loader):
+        with self.lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+
+        def run():
+            try:
+                self._store(key, loader())
+            except Exception as e:
+                logger.debug(f"Background revalidation of {self.table} failed: {e}")
+            finally:
+                with self.lock:
+                    self.refreshing.discard(key)
+
+        # Обновление выполняется в контексте вызывающего (тенант, трасса)
+        REVALIDATION_EXECUTOR.submit(contextvars.copy_context().run, run)
+
+    def get(self, key, loader):
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry and time.time() - entry[0] < self.ttl:
+            return entry[1]
+        if entry and get_airtable_breaker(self.table).is_degraded():
+            self._revalidate(key, loader)
+            return entry[1]
+        try:
+            value = loader()
+        except Exception as e:
+            if entry:
+                logger.warning(f"Serving stale {self.table} data for {key!r}: {e}")
+                return entry[1]
+            raise
+        self._store(key, value)
+        return value
+
+# Состояние для эндпоинта /health: общие очереди и по каждому тенанту его база и данные
+def get_health():
+    tenants = {}
+    for name, current in TENANTS.items():
+        base_id = current.airtable_base_id
+        limiter = AIRTABLE_RATE_LIMITERS.get(base_id)
+        tenants[name] = {
+            'airtable_base_id': base_id,
+            'airtable_breakers': {
+                table: breaker.snapshot() for (breaker_base, table), breaker in list(AIRTABLE_BREAKERS.items())
+                if breaker_base == base_id
+            },
+            'airtable_rate_limit_wait_seconds': round(limiter.total_wait, 3) if limiter else 0.0,
+            'users_loaded': len(current.allowed_users),
+            'replica_staleness': current.replica.staleness() if current.replica else None,
+            'status_polling': current.run(current.status_poll_scheduler.snapshot) if not current.replica else None,
+            'stock': current.stock_ledger.snapshot()
+        }
+    return {'updates': UPDATE_SCHEDULER.snapshot(), 'event_loop': LOOP_WATCHDOG.snapshot(), 'tenants': tenants}
+
+# Метрики для эндпоинта /metrics (имя -> значение)
+def get_metrics():
+    metrics = {f"updates_{name}": value for name, value in UPDATE_SCHEDULER.snapshot().items()}
+    event_loop = LOOP_WATCHDOG.snapshot()
+    metrics['event_loop_lag_seconds'] = event_loop['lag_ms'] / 1000
+    metrics['event_loop_max_lag_seconds'] = event_loop['max_lag_ms'] / 1000
+    metrics['event_loop_stalls_total'] = event_loop['stalls']
+    metrics['event_loop_blocked_seconds_total'] = event_loop['blocked_seconds']
+    for stall in event_loop['stalls_by_handler']:
+        metrics[f'event_loop_handler_stalls_total{{handler="{stall["handler"]}",state="{stall["state"] or ""}"}}'] = stall['count']
+    for (base_id, table), breaker in list(AIRTABLE_BREAKERS.items()):
+        metrics[f'airtable_breaker_open{{base="{base_id}",table="{table}"}}'] = int(breaker.state != 'closed')
+    for base_id, limiter in list(AIRTABLE_RATE_LIMITERS.items()):
+        metrics[f'airtable_rate_limit_wait_seconds{{base="{base_id}"}}'] = round(limiter.total_wait, 3)
+    for name, current in TENANTS.items():
+        metrics[f'users_loaded{{tenant="{name}"}}'] = len(current.allowed_users)
+        if current.replica:
+            metrics[f'replica_staleness_seconds{{tenant="{name}"}}'] = current.replica.staleness() or 0
+    return metrics
+
+# Тенант апдейта определяется по боту, который его получил
+@dp.update.outer_middleware()
+async def tenant_middleware(handler, event, data):
+    current = TENANTS_BY_BOT_ID.get(data['bot'].id)
+    if current is None:
+        return await handler(event, data)
+    token = CURRENT_TENANT.set(current)
+    try:
+        return await handler(event, data)
+    finally:
+        CURRENT_TENANT.reset(token)
+
+# Спан на весь апдейт: вход в диспетчер и пользователь. Состояние FSM добавляется
+# в контекст трассы при вызове обработчика (см. trace_handler_middleware)
+@dp.update.outer_middleware()
+async def trace_update_middleware(handler, event, data):
+    user = data.get('event_from_user')
+    token = start_trace(
+        f"update-{event.update_id}",
+        update_id=event.update_id,
+        tenant=current_tenant().name,
+        user_id=user.id if user else None,
+        state=None
+    )
+    try:
+        with trace_span('dispatcher', event_type=event.event_type):
+            return await handler(event, data)
+    finally:
+        TRACE_CONTEXT.reset(token)
+
+# Спан на вызов конкретного обработчика. Апдейт уже прошел очередь чата, поэтому здесь
+# читается актуальное состояние FSM (raw_state загружен до очереди и при серии сообщений
+# устаревает); им помечаются этот спан, вложенные и спан диспетчера
+async def trace_handler_middleware(handler, event, data):
+    handler_object = data.get('handler')
+    name = handler_object.callback.__name__ if handler_object else 'unknown'
+    context = TRACE_CONTEXT.get()
+    if context and context['sampled'] and 'state' in data:
+        context['state'] = await data['state'].get_state()
+    with trace_span('handler', handler=name):
+        return await handler(event, data)
+
+dp.message.middleware(trace_handler_middleware)
+dp.callback_query.middleware(trace_handler_middleware)
+
+# Спан на каждый запрос к Telegram Bot API (send_message, reply, edit_text и т.д.)
+async def trace_telegram_request(make_request, bot, method):
+    with trace_span('telegram', method=type(method).__name__):
+        return await make_request(bot, method)
+
+# Апдейты одного чата обрабатываются строго по очереди (гонки на state.get_data()/update_data
+# при двойных нажатиях), разные чаты — параллельно в пределах UPDATE_MAX_CONCURRENCY.
+# Повторное нажатие той же inline-кнопки в течение CALLBACK_DEDUP_WINDOW отбрасывается.
+class UpdateScheduler:
+    def __init__(self, max_concurrency, dedup_window):
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.dedup_window = dedup_window
+        # (bot_id, chat_id) -> [Lock, число апдейтов в очереди и в обработке]
+        self.chats = {}
+        self.recent_callbacks = OrderedDict()
+        self.queued = 0
+        self.in_flight = 0
+        self.max_queue_depth = 0
+        self.max_chat_queue_depth = 0
+        self.processed = 0
+        self.deduplicated = 0
+        self.total_wait = 0.0
+
+    def is_duplicate_callback(self, bot_id, callback_query):
+        now = time.monotonic()
+        while self.recent_callbacks and next(iter(self.recent_callbacks.values())) < now - self.dedup_window:
+            self.recent_callbacks.popitem(last=False)
+        message_id = callback_query.message.message_id if callback_query.message else None
+        key = (bot_id, callback_query.from_user.id, message_id, callback_query.data)
+        if key in self.recent_callbacks:
+            return True
+        self.recent_callbacks[key] = now
+        return False
+
+    async def run(self, chat_key, handler, event, data):
+        entry = self.chats.get(chat_key)
+        if entry is None:
+            entry = self.chats[chat_key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        self.queued += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queued)
+        self.max_chat_queue_depth = max(self.max_chat_queue_depth, entry[1])
+        started = time.perf_counter()
+        try:
+            async with entry[0]:
+                async with self.semaphore:
+                    self.queued -= 1
+                    self.total_wait += time.perf_counter() - started
+                    self.in_flight += 1
+                    try:
+                        return await handler(event, data)
+                    finally:
+                        self.in_flight -= 1
+                        self.processed += 1
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.chats[chat_key]
+
+    def snapshot(self):
+        return {
+            'queued': self.queued,
+            'in_flight': self.in_flight,
+            'active_chats': len(self.chats),
+            'max_queue_depth': self.max_queue_depth,
+            'max_chat_queue_depth': self.max_chat_queue_depth,
+            'processed': self.processed,
+            'deduplicated': self.deduplicated,
+            'avg_wait_ms': round(self.total_wait / self.processed * 1000, 3) if self.processed else 0.0
+        }
+
+# Создается в create_app
+UPDATE_SCHEDULER = None
+
+@dp.update.outer_middleware()
+async def schedule_update_middleware(handler, event, data):
+    bot_id = data['bot'].id
+    if event.callback_query and UPDATE_SCHEDULER.is_duplicate_callback(bot_id, event.callback_query):
+        UPDATE_SCHEDULER.deduplicated += 1
+        logger.debug(f"Duplicate callback dropped: {event.callback_query.data}")
+        await event.callback_query.answer()
+        return None
+    chat = data.get('event_chat')
+    user = data.get('event_from_user')
+    chat_id = chat.id if chat else (user.id if user else None)
+    return await UPDATE_SCHEDULER.run((bot_id, chat_id), handler, event, data)
+
+# Запись входящего апдейта вместе с состоянием FSM на момент обработки. Регистрируется после
+# планировщика: raw_state загружается до очереди чата и при серии сообщений устаревает,
+# а от состояния зависит, какой текст маскируется
+@dp.update.outer_middleware()
+async def capture_update_middleware(handler, event, data):
+    if CAPTURE:
+        try:
+            state = data['state'] if 'state' in data else None
+            CAPTURE.record_update(event, await state.get_state() if state else data.get('raw_state'))
+        except Exception as e:
+            logger.error(f"Ошибка записи трафика: {e}")
+    return await handler(event, data)
+
+# Сторож event loop. Контрольный таймер в цикле раз в interval отмечается и измеряет свою
+# задержку (lag). Отдельный поток замечает, что отметки нет дольше threshold, и снимает стек
+# потока цикла — это код, который его заблокировал. Блокировка приписывается обработчику
+# (ближайший к месту блокировки кадр обработчика из таблиц маршрутизации) и состоянию FSM
+# апдейта, при котором она случилась; вне апдейтов — фоновой задаче. Блокировки, большую часть
+# которых занял сборщик мусора, приписываются gc и не считаются блокировками обработчиков.
+class LoopWatchdog:
+    def __init__(self, interval, threshold, history=20):
+        self.interval = interval
+        self.threshold = threshold
+        self.history = history
+        self.loop = None
+        self.loop_thread_id = None
+        self.heartbeat_task = None
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+        # Задача -> {'update_id', 'state'} для апдейтов в обработке
+        self.updates = {}
+        self.handler_names = frozenset()
+        self.last_beat = 0.0
+        # Время сборок мусора (gc.callbacks вызываются в потоке цикла): начало текущей и сумма
+        self.gc_started = None
+        self.gc_seconds = 0.0
+        self.gc_seconds_at_beat = 0.0
+        # Блокировка, стек которой снят, но которая еще не закончилась
+        self.pending = None
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.beats = 0
+            self.last_lag = 0.0
+            self.max_lag = 0.0
+            self.total_lag = 0.0
+            self.stalls_total = 0
+            # Блокировки во время обработки апдейтов (остальные — фоновые задачи)
+            self.update_stalls = 0
+            self.blocked_seconds = 0.0
+            # (обработчик, состояние) -> число блокировок
+            self.stall_counts = Counter()
+            self.stalls = deque(maxlen=self.history)
+
+    def start(self, handler_names=()):
+        if self.threshold <= 0 or self.heartbeat_task is not None:
+            return
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.handler_names = frozenset(handler_names)
+        self.last_beat = time.monotonic()
+        self.stop_event.clear()
+        gc.callbacks.append(self._on_gc)
+        self.heartbeat_task = asyncio.create_task(self._heartbeat())
+        self.thread = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.heartbeat_task is None:
+            return
+        self.stop_event.set()
+        gc.callbacks.remove(self._on_gc)
+        self.heartbeat_task.cancel()
+        self.heartbeat_task = None
+        self.thread.join()
+        self.thread = None
+
+    def _on_gc(self, phase, info):
+        if phase == 'start':
+            self.gc_started = time.perf_counter()
+        elif self.gc_started is not None:
+            self.gc_seconds += time.perf_counter() - self.gc_started
+            self.gc_started = None
+
+    # Апдейт в обработке текущей задачей: к нему относятся блокировки, пока он не завершится
+    @contextmanager
+    def watch_update(self, update_id, state):
+        task = asyncio.current_task()
+        self.updates[task] = {'update_id': update_id, 'state': state}
+        try:
+            yield
+        finally:
+            self.updates.pop(task, None)
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - self.last_beat - self.interval)
+            gc_seconds = self.gc_seconds - self.gc_seconds_at_beat
+            self.gc_seconds_at_beat = self.gc_seconds
+            with self.lock:
+                self.last_beat = now
+                self.beats += 1
+                self.last_lag = lag
+                self.max_lag = max(self.max_lag, lag)
+                self.total_lag += lag
+                stall, self.pending = self.pending, None
+                if stall is None and lag >= self.threshold:
+                    # Поток-сторож не успел снять стек (короткая блокировка)
+                    stall = {'handler': 'unknown', 'state': None, 'update_id': None, 'stack': []}
+                if stall is not None:
+                    stall['duration_ms'] = round(lag * 1000, 1)
+                    if gc_seconds * 2 >= lag:
+                        stall['handler'] = 'gc'
+                    self.stalls_total += 1
+                    if stall['update_id'] is not None and stall['handler'] != 'gc':
+                        self.update_stalls += 1
+                    self.blocked_seconds += lag
+                    self.stall_counts[(stall['handler'], stall['state'])] += 1
+                    self.stalls.append(stall)
+            if stall is not None:
+                location = stall['stack'][-1] if stall['stack'] else '?'
+                logger.warning(
+                    f"Event loop заблокирован на {stall['duration_ms']} мс: обработчик {stall['handler']}, "
+                    f"состояние {stall['state']}, место {location}"
+                )
+
+    def _watch(self):
+        poll = min(self.interval, self.threshold) / 2
+        while not self.stop_event.wait(poll):
+            with self.lock:
+                if self.pending is not None or time.monotonic() - self.last_beat - self.interval < self.threshold:
+                    continue
+            stall = self._capture()
+            with self.lock:
+                self.pending = stall
+
+    # Стек потока цикла и то, чему приписать блокировку
+    def _capture(self):
+        frame = sys._current_frames().get(self.loop_thread_id)
+        stack = []
+        handler = None
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+            if handler is None and code.co_name in self.handler_names:
+                handler = code.co_name
+            frame = frame.f_back
+        stack.reverse()
+        task = asyncio.current_task(self.loop)
+        update = self.updates.get(task, {})
+        if handler is None:
+            handler = task.get_coro().__qualname__ if task else 'callback'
+        return {
+            'at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'handler': handler,
+            'state': update.get('state'),
+            'update_id': update.get('update_id'),
+            'stack': stack[-30:]
+        }
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'lag_ms': round(self.last_lag * 1000, 1),
+                'max_lag_ms': round(self.max_lag * 1000, 1),
+                'avg_lag_ms': round(self.total_lag / self.beats * 1000, 3) if self.beats else 0.0,
+                'stalls': self.stalls_total,
+                'update_stalls': self.update_stalls,
+                'blocked_seconds': round(self.blocked_seconds, 3),
+                'stalls_by_handler': [
+                    {'handler': handler, 'state': state, 'count': count}
+                    for (handler, state), count in self.stall_counts.most_common()
+                ],
+                'recent_stalls': list(self.stalls)
+            }
+
+# Создается в create_app
+LOOP_WATCHDOG = None
+
+# Регистрируется после планировщика: состояние FSM читается, когда апдейт дошел до обработки
+# (raw_state загружается до очереди чата и при серии сообщений устаревает)
+@dp.update.outer_middleware()
+async def watchdog_update_middleware(handler, event, data):
+    state = data['state'] if 'state' in data else None
+    with LOOP_WATCHDOG.watch_update(event.update_id, await state.get_state() if state else data.get('raw_state')):
+        return await handler(event, data)
+
+# Загрузка пользователей из Airtable
+def fetch_users():
+    allowed_users = {}
+    for users in iter_airtable_records('Пользователи'):
         for user in users:
             fields = user.get('fields', {})
             telegram_id = fields.get('Telegram_ID')
@@ -77,65 +1286,866 @@ def load_users():
             department = fields.get('Отдел', 'Без отдела')
             if telegram_id and record_id:
                 allowed_users[str(telegram_id)] = {'record_id': record_id, 'department': department}
+    return allowed_users
+
+def load_users():
+    try:
+        allowed_users = fetch_users()
         logger.info(f"Загружено {len(allowed_users)} пользователей.")
         return allowed_users
     except Exception as e:
         logger.error(f"Ошибка загрузки пользователей: {e}")
         return {}
 
+# Фоновое обновление списка пользователей; при ошибке остаются последние загруженные
+async def refresh_users_loop():
+    while True:
+        await asyncio.sleep(tenant.settings.USERS_REFRESH_INTERVAL)
+        try:
+            allowed_users = await asyncio.to_thread(fetch_users)
+        except Exception as e:
+            logger.warning(f"Не удалось обновить пользователей, используется последний список: {e}")
+            continue
+        tenant.allowed_users = allowed_users
+        tenant.record_id_to_telegram_id = {data['record_id']: telegram_id for telegram_id, data in allowed_users.items()}
+        logger.debug(f"Обновлено {len(allowed_users)} пользователей")
+
 # Поиск товаров в Airtable с фильтром по остатку и отделу
 def search_products(query, department):
-    try:
-        headers = {'Authorization': f'Bearer {AIRTABLE_API_KEY}'}
-        url = f'https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/Товары'
-        if department == 'Администратор':
-            filter_formula = f"AND(SEARCH(LOWER('{query}'), LOWER({{Название}})), {{Текущий остаток}} >= 1)"
-        else:
-            filter_formula = f"AND(SEARCH(LOWER('{query}'), LOWER({{Название}})), {{Текущий остаток}} >= 1, OR({{Отдел}} = '{department}', {{Отдел}} = 'Общее'))"
+    def load():
+        # Остаток — то же поле, по которому сверяет StockLedger
+        conditions = [
+            f"SEARCH(LOWER('{escape_formula_value(query)}'), LOWER({{Название}}))",
+            f"{{{tenant.settings.STOCK_FIELD}}} >= 1"
+        ]
+        if department != 'Администратор':
+            conditions.append(f"OR({{Отдел}} = '{escape_formula_value(department)}', {{Отдел}} = 'Общее')")
+        filter_formula = f"AND({', '.join(conditions)})"
         params = {'filterByFormula': filter_formula}
-        response = requests.get(url, headers=headers, params=params)
+        started = time.time()
+        response = airtable_request('GET', 'Товары', params=params)
         response.raise_for_status()
-        return response.json().get('records', [])
+        records = response.json().get('records', [])
+        tenant.stock_ledger.observe(records, started)
+        return records
+
+    try:
+        return tenant.catalog_search_cache.get((query.lower(), department), load)
     except Exception as e:
         logger.error(f"Ошибка поиска товаров: {e}")
         return []
 
 # Получение товара по ID
 def get_product_by_id(product_id):
-    try:
-        headers = {'Authorization': f'Bearer {AIRTABLE_API_KEY}'}
-        url = f'https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/Товары/{product_id}'
-        response = requests.get(url, headers=headers)
+    def load():
+        started = time.time()
+        response = airtable_request('GET', f'Товары/{product_id}')
         response.raise_for_status()
-        return response.json()
+        product = response.json()
+        tenant.stock_ledger.observe([product], started)
+        return product
+
+    try:
+        return tenant.product_cache.get(product_id, load)
     except Exception as e:
         logger.error(f"Ошибка получения товара: {e}")
         return None
 
+# Остатки товаров и резервы незавершенных заявок. Доступно = остаток из последнего ответа
+# Airtable - заявки, оформленные после этого ответа, - активные резервы других пользователей.
+# Остаток обновляется при каждой загрузке каталога (поиск, товар по ID), поэтому проверки
+# при вводе количества и сохранении заявки не делают запросов к Airtable.
+class StockLedger:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        # product_id -> (остаток, когда запрошен)
+        self.stock = {}
+        # product_id -> [(количество, когда оформлено)], еще не отраженные в остатке
+        self.committed = {}
+        # product_id -> {пользователь: (количество, когда истекает)}
+        self.reservations = {}
+        self.lock = threading.Lock()
+
+    # Остатки из ответа Airtable; заявки, оформленные до запроса, в них уже учтены
+    def observe(self, products, requested_at):
+        with self.lock:
+            for product in products:
+                stock = product.get('fields', {}).get(tenant.settings.STOCK_FIELD)
+                if not isinstance(stock, (int, float)):
+                    continue
+                product_id = product['id']
+                previous = self.stock.get(product_id)
+                if previous and previous[1] > requested_at:
+                    continue
+                self.stock[product_id] = (stock, requested_at)
+                pending = [entry for entry in self.committed.get(product_id, []) if entry[1] >= requested_at]
+                if pending:
+                    self.committed[product_id] = pending
+                else:
+                    self.committed.pop(product_id, None)
+
+    def _expire(self, now):
+        for product_id in list(self.reservations):
+            holders = self.reservations[product_id]
+            for user_id in [user_id for user_id, (_, expires) in holders.items() if expires <= now]:
+                del holders[user_id]
+            if not holders:
+                del self.reservations[product_id]
+
+    def _release(self, user_id):
+        for product_id in list(self.reservations):
+            holders = self.reservations[product_id]
+            holders.pop(user_id, None)
+            if not holders:
+                del self.reservations[product_id]
+
+    # Доступное пользователю количество или None, если остаток товара неизвестен
+    def _available(self, product_id, user_id):
+        entry = self.stock.get(product_id)
+        if entry is None:
+            return None
+        stock, _ = entry
+        committed = sum(quantity for quantity, _ in self.committed.get(product_id, []))
+        reserved = sum(
+            quantity for holder, (quantity, _) in self.reservations.get(product_id, {}).items() if holder != user_id
+        )
+        return max(0, stock - committed - reserved)
+
+    # Проверка и резерв количеств {product_id: количество}. Резерв пользователя заменяется
+    # целиком и продлевается; при нехватке ничего не резервируется и возвращается
+    # список (product_id, доступно)
+    def reserve(self, user_id, demand):
+        now = time.time()
+        with self.lock:
+            self._expire(now)
+            shortages = []
+            for product_id, quantity in demand.items():
+                available = self._available(product_id, user_id)
+                if available is not None and quantity > available:
+                    shortages.append((product_id, available))
+            if shortages:
+                return shortages
+            self._release(user_id)
+            for product_id, quantity in demand.items():
+                self.reservations.setdefault(product_id, {})[user_id] = (quantity, now + self.ttl)
+            return []
+
+    # Заявка оформлена: резерв переходит в списание до следующей загрузки остатка
+    def commit(self, user_id, demand):
+        now = time.time()
+        with self.lock:
+            self._release(user_id)
+            for product_id, quantity in demand.items():
+                if product_id in self.stock:
+                    self.committed.setdefault(product_id, []).append((quantity, now))
+
+    def release(self, user_id):
+        with self.lock:
+            self._release(user_id)
+
+    def snapshot(self):
+        with self.lock:
+            self._expire(time.time())
+            return {
+                'products_tracked': len(self.stock),
+                'reservations': sum(len(holders) for holders in self.reservations.values()),
+                'reserved_units': sum(
+                    quantity for holders in self.reservations.values() for quantity, _ in holders.values()
+                ),
+                'pending_commits': sum(len(entries) for entries in self.committed.values())
+            }
+
+# Количества по товарам: один товар может быть выбран несколько раз с разными размерами
+def get_stock_demand(selected_products, quantities):
+    demand = {}
+    for product, quantity in zip(selected_products, quantities):
+        demand[product['id']] = demand.get(product['id'], 0) + quantity
+    return demand
+
+def format_stock_shortages(shortages, selected_products):
+    names = {product['id']: product['name'] for product in selected_products}
+    lines = [f"• {names.get(product_id, product_id)}: доступно {available} шт." for product_id, available in shortages]
+    return "❌ Недостаточно товара на складе:\n" + "\n".join(lines)
+
+# Реестр file_id Telegram для фото из вложений Airtable: ключ — ID вложения и его версия.
+# Хранится в JSONL: новые записи дописываются в конец, при загрузке действует последняя.
+class PhotoFileIdCache:
+    def __init__(self, path):
+        self.path = path
+        self.file_ids = None
+        self.lock = threading.Lock()
+
+    def _load(self):
+        file_ids = {}
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    entry = json.loads(line)
+                    if entry.get('file_id'):
+                        file_ids[entry['key']] = entry['file_id']
+                    else:
+                        file_ids.pop(entry['key'], None)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.error(f"Ошибка чтения реестра file_id: {e}")
+        return file_ids
+
+    def _append(self, entry):
+        try:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        except OSError as e:
+            logger.error(f"Ошибка записи реестра file_id: {e}")
+
+    def get(self, key):
+        with self.lock:
+            if self.file_ids is None:
+                self.file_ids = self._load()
+            return self.file_ids.get(key)
+
+    def set(self, key, file_id):
+        with self.lock:
+            if self.file_ids is None:
+                self.file_ids = self._load()
+            self.file_ids[key] = file_id
+            self._append({'key': key, 'file_id': file_id})
+
+    def discard(self, key):
+        with self.lock:
+            if self.file_ids and self.file_ids.pop(key, None):
+                self._append({'key': key, 'file_id': None})
+
+# Первое изображение товара: (ключ реестра, URL для первой загрузки) или None.
+# Версия вложения — по имени файла и размеру: замена файла дает новый ключ.
+def get_product_photo(product):
+    attachments = product['fields'].get(tenant.settings.PRODUCT_PHOTO_FIELD) or []
+    attachment = next(
+        (item for item in attachments if str(item.get('type', 'image/')).startswith('image/') and item.get('id')), None
+    )
+    if not attachment:
+        return None
+    version = hashlib.sha1(f"{attachment.get('filename')}:{attachment.get('size')}".encode()).hexdigest()[:12]
+    source = attachment.get('thumbnails', {}).get('large', {}).get('url') or attachment.get('url')
+    return f"{attachment['id']}:{version}", source
+
+# Фото товаров альбомами по 10; уже загруженные отправляются по file_id
+async def send_product_photos(message, products):
+    photos = []
+    for product in products[:tenant.settings.PRODUCT_PHOTO_LIMIT]:
+        photo = get_product_photo(product)
+        if photo:
+            photos.append((*photo, product['fields'].get('Название', 'Без названия')))
+    registry = tenant.photo_file_ids
+    for i in range(0, len(photos), 10):
+        chunk = [(key, registry.get(key), url, name) for key, url, name in photos[i:i + 10]]
+        try:
+            if len(chunk) == 1:
+                key, file_id, url, name = chunk[0]
+                sent = [await message.answer_photo(photo=file_id or url, caption=name)]
+            else:
+                sent = await message.answer_media_group(
+                    [InputMediaPhoto(media=file_id or url, caption=name) for key, file_id, url, name in chunk]
+                )
+        except Exception as e:
+            logger.warning(f"Не удалось отправить фото товаров: {e}")
+            # Устаревший file_id не должен ломать следующие показы
+            for key, file_id, _, _ in chunk:
+                if file_id:
+                    registry.discard(key)
+            continue
+        for (key, file_id, _, _), sent_message in zip(chunk, sent):
+            if not file_id and sent_message.photo:
+                registry.set(key, sent_message.photo[-1].file_id)
+
+# Постраничное чтение всех записей таблицы (по 100 записей за запрос)
+def iter_airtable_records(table, params=None):
+    params = dict(params or {})
+    params['pageSize'] = 100
+    while True:
+        response = airtable_request('GET', table, params=params)
+        response.raise_for_status()
+        data = response.json()
+        yield data.get('records', [])
+        offset = data.get('offset')
+        if not offset:
+            break
+        params['offset'] = offset
+
+# Пакетное получение названий товаров одним запросом на до 50 ID
+def fetch_product_names(product_ids):
+    missing = [product_id for product_id in dict.fromkeys(product_ids) if product_id not in tenant.product_name_cache]
+    for i in range(0, len(missing), 50):
+        chunk = missing[i:i + 50]
+        formula = "OR(" + ",".join(f"RECORD_ID() = '{product_id}'" for product_id in chunk) + ")"
+        try:
+            for records in iter_airtable_records('Товары', {'filterByFormula': formula, 'fields[]': 'Название'}):
+                for record in records:
+                    tenant.product_name_cache[record['id']] = record['fields'].get('Название', record['id'])
+        except Exception as e:
+            logger.error(f"Ошибка пакетного получения товаров: {e}")
+    return {product_id: tenant.product_name_cache.get(product_id, product_id) for product_id in product_ids}
+
+# Локальная SQLite-реплика таблиц Заявки, Кастомные_заказы и Пользователи.
+# Синхронизация инкрементальная по LAST_MODIFIED_TIME(), раз в REPLICA_FULL_SYNC_EVERY
+# синхронизаций выполняется полная сверка для обнаружения удаленных записей.
+class AirtableReplica:
+    REQUEST_TABLES = ['Заявки', 'Кастомные_заказы']
+    USERS_TABLE = 'Пользователи'
+    # Запас на расхождение часов и задержку индексации Airtable
+    WATERMARK_OVERLAP = timedelta(seconds=60)
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            self.conn.executescript('''
+                CREATE TABLE IF NOT EXISTS requests (
+                    record_id TEXT PRIMARY KEY,
+                    table_name TEXT NOT NULL,
+                    request_number TEXT,
+                    status TEXT,
+                    tracking_number TEXT,
+                    user_record_id TEXT,
+                    created_time TEXT,
+                    fields TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_requests_user ON requests (user_record_id);
+                CREATE INDEX IF NOT EXISTS idx_requests_status ON requests (status);
+                CREATE INDEX IF NOT EXISTS idx_requests_number ON requests (request_number);
+                CREATE TABLE IF NOT EXISTS users (
+                    record_id TEXT PRIMARY KEY,
+                    telegram_id TEXT,
+                    department TEXT,
+                    fields TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_users_telegram ON users (telegram_id);
+                CREATE TABLE IF NOT EXISTS sync_state (
+                    table_name TEXT PRIMARY KEY,
+                    watermark TEXT
+                );
+            ''')
+        self.synced_at = None
+        self.sync_count = 0
+
+    def _get_watermark(self, table):
+        row = self.conn.execute('SELECT watermark FROM sync_state WHERE table_name = ?', (table,)).fetchone()
+        return row[0] if row else None
+
+    def _upsert(self, table, record):
+        fields = record['fields']
+        fields_json = json.dumps(fields, ensure_ascii=False, sort_keys=True)
+        if table == self.USERS_TABLE:
+            row = self.conn.execute('SELECT fields FROM users WHERE record_id = ?', (record['id'],)).fetchone()
+            if row and row[0] == fields_json:
+                return False
+            telegram_id = fields.get('Telegram_ID')
+            self.conn.execute(
+                'INSERT OR REPLACE INTO users (record_id, telegram_id, department, fields) VALUES (?, ?, ?, ?)',
+                (record['id'], str(telegram_id) if telegram_id else None, fields.get('Отдел', 'Без отдела'), fields_json)
+            )
+            return True
+        row = self.conn.execute('SELECT fields FROM requests WHERE record_id = ?', (record['id'],)).fetchone()
+        if row and row[0] == fields_json:
+            return False
+        request_number = fields.get('Номер_заявки')
+        self.conn.execute(
+            'INSERT OR REPLACE INTO requests (record_id, table_name, request_number, status, tracking_number, '
+            'user_record_id, created_time, fields) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (
+                record['id'], table,
+                str(request_number) if request_number is not None else None,
+                fields.get('Статус', 'Неизвестно'),
+                fields.get('Трек-номер'),
+                fields.get('Пользователь', [None])[0],
+                record.get('createdTime'),
+                fields_json
+            )
+        )
+        return True
+
+    def _sync_table(self, table, full):
+        started = datetime.now(timezone.utc)
+        watermark = None if full else self._get_watermark(table)
+        params = {}
+        if watermark:
+            params['filterByFormula'] = f"IS_AFTER(LAST_MODIFIED_TIME(), '{watermark}')"
+        changed = []
+        seen = set()
+        for records in iter_airtable_records(table, params):
+            with self.lock, self.conn:
+                for record in records:
+                    seen.add(record['id'])
+                    if self._upsert(table, record):
+                        changed.append(record)
+        deleted = []
+        with self.lock, self.conn:
+            if not watermark:
+                if table == self.USERS_TABLE:
+                    existing = self.conn.execute('SELECT record_id FROM users').fetchall()
+                else:
+                    existing = self.conn.execute(
+                        'SELECT record_id FROM requests WHERE table_name = ?', (table,)
+                    ).fetchall()
+                deleted = [row[0] for row in existing if row[0] not in seen]
+                sql_table = 'users' if table == self.USERS_TABLE else 'requests'
+                self.conn.executemany(f'DELETE FROM {sql_table} WHERE record_id = ?', [(rid,) for rid in deleted])
+            new_watermark = (started - self.WATERMARK_OVERLAP).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+            self.conn.execute(
+                'INSERT OR REPLACE INTO sync_state (table_name, watermark) VALUES (?, ?)', (table, new_watermark)
+            )
+        logger.debug(f"Replica sync {table}: full={not watermark}, changed={len(changed)}, deleted={len(deleted)}")
+        return changed, deleted
+
+    # Синхронизация всех таблиц; возвращает измененные и удаленные заявки
+    def sync(self):
+        full = self.sync_count % tenant.settings.REPLICA_FULL_SYNC_EVERY == 0
+        self._sync_table(self.USERS_TABLE, full)
+        changed, deleted = [], []
+        for table in self.REQUEST_TABLES:
+            table_changed, table_deleted = self._sync_table(table, full)
+            changed.extend(table_changed)
+            deleted.extend(table_deleted)
+        self.sync_count += 1
+        self.synced_at = time.time()
+        return changed, deleted
+
+    # Применение записей, полученных вне синхронизации (вебхук Airtable)
+    def apply(self, table_records, deleted_ids=()):
+        with self.lock, self.conn:
+            for table, record in table_records:
+                self._upsert(table, record)
+            self.conn.executemany('DELETE FROM requests WHERE record_id = ?', [(rid,) for rid in deleted_ids])
+
+    def staleness(self):
+        if self.synced_at is None:
+            return None
+        return time.time() - self.synced_at
+
+    def is_fresh(self):
+        staleness = self.staleness()
+        return staleness is not None and staleness <= tenant.settings.REPLICA_MAX_STALENESS
+
+    def iter_requests(self):
+        with self.lock:
+            rows = self.conn.execute('SELECT record_id, fields, created_time FROM requests').fetchall()
+        for record_id, fields_json, created_time in rows:
+            yield record_id, json.loads(fields_json), created_time
+
+    def requests_for_user(self, user_record_id):
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT fields FROM requests WHERE user_record_id = ? ORDER BY created_time', (user_record_id,)
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def find_request(self, request_number):
+        with self.lock:
+            return self.conn.execute(
+                'SELECT record_id, table_name FROM requests WHERE request_number = ?', (str(request_number),)
+            ).fetchone()
+
+    def telegram_id_for_user(self, user_record_id):
+        with self.lock:
+            row = self.conn.execute('SELECT telegram_id FROM users WHERE record_id = ?', (user_record_id,)).fetchone()
+        return row[0] if row else None
+
 # Проверка доступа
 def check_access(user_id, require_admin=False):
     user_id_str = str(user_id)
-    if user_id_str not in ALLOWED_USERS:
+    if user_id_str not in tenant.allowed_users:
         return False
-    if require_admin and ALLOWED_USERS[user_id_str]['department'] != 'Администратор':
+    if require_admin and tenant.allowed_users[user_id_str]['department'] != 'Администратор':
         return False
     return True
 
+# Отдел пользователя по record_id из таблицы Пользователи
+def get_department_by_user_record(user_record_id):
+    telegram_id = tenant.record_id_to_telegram_id.get(user_record_id)
+    return tenant.allowed_users.get(telegram_id, {}).get('department', 'Без отдела')
+
+# Учет заявки в агрегатах /stats
+def update_request_stats(record_id, fields, created_time=None):
+    status = fields.get('Статус', 'Неизвестно')
+    user_record_id = fields.get('Пользователь', [None])[0]
+    created = fields.get('Дата_создания') or created_time or ''
+    since = None
+    if status in tenant.settings.PENDING_STATUSES and created_time:
+        # Ожидающие заявки находятся в статусе с момента создания
+        since = datetime.fromisoformat(created_time.replace('Z', '+00:00')).timestamp()
+    tenant.request_stats.upsert(
+        record_id,
+        status,
+        get_department_by_user_record(user_record_id),
+        fields.get('Способ_отправки', 'Не указано'),
+        created[:10] or 'Неизвестно',
+        since=since
+    )
+
+# Столбцы CSV-выгрузки заявок
+EXPORT_COLUMNS = [
+    'Таблица', 'Номер_заявки', 'Дата_создания', 'Статус', 'Отдел', 'Товар', 'Количество', 'Размер',
+    'Название_кастома', 'ФИО', 'Номер_телефона', 'Адрес', 'Индекс', 'Способ_отправки', 'Трек-номер', 'Общая_сумма'
+]
+
+# Экранирование строки для формул Airtable
+def escape_formula_value(value):
+    return value.replace("\\", "\\\\").replace("'", "\\'")
+
+# Формула фильтра выгрузки по статусу и диапазону дат
+def build_export_formula(filters):
+    conditions = []
+    if filters.get('status'):
+        conditions.append(f"{{Статус}} = '{escape_formula_value(filters['status'])}'")
+    if filters.get('from'):
+        conditions.append(f"NOT(IS_BEFORE({{Дата_создания}}, '{filters['from']}'))")
+    if filters.get('to'):
+        conditions.append(f"NOT(IS_AFTER({{Дата_создания}}, '{filters['to']}'))")
+    if not conditions:
+        return None
+    return conditions[0] if len(conditions) == 1 else f"AND({', '.join(conditions)})"
+
+# Потоковая запись заявок в CSV: в памяти держится только текущая страница
+def export_requests_csv(filters, csv_file):
+    writer = csv.writer(csv_file, delimiter=';')
+    writer.writerow(EXPORT_COLUMNS)
+    formula = build_export_formula(filters)
+    params = {'filterByFormula': formula} if formula else {}
+    department_filter = filters.get('department')
+    exported = 0
+    for table in ['Заявки', 'Кастомные_заказы']:
+        for records in iter_airtable_records(table, params):
+            product_ids = [product_id for record in records for product_id in record['fields'].get('Товар', [])]
+            product_names = fetch_product_names(product_ids) if product_ids else {}
+            for record in records:
+                fields = record['fields']
+                department = get_department_by_user_record(fields.get('Пользователь', [None])[0])
+                if department_filter and department != department_filter:
+                    continue
+                writer.writerow([
+                    table,
+                    fields.get('Номер_заявки', ''),
+                    fields.get('Дата_создания', record.get('createdTime', '')),
+                    fields.get('Статус', ''),
+                    department,
+                    ", ".join(product_names[product_id] for product_id in fields.get('Товар', [])),
+                    fields.get('Количество', ''),
+                    fields.get('Размер', ''),
+                    fields.get('Название_кастома', ''),
+                    fields.get('ФИО', ''),
+                    fields.get('Номер_телефона', ''),
+                    fields.get('Адрес', ''),
+                    fields.get('Индекс', ''),
+                    fields.get('Способ_отправки', ''),
+                    fields.get('Трек-номер', ''),
+                    fields.get('Общая_сумма', '')
+                ])
+                exported += 1
+    return exported
+
+# Разбор аргументов /export: status="В обработке" from=2024-01-01 to=2024-01-31 department=Маркетинг
+def parse_export_filters(args):
+    aliases = {'status': 'status', 'статус': 'status', 'from': 'from', 'с': 'from', 'to': 'to', 'по': 'to',
+               'department': 'department', 'отдел': 'department'}
+    filters = {}
+    for token in shlex.split(args or ''):
+        key, sep, value = token.partition('=')
+        key = aliases.get(key.lower())
+        if not sep or not key or not value:
+            raise ValueError(f"Неизвестный параметр: {token}")
+        if key in ('from', 'to'):
+            datetime.strptime(value, '%Y-%m-%d')
+        filters[key] = value
+    return filters
+
+# Массовое обновление заявок из CSV (/bulk_update): номер заявки; статус; трек-номер
+BULK_UPDATE_BATCH_SIZE = 10
+BULK_UPDATE_COLUMNS = {
+    'номер_заявки': 'number', 'номер': 'number', 'number': 'number',
+    'статус': 'status', 'status': 'status',
+    'трек-номер': 'tracking', 'трек_номер': 'tracking', 'tracking': 'tracking'
+}
+
+# Построчное чтение CSV: заголовок необязателен, без него колонки идут по порядку
+def iter_bulk_update_rows(csv_file):
+    first_line = csv_file.readline()
+    delimiter = ';' if first_line.count(';') >= first_line.count(',') else ','
+    csv_file.seek(0)
+    reader = csv.reader(csv_file, delimiter=delimiter)
+    positions = {'number': 0, 'status': 1, 'tracking': 2}
+    for row in reader:
+        if not any(cell.strip() for cell in row):
+            continue
+        if reader.line_num == 1:
+            header = [BULK_UPDATE_COLUMNS.get(cell.strip().lower().replace(' ', '_')) for cell in row]
+            if 'number' in header:
+                positions = {name: header.index(name) for name in positions if name in header}
+                continue
+        values = {name: row[index].strip() if index < len(row) else '' for name, index in positions.items()}
+        yield reader.line_num, values.get('number', ''), values.get('status', ''), values.get('tracking', '')
+
+# Индекс номер заявки -> (record_id, таблица, статус, трек-номер) одним постраничным проходом
+def build_request_number_index():
+    index = {}
+    params = {'fields[]': ['Номер_заявки', 'Статус', 'Трек-номер']}
+    for table in ['Заявки', 'Кастомные_заказы']:
+        for records in iter_airtable_records(table, params):
+            for record in records:
+                fields = record['fields']
+                if 'Номер_заявки' in fields:
+                    index[str(fields['Номер_заявки'])] = (
+                        record['id'], table, fields.get('Статус', 'Неизвестно'), fields.get('Трек-номер')
+                    )
+    return index
+
+# PATCH до 10 записей; при отказе Airtable в валидации (422) записи повторяются по одной,
+# чтобы одна ошибочная строка не отменяла всю пачку
+def patch_request_batch(table, batch, summary, updated_records):
+    try:
+        response = airtable_request('PATCH', table, json={'records': [item for _, _, item in batch]})
+    except requests.exceptions.RequestException as e:
+        for line_num, number, _ in batch:
+            add_bulk_update_error(summary, line_num, number, f"Airtable недоступен: {e}")
+        return
+    if response.ok:
+        records = response.json().get('records', [])
+        summary['applied'] += len(records)
+        updated_records.extend(records)
+    elif response.status_code == 422 and len(batch) > 1:
+        for item in batch:
+            patch_request_batch(table, [item], summary, updated_records)
+    else:
+        for line_num, number, _ in batch:
+            add_bulk_update_error(summary, line_num, number, f"HTTP {response.status_code}")
+
+def add_bulk_update_error(summary, line_num, number, reason):
+    summary['failed'] += 1
+    if len(summary['errors']) < 20:
+        summary['errors'].append(f"строка {line_num} (№{number or '-'}): {reason}")
+
+def bulk_update_requests(csv_file):
+    summary = {'applied': 0, 'skipped': 0, 'failed': 0, 'errors': []}
+    updated_records = []
+    # Прежнее состояние заявок, которых еще нет в хранилище: record_id -> (статус, трек-номер).
+    # Хранилище меняется только в event loop под request_changes_lock, здесь — только чтение
+    seeds = {}
+    index = None if tenant.replica else build_request_number_index()
+    batches = {}
+    for line_num, number, status, tracking in iter_bulk_update_rows(csv_file):
+        if not number:
+            add_bulk_update_error(summary, line_num, number, "не указан номер заявки")
+            continue
+        found = tenant.replica.find_request(number) if tenant.replica else index.get(number)
+        if not found:
+            add_bulk_update_error(summary, line_num, number, "заявка не найдена")
+            continue
+        record_id, table = found[0], found[1]
+        statuses = tenant.request_statuses
+        current = statuses.get(record_id)
+        if current is not None:
+            known_status, known_tracking = statuses.status_of(current), statuses.tracking_of(current)
+        elif not tenant.replica:
+            # Прежнее состояние нужно детектору изменений, чтобы уведомить пользователя
+            seeds[record_id] = (found[2], found[3])
+            known_status, known_tracking = found[2], statuses.tracking_hash(found[3])
+        else:
+            known_status = known_tracking = None
+        fields = {}
+        if status and status != known_status:
+            fields['Статус'] = status
+        if tracking and statuses.tracking_hash(tracking) != known_tracking:
+            fields['Трек-номер'] = tracking
+        if not fields:
+            summary['skipped'] += 1
+            continue
+        batch = batches.setdefault(table, [])
+        batch.append((line_num, number, {'id': record_id, 'fields': fields}))
+        if len(batch) == BULK_UPDATE_BATCH_SIZE:
+            patch_request_batch(table, batch, summary, updated_records)
+            batches[table] = []
+    for table, batch in batches.items():
+        if batch:
+            patch_request_batch(table, batch, summary, updated_records)
+    return summary, updated_records, seeds
+
+# Форматирование длительности для /stats
+def format_duration(seconds):
+    if seconds is None:
+        return '-'
+    minutes = int(seconds // 60)
+    if minutes < 60:
+        return f"{minutes} мин"
+    hours = minutes // 60
+    if hours < 48:
+        return f"{hours} ч {minutes % 60} мин"
+    return f"{hours // 24} дн {hours % 24} ч"
+
+# Форматирование заявки для /history
+def format_history_entry(fields, product_info):
+    order_type = '📦 Заявка' if 'Товар' in fields else '🎨 Кастом'
+    return (
+        f"**{order_type}**\n"
+        f"**Номер заявки**: {fields.get('Номер_заявки', '-')}\n"
+        f"**Товар**: {product_info}\n"
+        f"**Количество**: {fields.get('Количество', '-')}\n"
+        f"**Сумма**: {fields.get('Общая_сумма', 0)} руб.\n"
+        f"**Статус**: {fields.get('Статус', '-')}\n"
+        f"**Дата**: {fields.get('Дата_создания', '-')}\n"
+        "--------------------"
+    )
+
+# Разбиение длинного текста на части по строкам (лимит Telegram ~4096 символов)
+def split_message(text, max_length=MAX_MESSAGE_LENGTH):
+    if len(text) <= max_length:
+        return [text]
+    parts = []
+    current_part = ""
+    for line in text.split("\n"):
+        if len(current_part) + len(line) + 1 > max_length:
+            parts.append(current_part)
+            current_part = line
+        else:
+            if current_part:
+                current_part += "\n" + line
+            else:
+                current_part = line
+    if current_part:
+        parts.append(current_part)
+    return parts
+
+# Признак срочной заявки: ключевое слово в названии кастома или способе доставки
+def is_urgent_request(user_data):
+    text = " ".join([
+        user_data.get('custom_name', ''),
+        user_data.get('delivery_method', '')
+    ]).lower()
+    return any(keyword in text for keyword in tenant.settings.TEAMLEAD_URGENT_KEYWORDS)
+
+# Загрузка неотправленных элементов дайджеста после перезапуска
+def load_teamlead_digest_spool():
+    if not os.path.exists(tenant.digest_spool):
+        return
+    try:
+        with open(tenant.digest_spool, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    tenant.digest_buffer.append(json.loads(line))
+        logger.info(f"Восстановлено {len(tenant.digest_buffer)} заявок для дайджеста тимлида.")
+    except Exception as e:
+        logger.error(f"Ошибка чтения файла дайджеста: {e}")
+
+# Перезапись файла дайджеста текущим содержимым буфера
+def write_teamlead_digest_spool():
+    try:
+        with open(tenant.digest_spool, 'w', encoding='utf-8') as f:
+            for item in tenant.digest_buffer:
+                f.write(json.dumps(item, ensure_ascii=False) + "\n")
+    except Exception as e:
+        logger.error(f"Ошибка записи файла дайджеста: {e}")
+
+# Формирование текста дайджеста с группировкой по типу и отделу
+def format_teamlead_digest(items):
+    groups = {}
+    for item in items:
+        key = (item['request_type'], item['department'])
+        groups.setdefault(key, []).append(item)
+    lines = [f"📋 Новые заявки за период: {len(items)}"]
+    for (request_type, department), group in sorted(groups.items()):
+        lines.append("")
+        lines.append(f"{request_type} — {department}: {len(group)}")
+        for item in group:
+            lines.append(f"• {item['request_number']} от {item['user_id']}")
+    return "\n".join(lines)
+
+# Разбиение дайджеста на сообщения по целым заявкам: [(заявки, текст)]. Длина оценивается
+# по строкам заявок и заголовкам групп, 100 символов — запас на шапку и счетчики
+def split_teamlead_digest(items):
+    batches = []
+    batch, groups, length = [], set(), 0
+    for item in items:
+        key = (item['request_type'], item['department'])
+        line = len(f"• {item['request_number']} от {item['user_id']}") + 1
+        header = len(f"{item['request_type']} — {item['department']}: ") + 12
+        added = line + (header if key not in groups else 0)
+        if batch and length + added > MAX_MESSAGE_LENGTH - 100:
+            batches.append(batch)
+            batch, groups, length = [], set(), 0
+            added = line + header
+        batch.append(item)
+        groups.add(key)
+        length += added
+    if batch:
+        batches.append(batch)
+    return [(batch, format_teamlead_digest(batch)) for batch in batches]
+
+# Отправка накопленного дайджеста тимлиду. Заявки удаляются из буфера после отправки
+# своего сообщения, поэтому при ошибке повторно отправляются только неотправленные
+async def flush_teamlead_digest():
+    async with tenant.digest_lock:
+        if not tenant.digest_buffer:
+            return
+        sent = 0
+        try:
+            for items, text in split_teamlead_digest(list(tenant.digest_buffer)):
+                for part in split_message(text):
+                    await tenant.bot.send_message(chat_id=tenant.teamlead_id, text=part)
+                del tenant.digest_buffer[:len(items)]
+                write_teamlead_digest_spool()
+                sent += len(items)
+        except Exception as e:
+            tenant.digest_failures += 1
+            delay = min(TEAMLEAD_DIGEST_RETRY_DELAY * 2 ** (tenant.digest_failures - 1),
+                        tenant.settings.TEAMLEAD_DIGEST_INTERVAL)
+            tenant.digest_retry_at = time.monotonic() + delay
+            logger.error(f"Ошибка отправки дайджеста тимлиду (отправлено {sent} заявок): {e}")
+            return
+        tenant.digest_failures = 0
+        tenant.digest_retry_at = 0.0
+        logger.info(f"Дайджест тимлиду отправлен: {sent} заявок.")
+
+# Фоновая задача периодической отправки дайджеста
+async def teamlead_digest_loop():
+    while True:
+        await asyncio.sleep(tenant.settings.TEAMLEAD_DIGEST_INTERVAL)
+        await flush_teamlead_digest()
+
 # Уведомление тимлиду о создании заявки
-async def notify_teamlead(user_id, request_type, request_number):
+async def notify_teamlead(user_id, request_type, request_number, department='Без отдела', urgent=False):
+    if urgent or not tenant.settings.TEAMLEAD_DIGEST_ENABLED:
+        try:
+            prefix = "🔥 Срочная заявка" if urgent else "Новая заявка"
+            message = f"{prefix} {request_number} от {user_id} (Тип: {request_type})."
+            await tenant.bot.send_message(chat_id=tenant.teamlead_id, text=message)
+        except Exception as e:
+            logger.error(f"Ошибка уведомления тимлида: {e}")
+        return
+    item = {
+        'user_id': user_id,
+        'request_type': request_type,
+        'request_number': request_number,
+        'department': department,
+        'created_at': time.time()
+    }
+    tenant.digest_buffer.append(item)
     try:
-        message = f"Новая заявка {request_number} от {user_id} (Тип: {request_type})."
-        await bot.send_message(chat_id=TEAMLEAD_ID, text=message)
+        with open(tenant.digest_spool, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(item, ensure_ascii=False) + "\n")
     except Exception as e:
-        logger.error(f"Ошибка уведомления тимлида: {e}")
+        logger.error(f"Ошибка записи файла дайджеста: {e}")
+    # После ошибки отправки переполнение не вызывает отправку до конца паузы
+    if (len(tenant.digest_buffer) >= tenant.settings.TEAMLEAD_DIGEST_MAX_ITEMS
+            and time.monotonic() >= tenant.digest_retry_at):
+        await flush_teamlead_digest()
 
 # Функция для получения всех заявок
 async def fetch_all_requests():
-    headers = {'Authorization': f'Bearer {AIRTABLE_API_KEY}'}
     requests_data = {}
     for table in ['Заявки', 'Кастомные_заказы']:
-        url = f'https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{table}'
-        response = requests.get(url, headers=headers)
+        response = airtable_request('GET', table)
         response.raise_for_status()
         records = response.json().get('records', [])
         for record in records:
@@ -151,123 +2161,470 @@ async def fetch_all_requests():
             }
     return requests_data
 
+# Telegram ID пользователя по record_id из таблицы Пользователи
+def get_telegram_id(user_record_id):
+    logger.debug(f"Fetching Telegram_ID for user_record_id {user_record_id}")
+    if user_record_id in tenant.record_id_to_telegram_id:
+        return tenant.record_id_to_telegram_id[user_record_id]
+    if tenant.replica:
+        return tenant.replica.telegram_id_for_user(user_record_id)
+    response = airtable_request('GET', f'Пользователи/{user_record_id}')
+    response.raise_for_status()
+    fields = response.json().get('fields', {})
+    telegram_id = fields.get('Telegram_ID')
+    logger.debug(f"Retrieved Telegram_ID {telegram_id} for user_record_id {user_record_id}")
+    return telegram_id
+
+# Данные заявки для сравнения статусов (заодно обновляет агрегаты /stats)
+def request_data_from_record(record):
+    fields = record['fields']
+    update_request_stats(record['id'], fields, record.get('createdTime'))
+    return {
+        'status': fields.get('Статус', 'Неизвестно'),
+        'tracking_number': fields.get('Трек-номер', None),
+        'user_record_id': fields.get('Пользователь', [None])[0],
+        'request_number': fields.get('Номер_заявки', 'Неизвестно')
+    }
+
+# Сравнение заявок с последним известным состоянием и уведомление пользователей.
+# Используется поллером и вебхуком Airtable; блокировка исключает двойные уведомления.
+# fetched_at — time.monotonic() перед запросом данных: страница опроса, запрошенная до того,
+# как вебхук применил более новое состояние, не откатывает его назад
+async def process_request_changes(requests_data, deleted_ids=(), fetched_at=None):
+    changed_count = 0
+    statuses = tenant.request_statuses
+    changed_at = tenant.request_changed_at
+    if fetched_at is None:
+        fetched_at = time.monotonic()
+    async with tenant.request_changes_lock:
+        if len(changed_at) > REQUEST_CHANGED_AT_MAX_ENTRIES:
+            horizon = time.monotonic() - REQUEST_CHANGED_AT_HORIZON
+            for record_id in [record_id for record_id, at in changed_at.items() if at < horizon]:
+                del changed_at[record_id]
+        for record_id, data in requests_data.items():
+            if changed_at.get(record_id, fetched_at) > fetched_at:
+                logger.debug(f"Skipping stale data for request {record_id}")
+                continue
+            current_status = data['status']
+            current_tracking = data['tracking_number']
+            request_number = data['request_number']
+            previous = statuses.get(record_id)
+            current = statuses.fingerprint(current_status, current_tracking)
+            if previous is None:
+                logger.debug(f"New request detected: {record_id}, request_number: {request_number}")
+                statuses.set(record_id, current)
+                continue
+            # Без изменений — без обращения к пользователям и Telegram
+            if previous == current:
+                continue
+            changed_count += 1
+            prev_status = statuses.status_of(previous)
+            tracking_changed = statuses.tracking_of(previous) != statuses.tracking_of(current)
+            user_record_id = data['user_record_id']
+
+            if user_record_id:
+                try:
+                    telegram_id = tenant.record_id_to_telegram_id.get(user_record_id)
+                    if telegram_id is None:
+                        telegram_id = await asyncio.to_thread(get_telegram_id, user_record_id)
+                    if telegram_id:
+                        if current_status != prev_status:
+                            logger.info(
+                                f"Sending status update for request {request_number} to user {telegram_id}: "
+                                f"{prev_status} -> {current_status}"
+                            )
+                            await tenant.bot.send_message(
+                                chat_id=telegram_id,
+                                text=f"Статус вашей заявки №{request_number} изменился с '{prev_status}' на '{current_status}'."
+                            )
+                        if current_tracking and tracking_changed:
+                            logger.info(
+                                f"Sending tracking update for request {request_number} to user {telegram_id}: "
+                                f"{current_tracking}"
+                            )
+                            await tenant.bot.send_message(
+                                chat_id=telegram_id,
+                                text=f"Трек-номер для вашей заявки №{request_number}: {current_tracking}"
+                            )
+                    else:
+                        logger.warning(f"No Telegram_ID found for user_record_id {user_record_id}")
+                except requests.exceptions.HTTPError as http_err:
+                    logger.error(f"Error fetching Telegram_ID for {user_record_id}: {http_err}")
+            else:
+                logger.warning(f"No user_record_id found for request {record_id}")
+
+            statuses.set(record_id, current)
+            changed_at[record_id] = fetched_at
+
+        for record_id in deleted_ids:
+            if statuses.remove(record_id):
+                logger.debug(f"Removing deleted request {record_id}")
+                changed_count += 1
+            tenant.request_stats.remove(record_id)
+            changed_at.pop(record_id, None)
+    return changed_count
+
+# Планировщик опроса по уровням статусов. Каждый активный статус — отдельный уровень
+# со своим интервалом, остальные незавершенные статусы — уровень по умолчанию,
+# завершенные проверяются только полной сверкой. Так число запросов к Airtable
+# зависит от количества активных заявок, а не от всей истории.
+class StatusPollScheduler:
+    DEFAULT_TIER = '*'
+    RECONCILE_TIER = 'reconcile'
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.terminal_statuses = set(settings.TERMINAL_STATUSES)
+        self.configured_statuses = set(settings.STATUS_POLL_INTERVALS)
+        self.tiers = {}
+        for status, interval in settings.STATUS_POLL_INTERVALS.items():
+            if status not in self.terminal_statuses:
+                self._add_tier(status, interval)
+        self._add_tier(self.DEFAULT_TIER, settings.DEFAULT_STATUS_POLL_INTERVAL)
+        # Первая сверка сразу при запуске: заполняет REQUEST_STATUSES всеми заявками
+        self._add_tier(self.RECONCILE_TIER, settings.TERMINAL_RECONCILE_INTERVAL)
+        # Неудачные сверки подряд и была ли хотя бы одна успешная
+        self.reconcile_failures = 0
+        self.reconciled = False
+
+    def _add_tier(self, name, interval):
+        self.tiers[name] = {
+            'base': interval, 'interval': interval, 'next_run': 0.0,
+            'polls': 0, 'changes': 0, 'records': 0
+        }
+
+    def covers(self, tier, status):
+        if tier == self.RECONCILE_TIER:
+            return True
+        if tier == self.DEFAULT_TIER:
+            return status not in self.configured_statuses and status not in self.terminal_statuses
+        return status == tier
+
+    def formula(self, tier):
+        if tier == self.RECONCILE_TIER:
+            return None
+        if tier == self.DEFAULT_TIER:
+            excluded = sorted(self.configured_statuses | self.terminal_statuses)
+            if not excluded:
+                return None
+            conditions = ",".join(f"{{Статус}} = '{escape_formula_value(status)}'" for status in excluded)
+            return f"NOT(OR({conditions}))"
+        return f"{{Статус}} = '{escape_formula_value(tier)}'"
+
+    def effective_interval(self, tier):
+        interval = self.tiers[tier]['interval']
+        # С вебхуком изменения приходят push-уведомлениями, опрос — только страховка
+        if tenant.webhook_id and tier != self.RECONCILE_TIER:
+            interval = max(interval, self.settings.WEBHOOK_SAFETY_POLL_INTERVAL)
+        return interval
+
+    def next_reconcile_delay(self):
+        if not self.settings.TERMINAL_RECONCILE_HOUR.isdigit():
+            return self.settings.TERMINAL_RECONCILE_INTERVAL
+        now = datetime.now(timezone.utc)
+        run_at = now.replace(hour=int(self.settings.TERMINAL_RECONCILE_HOUR) % 24, minute=0, second=0, microsecond=0)
+        if run_at <= now:
+            run_at += timedelta(days=1)
+        return (run_at - now).total_seconds()
+
+    def due_tiers(self):
+        now = time.monotonic()
+        due = [name for name, tier in self.tiers.items() if tier['next_run'] <= now]
+        # Сверка охватывает все уровни, отдельный опрос в этом цикле не нужен
+        if self.RECONCILE_TIER in due:
+            return [self.RECONCILE_TIER]
+        return due
+
+    # Учет результата опроса: изменения — интервал вдвое короче, тишина — в 1.5 раза длиннее
+    def record_result(self, tier, records, changes):
+        state = self.tiers[tier]
+        state['polls'] += 1
+        state['changes'] += changes
+        state['records'] = records
+        now = time.monotonic()
+        if tier == self.RECONCILE_TIER:
+            self.reconcile_failures = 0
+            self.reconciled = True
+            state['next_run'] = now + self.next_reconcile_delay()
+            for name, other in self.tiers.items():
+                if name != tier:
+                    other['next_run'] = now + self.effective_interval(name)
+            return
+        if changes:
+            state['interval'] = max(state['base'] * self.settings.POLL_INTERVAL_MIN_FACTOR, state['interval'] / 2)
+        else:
+            state['interval'] = min(state['base'] * self.settings.POLL_INTERVAL_MAX_FACTOR, state['interval'] * 1.5)
+        state['next_run'] = now + self.effective_interval(tier)
+
+    # Ошибка опроса: повтор уровня не раньше чем через его базовый интервал. Сверка повторяется
+    # раньше: с DEFAULT_STATUS_POLL_INTERVAL, удваивая паузу; до первой успешной сверки —
+    # не реже чем раз в DEFAULT_STATUS_POLL_INTERVAL * POLL_INTERVAL_MAX_FACTOR, потом —
+    # не позже следующей сверки по расписанию
+    def record_failure(self, tier):
+        state = self.tiers[tier]
+        now = time.monotonic()
+        if tier == self.RECONCILE_TIER:
+            self.reconcile_failures += 1
+            default_interval = self.settings.DEFAULT_STATUS_POLL_INTERVAL
+            if self.reconciled:
+                limit = self.next_reconcile_delay()
+            else:
+                limit = default_interval * self.settings.POLL_INTERVAL_MAX_FACTOR
+            state['next_run'] = now + min(default_interval * 2 ** (self.reconcile_failures - 1), limit)
+            return
+        state['next_run'] = now + min(state['base'], self.effective_interval(tier))
+
+    def next_wakeup(self):
+        now = time.monotonic()
+        return max(1.0, min(tier['next_run'] for tier in self.tiers.values()) - now)
+
+    def snapshot(self):
+        now = time.monotonic()
+        return {
+            name: {
+                'interval': round(self.effective_interval(name)),
+                'next_run_in': round(max(0.0, tier['next_run'] - now)),
+                'polls': tier['polls'],
+                'changes': tier['changes'],
+                'records': tier['records']
+            }
+            for name, tier in self.tiers.items()
+        }
+
+# Опрос одного уровня: страницы заявок с его статусами сравниваются по мере загрузки,
+# затем дозагружаются по ID известные заявки, которые из уровня пропали (сменили статус
+# или удалены). Возвращает (число просмотренных заявок, число изменений).
+async def poll_status_tier(tier):
+    scheduler = tenant.status_poll_scheduler
+    statuses = tenant.request_statuses
+    formula = scheduler.formula(tier)
+    params = {'filterByFormula': formula} if formula else {}
+    # Отметки увиденных в этом опросе слотов — по байту на запись
+    expected = list(statuses.iter_slots(lambda status: scheduler.covers(tier, status)))
+    seen = bytearray(len(statuses.values))
+    records_count = changes = 0
+    for table in ['Заявки', 'Кастомные_заказы']:
+        pages = iter_airtable_records(table, params)
+        while True:
+            fetched_at = time.monotonic()
+            page = await asyncio.to_thread(next, pages, None)
+            if page is None:
+                break
+            requests_data = {record['id']: request_data_from_record(record) for record in page}
+            changes += await process_request_changes(requests_data, fetched_at=fetched_at)
+            records_count += len(page)
+            for record_id in requests_data:
+                slot = statuses.slot(record_id)
+                if slot is not None and slot < len(seen):
+                    seen[slot] = 1
+    missing = [record_id for record_id, slot in expected if not seen[slot] and record_id in statuses]
+    found_ids = set()
+    if missing and tier != StatusPollScheduler.RECONCILE_TIER:
+        fetched_at = time.monotonic()
+        records = await asyncio.to_thread(fetch_requests_by_ids, missing)
+        requests_data = {record['id']: request_data_from_record(record) for _, record in records}
+        found_ids = set(requests_data)
+        changes += await process_request_changes(requests_data, fetched_at=fetched_at)
+        records_count += len(requests_data)
+    deleted_ids = [record_id for record_id in missing if record_id not in found_ids]
+    if deleted_ids:
+        changes += await process_request_changes({}, deleted_ids)
+    return records_count, changes
+
 # Фоновая задача для проверки обновлений заявок
 async def check_request_updates():
-    global REQUEST_STATUSES
     while True:
+        token = start_trace(f"poll-{int(time.time())}")
         try:
             logger.debug("Starting request updates check")
-            headers = {'Authorization': f'Bearer {AIRTABLE_API_KEY}'}
-            requests_data = {}
-
-            def get_telegram_id(user_record_id):
-                logger.debug(f"Fetching Telegram_ID for user_record_id {user_record_id}")
-                response = requests.get(
-                    f'https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/Пользователи/{user_record_id}',
-                    headers=headers
-                )
-                response.raise_for_status()
-                fields = response.json().get('fields', {})
-                telegram_id = fields.get('Telegram_ID')
-                logger.debug(f"Retrieved Telegram_ID {telegram_id} for user_record_id {user_record_id}")
-                return telegram_id
-
-            for table in ['Заявки', 'Кастомные_заказы']:
-                logger.debug(f"Fetching records from table {table}")
-                url = f'https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{table}'
-                response = requests.get(url, headers=headers)
-                response.raise_for_status()
-                records = response.json().get('records', [])
-                logger.debug(f"Fetched {len(records)} records from {table}")
-                for record in records:
-                    record_id = record['id']
-                    fields = record['fields']
-                    status = fields.get('Статус', 'Неизвестно')
-                    tracking_number = fields.get('Трек-номер', None)
-                    request_number = fields.get('Номер_заявки', 'Неизвестно')
-                    user_record_id = fields.get('Пользователь', [None])[0]
-                    requests_data[record_id] = {
-                        'status': status,
-                        'tracking_number': tracking_number,
-                        'user_record_id': user_record_id,
-                        'request_number': request_number
-                    }
+            if tenant.replica:
+                # С репликой сравниваются только изменившиеся с прошлой синхронизации записи
+                requests_data = {}
+                fetched_at = time.monotonic()
+                changed, deleted_ids = await asyncio.to_thread(tenant.replica.sync)
+                for record in changed:
+                    requests_data[record['id']] = request_data_from_record(record)
+                await process_request_changes(requests_data, deleted_ids, fetched_at)
+            else:
+                for tier in tenant.status_poll_scheduler.due_tiers():
+                    try:
+                        with trace_span('poll_tier', tier=tier):
+                            records_count, changes = await poll_status_tier(tier)
+                    except Exception:
+                        tenant.status_poll_scheduler.record_failure(tier)
+                        raise
+                    tenant.status_poll_scheduler.record_result(tier, records_count, changes)
+                    logger.debug(f"Polled tier {tier}: {records_count} records, {changes} changes")
+            logger.debug("Request updates check completed")
+        except Exception as e:
+            logger.error(f"Error in check_request_updates: {e}")
+        finally:
+            TRACE_CONTEXT.reset(token)
+        await asyncio.sleep(get_poll_interval())
+
+# Интервал опроса. Без реплики — до ближайшего уровня статусов по расписанию (с вебхуком
+# Airtable уровни опрашиваются только как страховка). Реплика синхронизируется с обычным
+# интервалом и при вебхуке: /history читает ее, только пока она свежая, а Пользователи
+# обновляются только синхронизацией
+def get_poll_interval():
+    if not tenant.replica:
+        return tenant.status_poll_scheduler.next_wakeup()
+    return tenant.settings.REPLICA_SYNC_INTERVAL
+
+# Проверка подписи уведомления Airtable (заголовок X-Airtable-Content-MAC)
+def verify_airtable_webhook(body, mac_header):
+    if not tenant.webhook_secret or not mac_header:
+        return False
+    expected = hmac.new(base64.b64decode(tenant.webhook_secret), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(f"hmac-sha256={expected}", mac_header)
+
+# Загрузка накопленных payload вебхука начиная с курсора
+def fetch_webhook_payloads(cursor):
+    url = f'{tenant.settings.AIRTABLE_API_URL}/v0/bases/{tenant.airtable_base_id}/webhooks/{tenant.webhook_id}/payloads'
+    response = airtable_call('GET', url, 'webhooks', params={'cursor': cursor})
+    response.raise_for_status()
+    return response.json()
+
+# Загрузка заявок по списку ID (до 50 ID на запрос)
+def fetch_requests_by_ids(record_ids):
+    records = []
+    for table in ['Заявки', 'Кастомные_заказы']:
+        for i in range(0, len(record_ids), 50):
+            chunk = record_ids[i:i + 50]
+            formula = "OR(" + ",".join(f"RECORD_ID() = '{record_id}'" for record_id in chunk) + ")"
+            for page in iter_airtable_records(table, {'filterByFormula': formula}):
+                records.extend((table, record) for record in page)
+    return records
+
+def load_webhook_cursor():
+    try:
+        with open(tenant.webhook_cursor_file, encoding='utf-8') as f:
+            return int(f.read().strip() or 1)
+    except (OSError, ValueError):
+        return 1
 
-            for record_id, data in requests_data.items():
-                if record_id not in REQUEST_STATUSES:
-                    logger.debug(f"New request detected: {record_id}, request_number: {data['request_number']}")
-                    REQUEST_STATUSES[record_id] = {
-                        'status': data['status'],
-                        'tracking_number': data['tracking_number'],
-                        'request_number': data['request_number']
-                    }
-                else:
-                    prev_status = REQUEST_STATUSES[record_id]['status']
-                    prev_tracking = REQUEST_STATUSES[record_id]['tracking_number']
-                    current_status = data['status']
-                    current_tracking = data['tracking_number']
-                    request_number = data['request_number']
-                    user_record_id = data['user_record_id']
-
-                    if user_record_id:
-                        try:
-                            telegram_id = get_telegram_id(user_record_id)
-                            if telegram_id:
-                                if current_status != prev_status:
-                                    logger.info(
-                                        f"Sending status update for request {request_number} to user {telegram_id}: "
-                                        f"{prev_status} -> {current_status}"
-                                    )
-                                    await bot.send_message(
-                                        chat_id=telegram_id,
-                                        text=f"Статус вашей заявки №{request_number} изменился с '{prev_status}' на '{current_status}'."
-                                    )
-                                if current_tracking and current_tracking != prev_tracking:
-                                    logger.info(
-                                        f"Sending tracking update for request {request_number} to user {telegram_id}: "
-                                        f"{current_tracking}"
-                                    )
-                                    await bot.send_message(
-                                        chat_id=telegram_id,
-                                        text=f"Трек-номер для вашей заявки №{request_number}: {current_tracking}"
-                                    )
-                            else:
-                                logger.warning(f"No Telegram_ID found for user_record_id {user_record_id}")
-                        except requests.exceptions.HTTPError as http_err:
-                            logger.error(f"Error fetching Telegram_ID for {user_record_id}: {http_err}")
-                    else:
-                        logger.warning(f"No user_record_id found for request {record_id}")
+def save_webhook_cursor(cursor):
+    try:
+        with open(tenant.webhook_cursor_file, 'w', encoding='utf-8') as f:
+            f.write(str(cursor))
+    except OSError as e:
+        logger.error(f"Ошибка записи курсора вебхука: {e}")
+
+# Обработка уведомления Airtable: читаем новые payload и сравниваем только затронутые заявки
+async def handle_airtable_webhook():
+    async with tenant.webhook_lock:
+        token = start_trace(f"webhook-{int(time.time())}")
+        try:
+            if tenant.webhook_cursor is None:
+                tenant.webhook_cursor = load_webhook_cursor()
+            # Курсор сдвигается только после обработки: при ошибке payload будут прочитаны снова
+            cursor = tenant.webhook_cursor
+            changed_ids, destroyed_ids = set(), set()
+            while True:
+                data = await asyncio.to_thread(fetch_webhook_payloads, cursor)
+                for payload in data.get('payloads', []):
+                    for table_changes in payload.get('changedTablesById', {}).values():
+                        changed_ids.update(table_changes.get('changedRecordsById', {}))
+                        changed_ids.update(table_changes.get('createdRecordsById', {}))
+                        destroyed_ids.update(table_changes.get('destroyedRecordIds', []))
+                cursor = data.get('cursor', cursor)
+                if not data.get('mightHaveMore'):
+                    break
+            changed_ids -= destroyed_ids
+            logger.debug(f"Airtable webhook: {len(changed_ids)} changed, {len(destroyed_ids)} destroyed records")
+            fetched_at = time.monotonic()
+            records = await asyncio.to_thread(fetch_requests_by_ids, sorted(changed_ids)) if changed_ids else []
+            if tenant.replica:
+                await asyncio.to_thread(tenant.replica.apply, records, sorted(destroyed_ids))
+            requests_data = {record['id']: request_data_from_record(record) for _, record in records}
+            await process_request_changes(requests_data, sorted(destroyed_ids), fetched_at)
+            tenant.webhook_cursor = cursor
+            save_webhook_cursor(cursor)
+        except Exception as e:
+            logger.error(f"Error handling Airtable webhook: {e}")
+        finally:
+            TRACE_CONTEXT.reset(token)
+
+# Клавиатуры строятся один раз при импорте и переиспользуются всеми обработчиками
+MAIN_MENU_KEYBOARD = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="Создать заявку"), KeyboardButton(text="История")]
+    ],
+    resize_keyboard=True
+)
 
-                    REQUEST_STATUSES[record_id] = {
-                        'status': current_status,
-                        'tracking_number': current_tracking,
-                        'request_number': request_number
-                    }
+NAV_KEYBOARD = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="Начать заново"), KeyboardButton(text="Вернуться назад")]
+    ],
+    resize_keyboard=True
+)
 
-            for record_id in list(REQUEST_STATUSES.keys()):
-                if record_id not in requests_data:
-                    logger.debug(f"Removing deleted request {record_id}")
-                    del REQUEST_STATUSES[record_id]
+RESTART_KEYBOARD = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="Начать заново")]
+    ],
+    resize_keyboard=True
+)
 
-            logger.debug("Request updates check completed")
-        except Exception as e:
-            logger.error(f"Error in check_request_updates: {e}")
-        await asyncio.sleep(1200)  # Проверка каждые 20 минут
+REQUEST_TYPE_KEYBOARD = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="Существующий товар"), KeyboardButton(text="Кастомный товар")],
+        [KeyboardButton(text="Начать заново")]
+    ],
+    resize_keyboard=True
+)
+
+DELIVERY_KEYBOARD = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="Почта"), KeyboardButton(text="Курьер"), KeyboardButton(text="CDEK")],
+        [KeyboardButton(text="Свой вариант")],
+        [KeyboardButton(text="Начать заново"), KeyboardButton(text="Вернуться назад")]
+    ],
+    resize_keyboard=True
+)
+
+SELECTION_ACTIONS_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="Добавить еще товар", callback_data="add_more")],
+    [InlineKeyboardButton(text="Вернуться к поиску", callback_data="back_to_search")],
+    [InlineKeyboardButton(text="Завершить выбор", callback_data="finish_selection")],
+    [InlineKeyboardButton(text="Показать выбранные товары", callback_data="show_selected")],
+    [InlineKeyboardButton(text="Начать заново", callback_data="restart")]
+])
+
+DELIVERY_METHODS = {"Почта", "Курьер", "CDEK"}
 
 # Создание клавиатуры главного меню
 def get_main_menu():
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="Создать заявку"), KeyboardButton(text="История")]
-        ],
-        resize_keyboard=True
-    )
-    return keyboard
+    return MAIN_MENU_KEYBOARD
+
+# Клавиатура со списком найденных товаров
+def build_product_list_keyboard(products):
+    rows = [
+        [InlineKeyboardButton(text=product['fields'].get('Название', 'Без названия'), callback_data=f"product_{product['id']}")]
+        for product in products
+    ]
+    rows.append([InlineKeyboardButton(text="Начать заново", callback_data="restart")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+# Клавиатура удаления выбранных товаров
+def build_selected_products_keyboard(selected_products):
+    rows = [
+        [InlineKeyboardButton(text=f"Удалить {product['name']}", callback_data=f"delete_product_{product['id']}")]
+        for product in selected_products
+    ]
+    rows.append([InlineKeyboardButton(text="Очистить все", callback_data="clear_all")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+# Сброс заполняемой заявки: состояние FSM и резерв товара пользователя
+async def clear_request(state, user_id):
+    tenant.stock_ledger.release(str(user_id))
+    await state.clear()
 
 # Обработчик /start
 @dp.message(Command("start"))
 async def send_welcome(message: types.Message, state: FSMContext):
-    await state.clear()
+    await clear_request(state, message.from_user.id)
     await message.reply(
         "Добро пожаловать! Используйте:\n"
         "/create_request — для создания заявки\n"
@@ -276,12 +2633,10 @@ async def send_welcome(message: types.Message, state: FSMContext):
     )
 
 # Обработчики для кнопок главного меню
-@dp.message(lambda message: message.text == "Создать заявку")
 async def handle_create_request(message: types.Message, state: FSMContext):
     await create_request(message, state)
 
-@dp.message(lambda message: message.text == "История")
-async def handle_history(message: types.Message):
+async def handle_history(message: types.Message, state: FSMContext):
     await show_history(message)
 
 # Обработчик /history
@@ -294,15 +2649,11 @@ async def show_history(message: types.Message):
         await message.reply("❌ Доступ запрещен", reply_markup=get_main_menu())
         return
     try:
-        headers = {'Authorization': f'Bearer {AIRTABLE_API_KEY}'}
         history = []
 
-        async def fetch_records(table_name):
+        def fetch_records(table_name):
             logger.debug(f"Fetching records from table {table_name}")
-            response = requests.get(
-                f'https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{table_name}',
-                headers=headers
-            )
+            response = airtable_request('GET', table_name)
             response.raise_for_status()
             records = response.json().get('records', [])
             logger.debug(f"Fetched {len(records)} records from {table_name}")
@@ -310,75 +2661,55 @@ async def show_history(message: types.Message):
 
         def get_telegram_id(user_record_id):
             logger.debug(f"Fetching user data for record_id {user_record_id}")
-            response = requests.get(
-                f'https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/Пользователи/{user_record_id}',
-                headers=headers
-            )
+            response = airtable_request('GET', f'Пользователи/{user_record_id}')
             response.raise_for_status()
             fields = response.json().get('fields', {})
             telegram_id = fields.get('Telegram_ID')
             logger.debug(f"Got Telegram_ID {telegram_id} for user_record_id {user_record_id}")
             return telegram_id
 
-        orders = await fetch_records('Заявки')
-        custom_orders = await fetch_records('Кастомные_заказы')
-
-        for record in orders + custom_orders:
-            fields = record['fields']
-            user_record_ids = fields.get('Пользователь', [])
-            logger.debug(f"Processing record {record['id']} with user_record_ids {user_record_ids}")
-
-            for user_record_id in user_record_ids:
-                try:
-                    telegram_id = get_telegram_id(user_record_id)
-                    if telegram_id == user_id:
-                        logger.debug(f"Match found: record {record['id']} belongs to user {user_id}")
-                        order_type = '📦 Заявка' if 'Товар' in fields else '🎨 Кастом'
-                        product_info = 'Нет данных'
-                        if 'Товар' in fields and fields['Товар']:
-                            product_ids = fields['Товар']
-                            products = []
-                            for product_id in product_ids:
-                                product = get_product_by_id(product_id)
-                                if product:
-                                    products.append(product['fields'].get('Название', product_id))
-                            product_info = ", ".join(products)
-                        history.append(
-                            f"**{order_type}**\n"
-                            f"**Номер заявки**: {fields.get('Номер_заявки', '-')}\n"
-                            f"**Товар**: {product_info}\n"
-                            f"**Количество**: {fields.get('Количество', '-')}\n"
-                            f"**Сумма**: {fields.get('Общая_сумма', 0)} руб.\n"
-                            f"**Статус**: {fields.get('Статус', '-')}\n"
-                            f"**Дата**: {fields.get('Дата_создания', '-')}\n"
-                            "--------------------"
-                        )
-                        break
-                except requests.exceptions.HTTPError as http_err:
-                    logger.error(f"Error fetching user data for {user_record_id}: {http_err}")
-                    continue
+        if tenant.replica and tenant.replica.is_fresh():
+            # Быстрый путь: заявки пользователя из локальной реплики по индексу
+            user_records = tenant.replica.requests_for_user(tenant.allowed_users[user_id]['record_id'])
+            logger.debug(f"Replica returned {len(user_records)} records for user {user_id}")
+            product_ids = [product_id for fields in user_records for product_id in fields.get('Товар', [])]
+            product_names = await asyncio.to_thread(fetch_product_names, product_ids) if product_ids else {}
+            for fields in user_records:
+                product_info = ", ".join(product_names[product_id] for product_id in fields.get('Товар', []))
+                history.append(format_history_entry(fields, product_info or 'Нет данных'))
+        else:
+            orders = await asyncio.to_thread(fetch_records, 'Заявки')
+            custom_orders = await asyncio.to_thread(fetch_records, 'Кастомные_заказы')
+
+            for record in orders + custom_orders:
+                fields = record['fields']
+                user_record_ids = fields.get('Пользователь', [])
+                logger.debug(f"Processing record {record['id']} with user_record_ids {user_record_ids}")
+
+                for user_record_id in user_record_ids:
+                    try:
+                        telegram_id = await asyncio.to_thread(get_telegram_id, user_record_id)
+                        if telegram_id == user_id:
+                            logger.debug(f"Match found: record {record['id']} belongs to user {user_id}")
+                            product_info = 'Нет данных'
+                            if 'Товар' in fields and fields['Товар']:
+                                product_ids = fields['Товар']
+                                products = []
+                                for product_id in product_ids:
+                                    product = await asyncio.to_thread(get_product_by_id, product_id)
+                                    if product:
+                                        products.append(product['fields'].get('Название', product_id))
+                                product_info = ", ".join(products)
+                            history.append(format_history_entry(fields, product_info))
+                            break
+                    except requests.exceptions.HTTPError as http_err:
+                        logger.error(f"Error fetching user data for {user_record_id}: {http_err}")
+                        continue
 
         history_text = f"🛒 **История заявок**:\n\n" + "\n".join(history) if history else "У вас пока нет заявок."
         logger.info(f"History for user {user_id}: {len(history)} records found")
-        MAX_MESSAGE_LENGTH = 4000
-        if len(history_text) > MAX_MESSAGE_LENGTH:
-            parts = []
-            current_part = ""
-            for line in history_text.split("\n"):
-                if len(current_part) + len(line) + 1 > MAX_MESSAGE_LENGTH:
-                    parts.append(current_part)
-                    current_part = line
-                else:
-                    if current_part:
-                        current_part += "\n" + line
-                    else:
-                        current_part = line
-            if current_part:
-                parts.append(current_part)
-            for part in parts:
-                await message.reply(part, parse_mode=ParseMode.MARKDOWN)
-        else:
-            await message.reply(history_text, parse_mode=ParseMode.MARKDOWN)
+        for part in split_message(history_text):
+            await message.reply(part, parse_mode=ParseMode.MARKDOWN)
     except requests.exceptions.HTTPError as e:
         logger.error(f"Airtable error: {e.response.status_code} - {e.response.text}")
         await message.reply("Ошибка доступа к данным. Попробуйте позже.", reply_markup=get_main_menu())
@@ -386,6 +2717,138 @@ async def show_history(message: types.Message):
         logger.error(f"Error in show_history: {e}")
         await message.reply("Произошла ошибка. Обратитесь к администратору.", reply_markup=get_main_menu())
 
+# Обработчик /stats (только для администраторов)
+@dp.message(Command("stats"))
+async def show_stats(message: types.Message):
+    user_id = str(message.from_user.id)
+    if not check_access(user_id, require_admin=True):
+        await message.reply("❌ Доступ запрещен", reply_markup=get_main_menu())
+        return
+    stats = tenant.request_stats
+    if stats.updated_at is None:
+        await message.reply("Статистика еще не собрана. Попробуйте позже.", reply_markup=get_main_menu())
+        return
+
+    def format_counter(counter):
+        return "\n".join(f"  {key}: {count}" for key, count in counter.most_common()) or "  -"
+
+    def format_status(status, count):
+        known = stats.known_in_status(status)
+        if not known:
+            return f"  {status}: {count} (время в статусе неизвестно)"
+        median = format_duration(stats.median_time_in_status(status))
+        if known < count:
+            return f"  {status}: {count} (медиана в статусе: {median} по {known} заявкам)"
+        return f"  {status}: {count} (медиана в статусе: {median})"
+
+    status_lines = "\n".join(
+        format_status(status, count) for status, count in stats.by_status.most_common()
+    ) or "  -"
+    days = sorted(stats.by_day.items(), reverse=True)[:14]
+    day_lines = "\n".join(f"  {day}: {count}" for day, count in days) or "  -"
+    updated = datetime.fromtimestamp(stats.updated_at).strftime('%d.%m.%Y %H:%M')
+    text = (
+        f"📊 Статистика заявок (обновлено {updated})\n\n"
+        f"Всего заявок: {len(stats)}\n"
+        f"Ожидают обработки: {stats.pending_count(tenant.settings.PENDING_STATUSES)}\n"
+        f"Отставание реплики: {format_duration(tenant.replica.staleness()) if tenant.replica else 'реплика выключена'}\n\n"
+        f"По статусам:\n{status_lines}\n"
+        f"Медиана — по заявкам с известным моментом входа в статус: ожидающие считаются с создания, "
+        f"остальные — со смены статуса, замеченной ботом\n\n"
+        f"По отделам:\n{format_counter(stats.by_department)}\n\n"
+        f"По способу доставки:\n{format_counter(stats.by_delivery)}\n\n"
+        f"По дням (последние 14):\n{day_lines}"
+    )
+    for part in split_message(text):
+        await message.reply(part, reply_markup=get_main_menu())
+
+# Обработчик /export (только для администраторов)
+@dp.message(Command("export"))
+async def export_requests(message: types.Message):
+    user_id = str(message.from_user.id)
+    if not check_access(user_id, require_admin=True):
+        await message.reply("❌ Доступ запрещен", reply_markup=get_main_menu())
+        return
+    try:
+        filters = parse_export_filters(message.text.partition(' ')[2])
+    except ValueError as e:
+        await message.reply(
+            f"❌ {e}\nПример: /export status=\"В обработке\" from=2024-01-01 to=2024-01-31 department=Маркетинг",
+            reply_markup=get_main_menu()
+        )
+        return
+    await message.reply("⏳ Формирую выгрузку...")
+    csv_path = None
+    try:
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', encoding='utf-8-sig', newline='', delete=False) as csv_file:
+            csv_path = csv_file.name
+            exported = await asyncio.to_thread(export_requests_csv, filters, csv_file)
+        filename = f"zayavki_{datetime.now().strftime('%Y%m%d_%H%M')}.csv"
+        await message.answer_document(
+            FSInputFile(csv_path, filename=filename),
+            caption=f"Выгружено заявок: {exported}",
+            reply_markup=get_main_menu()
+        )
+        logger.info(f"Export for admin {user_id}: {exported} records, filters {filters}")
+    except Exception as e:
+        logger.error(f"Ошибка выгрузки заявок: {e}")
+        await message.reply("❌ Ошибка при выгрузке заявок. Попробуйте позже.", reply_markup=get_main_menu())
+    finally:
+        if csv_path and os.path.exists(csv_path):
+            os.remove(csv_path)
+
+# Обработчик /bulk_update: CSV-документ с подписью /bulk_update (только для администраторов)
+@dp.message(Command("bulk_update"))
+async def bulk_update(message: types.Message):
+    user_id = str(message.from_user.id)
+    if not check_access(user_id, require_admin=True):
+        await message.reply("❌ Доступ запрещен", reply_markup=get_main_menu())
+        return
+    if not message.document:
+        await message.reply(
+            "Отправьте CSV-файл с подписью /bulk_update.\n"
+            "Колонки: Номер_заявки; Статус; Трек-номер (пустое значение — без изменений).",
+            reply_markup=get_main_menu()
+        )
+        return
+    await message.reply("⏳ Обновляю заявки...")
+    csv_path = None
+    try:
+        with tempfile.NamedTemporaryFile(suffix='.csv', delete=False) as csv_file:
+            csv_path = csv_file.name
+        await message.bot.download(message.document, destination=csv_path)
+        with open(csv_path, encoding='utf-8-sig', newline='') as csv_file:
+            fetched_at = time.monotonic()
+            summary, updated_records, seeds = await asyncio.to_thread(bulk_update_requests, csv_file)
+        async with tenant.request_changes_lock:
+            for record_id, (status, tracking_number) in seeds.items():
+                if record_id not in tenant.request_statuses:
+                    tenant.request_statuses.put(record_id, status, tracking_number)
+        # Уведомления пользователей — через общий детектор изменений
+        await process_request_changes(
+            {record['id']: request_data_from_record(record) for record in updated_records}, fetched_at=fetched_at
+        )
+        text = (
+            f"✅ Обновлено: {summary['applied']}\n"
+            f"⏭ Без изменений: {summary['skipped']}\n"
+            f"❌ Ошибок: {summary['failed']}"
+        )
+        if summary['errors']:
+            text += "\n\n" + "\n".join(summary['errors'])
+            if summary['failed'] > len(summary['errors']):
+                text += f"\n... и еще {summary['failed'] - len(summary['errors'])}"
+        await message.reply(text, reply_markup=get_main_menu())
+        logger.info(f"Bulk update by admin {user_id}: {summary['applied']} applied, "
+                    f"{summary['skipped']} skipped, {summary['failed']} failed")
+    except (UnicodeDecodeError, csv.Error) as e:
+        await message.reply(f"❌ Не удалось прочитать CSV: {e}", reply_markup=get_main_menu())
+    except Exception as e:
+        logger.error(f"Ошибка массового обновления заявок: {e}")
+        await message.reply("❌ Ошибка при обновлении заявок. Попробуйте позже.", reply_markup=get_main_menu())
+    finally:
+        if csv_path and os.path.exists(csv_path):
+            os.remove(csv_path)
+
 # Обработчик /create_request
 @dp.message(Command("create_request"))
 async def create_request(message: types.Message, state: FSMContext):
@@ -393,197 +2856,113 @@ async def create_request(message: types.Message, state: FSMContext):
     if not check_access(user_id):
         await message.reply("❌ Доступ запрещен.", reply_markup=get_main_menu())
         return
-    await state.clear()
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="Существующий товар"), KeyboardButton(text="Кастомный товар")],
-            [KeyboardButton(text="Начать заново")]
-        ],
-        resize_keyboard=True
-    )
-    await message.reply("Выберите тип заявки:", reply_markup=keyboard)
+    await clear_request(state, user_id)
+    await message.reply("Выберите тип заявки:", reply_markup=REQUEST_TYPE_KEYBOARD)
     await state.set_state(CreateRequest.choosing_type)
 
 # Обработка выбора типа заявки
-@dp.message(StateFilter(CreateRequest.choosing_type))
 async def process_type(message: types.Message, state: FSMContext):
-    if message.text == "Начать заново":
-        await state.clear()
-        await create_request(message, state)
-        return
     if message.text == "Кастомный товар":
-        keyboard = ReplyKeyboardMarkup(
-            keyboard=[
-                [KeyboardButton(text="Начать заново"), KeyboardButton(text="Вернуться назад")]
-            ],
-            resize_keyboard=True
-        )
-        await message.reply("Введите название кастомного товара:", reply_markup=keyboard)
+        await message.reply("Введите название кастомного товара:", reply_markup=NAV_KEYBOARD)
         await state.set_state(CreateRequest.entering_custom_name)
     elif message.text == "Существующий товар":
-        keyboard = ReplyKeyboardMarkup(
-            keyboard=[
-                [KeyboardButton(text="Начать заново"), KeyboardButton(text="Вернуться назад")]
-            ],
-            resize_keyboard=True
-        )
-        await message.reply("Введите название или часть названия товара для поиска:", reply_markup=keyboard)
+        await message.reply("Введите название или часть названия товара для поиска:", reply_markup=NAV_KEYBOARD)
         await state.set_state(CreateRequest.searching_product)
     else:
-        keyboard = ReplyKeyboardMarkup(
-            keyboard=[
-                [KeyboardButton(text="Начать заново")]
-            ],
-            resize_keyboard=True
-        )
-        await message.reply("Пожалуйста, выберите один из предложенных вариантов.", reply_markup=keyboard)
+        await message.reply("Пожалуйста, выберите один из предложенных вариантов.", reply_markup=RESTART_KEYBOARD)
 
 # Ввод названия кастомного товара
-@dp.message(StateFilter(CreateRequest.entering_custom_name))
 async def enter_custom_name(message: types.Message, state: FSMContext):
-    if message.text == "Начать заново":
-        await state.clear()
-        await create_request(message, state)
-        return
-    if message.text == "Вернуться назад":
-        await create_request(message, state)
-        return
     custom_name = message.text.strip()
     if not custom_name:
-        keyboard = ReplyKeyboardMarkup(
-            keyboard=[
-                [KeyboardButton(text="Начать заново"), KeyboardButton(text="Вернуться назад")]
-            ],
-            resize_keyboard=True
-        )
-        await message.reply("Название товара не может быть пустым. Попробуйте снова.", reply_markup=keyboard)
+        await message.reply("Название товара не может быть пустым. Попробуйте снова.", reply_markup=NAV_KEYBOARD)
         return
     await state.update_data(custom_name=custom_name)
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="Начать заново"), KeyboardButton(text="Вернуться назад")]
-        ],
-        resize_keyboard=True
-    )
-    await message.reply("Введите ФИО получателя:", reply_markup=keyboard)
+    await message.reply("Введите ФИО получателя:", reply_markup=NAV_KEYBOARD)
     await state.set_state(CreateRequest.entering_fio)
 
 # Поиск товара
-@dp.message(StateFilter(CreateRequest.searching_product))
 async def search_product(message: types.Message, state: FSMContext):
-    if message.text == "Начать заново":
-        await state.clear()
-        await create_request(message, state)
-        return
-    if message.text == "Вернуться назад":
-        await create_request(message, state)
-        return
     try:
         query = message.text.strip()
         user_id = str(message.from_user.id)
-        department = ALLOWED_USERS[user_id]['department']
-        products = search_products(query, department)
+        department = tenant.allowed_users[user_id]['department']
+        products = await asyncio.to_thread(search_products, query, department)
         if not products:
-            keyboard = ReplyKeyboardMarkup(
-                keyboard=[
-                    [KeyboardButton(text="Начать заново"), KeyboardButton(text="Вернуться назад")]
-                ],
-                resize_keyboard=True
-            )
-            await message.reply("❌ Товары не найдены. Попробуйте другой запрос.", reply_markup=keyboard)
+            await message.reply("❌ Товары не найдены. Попробуйте другой запрос.", reply_markup=NAV_KEYBOARD)
             return
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[])
-        for product in products:
-            product_id = product['id']
-            product_name = product['fields'].get('Название', 'Без названия')
-            keyboard.inline_keyboard.append([InlineKeyboardButton(text=product_name, callback_data=f"product_{product_id}")])
-        keyboard.inline_keyboard.append([InlineKeyboardButton(text="Начать заново", callback_data="restart")])
-        await message.reply("Выберите товар из списка:", reply_markup=keyboard)
+        await send_product_photos(message, products)
+        await message.reply("Выберите товар из списка:", reply_markup=build_product_list_keyboard(products))
         await state.update_data(search_query=query, product_list=products)
         await state.set_state(CreateRequest.selecting_product)
     except Exception as e:
         logger.error(f"Ошибка при поиске товаров: {e}")
         await message.reply("⚠ Ошибка при поиске товаров.", reply_markup=get_main_menu())
-        await state.clear()
+        await clear_request(state, message.from_user.id)
+
+# Действия на экране выбора товара (callback_data -> обработчик)
+async def selection_restart(callback_query: types.CallbackQuery, state: FSMContext, data):
+    await clear_request(state, callback_query.from_user.id)
+    await create_request(callback_query.message, state)
+    await callback_query.answer()
+
+async def selection_add_more(callback_query: types.CallbackQuery, state: FSMContext, data):
+    await callback_query.message.edit_reply_markup(reply_markup=None)
+    await callback_query.message.answer("Введите название или часть названия товара для поиска:", reply_markup=NAV_KEYBOARD)
+    await state.set_state(CreateRequest.searching_product)
+    await callback_query.answer()
+
+async def selection_back_to_search(callback_query: types.CallbackQuery, state: FSMContext, data):
+    await state.update_data(selected_products=[])
+    keyboard = build_product_list_keyboard(data.get('product_list', []))
+    await callback_query.message.edit_text("Выберите товар из списка:", reply_markup=keyboard)
+    await callback_query.answer()
+
+async def selection_finish(callback_query: types.CallbackQuery, state: FSMContext, data):
+    selected_products = data.get('selected_products', [])
+    if not selected_products:
+        await callback_query.message.answer("Вы не выбрали ни одного товара.", reply_markup=get_main_menu())
+        await clear_request(state, callback_query.from_user.id)
+        return
+    num_products = len(selected_products)
+    await callback_query.message.answer(
+        f"Вы выбрали {num_products} товаров. Введите {num_products} количеств через запятую (например, 2,3):",
+        reply_markup=NAV_KEYBOARD
+    )
+    await state.set_state(CreateRequest.entering_quantity)
+    await callback_query.answer()
+
+async def selection_show_selected(callback_query: types.CallbackQuery, state: FSMContext, data):
+    selected_products = data.get('selected_products', [])
+    if not selected_products:
+        await callback_query.message.answer("Нет выбранных товаров.")
+    else:
+        product_names = [f"{product['name']} (Размер: {product.get('size', 'Не указан')})" for product in selected_products]
+        await callback_query.message.answer(
+            "Выбранные товары:\n" + "\n".join(product_names),
+            reply_markup=build_selected_products_keyboard(selected_products)
+        )
+    await callback_query.answer()
+
+SELECTION_ACTIONS = {
+    "restart": selection_restart,
+    "add_more": selection_add_more,
+    "back_to_search": selection_back_to_search,
+    "finish_selection": selection_finish,
+    "show_selected": selection_show_selected
+}
 
 # Выбор товара
-@dp.callback_query(StateFilter(CreateRequest.selecting_product))
 async def select_product(callback_query: types.CallbackQuery, state: FSMContext):
     try:
         logger.debug(f"Processing callback: {callback_query.data}")
         data = await state.get_data()
-        selected_products = data.get('selected_products', [])
-
-        if callback_query.data == "restart":
-            await state.clear()
-            await create_request(callback_query.message, state)
-            await callback_query.answer()
-            return
-        if callback_query.data == "add_more":
-            await callback_query.message.edit_reply_markup(reply_markup=None)
-            keyboard = ReplyKeyboardMarkup(
-                keyboard=[
-                    [KeyboardButton(text="Начать заново"), KeyboardButton(text="Вернуться назад")]
-                ],
-                resize_keyboard=True
-            )
-            await callback_query.message.answer("Введите название или часть названия товара для поиска:", reply_markup=keyboard)
-            await state.set_state(CreateRequest.searching_product)
-            await callback_query.answer()
-            return
-        if callback_query.data == "back_to_search":
-            await state.update_data(selected_products=[])
-            products = data.get('product_list', [])
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[])
-            for product in products:
-                product_id = product['id']
-                product_name = product['fields'].get('Название', 'Без названия')
-                keyboard.inline_keyboard.append([InlineKeyboardButton(text=product_name, callback_data=f"product_{product_id}")])
-            keyboard.inline_keyboard.append([InlineKeyboardButton(text="Начать заново", callback_data="restart")])
-            await callback_query.message.edit_text("Выберите товар из списка:", reply_markup=keyboard)
-            await callback_query.answer()
-            return
-        if callback_query.data == "finish_selection":
-            if not selected_products:
-                await callback_query.message.answer("Вы не выбрали ни одного товара.", reply_markup=get_main_menu())
-                await state.clear()
-                return
-            num_products = len(selected_products)
-            keyboard = ReplyKeyboardMarkup(
-                keyboard=[
-                    [KeyboardButton(text="Начать заново"), KeyboardButton(text="Вернуться назад")]
-                ],
-                resize_keyboard=True
-            )
-            await callback_query.message.answer(
-                f"Вы выбрали {num_products} товаров. Введите {num_products} количеств через запятую (например, 2,3):",
-                reply_markup=keyboard
-            )
-            await state.set_state(CreateRequest.entering_quantity)
-            await callback_query.answer()
-            return
-        if callback_query.data == "show_selected":
-            if not selected_products:
-                await callback_query.message.answer("Нет выбранных товаров.")
-            else:
-                product_names = [f"{product['name']} (Размер: {product.get('size', 'Не указан')})" for product in selected_products]
-                keyboard = InlineKeyboardMarkup(inline_keyboard=[])
-                for product in selected_products:
-                    keyboard.inline_keyboard.append([InlineKeyboardButton(text=f"Удалить {product['name']}", callback_data=f"delete_product_{product['id']}")])
-                keyboard.inline_keyboard.append([InlineKeyboardButton(text="Очистить все", callback_data="clear_all")])
-                await callback_query.message.answer("Выбранные товары:\n" + "\n".join(product_names), reply_markup=keyboard)
-            await callback_query.answer()
-            return
-
-        if callback_query.data.startswith('size_'):
-            await select_size(callback_query, state)
-            return
-
-        if not callback_query.data.startswith('product_'):
-            logger.warning(f"Invalid callback data: {callback_query.data}")
-            await callback_query.answer("Неверный выбор")
+        action = SELECTION_ACTIONS.get(callback_query.data)
+        if action:
+            await action(callback_query, state, data)
             return
 
+        selected_products = data.get('selected_products', [])
         product_id = callback_query.data.split('product_')[1]
         if any(product['id'] == product_id for product in selected_products):
             await callback_query.answer("❌ Этот товар уже выбран")
@@ -594,47 +2973,39 @@ async def select_product(callback_query: types.CallbackQuery, state: FSMContext)
         if not product:
             await callback_query.answer("❌ Товар не найден")
             return
-        product_data = get_product_by_id(product_id)
+        product_data = await asyncio.to_thread(get_product_by_id, product_id)
         if not product_data:
             await callback_query.answer("❌ Товар удален")
-            await state.clear()
+            await clear_request(state, callback_query.from_user.id)
             return
         product_name = product_data['fields']['Название']
         sizes = product_data['fields'].get('Размер', '')
 
         if sizes:
             size_list = [size.strip() for size in sizes.split(',') if size.strip()]
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[])
-            for size in size_list:
-                safe_size = size.replace('_', '__')
-                keyboard.inline_keyboard.append([InlineKeyboardButton(text=size, callback_data=f"size_{product_id}_{safe_size}")])
-            keyboard.inline_keyboard.append([InlineKeyboardButton(text="Вернуться назад", callback_data="back_to_search")])
+            keyboard = InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text=size, callback_data=f"size_{product_id}_{size.replace('_', '__')}")]
+                for size in size_list
+            ] + [[InlineKeyboardButton(text="Вернуться назад", callback_data="back_to_search")]])
+            await send_product_photos(callback_query.message, [product_data])
             await callback_query.message.edit_text(f"Выберите размер для товара {product_name}:", reply_markup=keyboard)
             await state.update_data(current_product={'id': product_id, 'name': product_name})
             await callback_query.answer()
         else:
             selected_products.append({'id': product_id, 'name': product_name, 'size': "None"})
             await state.update_data(selected_products=selected_products)
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="Добавить еще товар", callback_data="add_more")],
-                [InlineKeyboardButton(text="Вернуться к поиску", callback_data="back_to_search")],
-                [InlineKeyboardButton(text="Завершить выбор", callback_data="finish_selection")],
-                [InlineKeyboardButton(text="Показать выбранные товары", callback_data="show_selected")],
-                [InlineKeyboardButton(text="Начать заново", callback_data="restart")]
-            ])
             await callback_query.message.edit_text(
                 f"✅ Выбран товар: {product_name}. Всего выбрано: {len(selected_products)} товаров. Хотите добавить еще?",
-                reply_markup=keyboard
+                reply_markup=SELECTION_ACTIONS_KEYBOARD
             )
             await callback_query.answer()
     except Exception as e:
         logger.error(f"Ошибка при выборе товара: {e}")
         await callback_query.message.edit_text("⚠ Произошла ошибка", reply_markup=None)
-        await state.clear()
+        await clear_request(state, callback_query.from_user.id)
         await callback_query.answer()
 
 # Обработчик выбора размера
-@dp.callback_query(lambda c: c.data.startswith('size_'))
 async def select_size(callback_query: types.CallbackQuery, state: FSMContext):
     try:
         logger.debug(f"Processing size selection: {callback_query.data}")
@@ -657,26 +3028,18 @@ async def select_size(callback_query: types.CallbackQuery, state: FSMContext):
 
         selected_products.append({'id': product_id, 'name': current_product['name'], 'size': size})
         await state.update_data(selected_products=selected_products, current_product=None)
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="Добавить еще товар", callback_data="add_more")],
-            [InlineKeyboardButton(text="Вернуться к поиску", callback_data="back_to_search")],
-            [InlineKeyboardButton(text="Завершить выбор", callback_data="finish_selection")],
-            [InlineKeyboardButton(text="Показать выбранные товары", callback_data="show_selected")],
-            [InlineKeyboardButton(text="Начать заново", callback_data="restart")]
-        ])
         await callback_query.message.edit_text(
             f"✅ Выбран товар: {current_product['name']} (Размер: {size}). Всего выбрано: {len(selected_products)} товаров. Хотите добавить еще?",
-            reply_markup=keyboard
+            reply_markup=SELECTION_ACTIONS_KEYBOARD
         )
         await callback_query.answer()
     except Exception as e:
         logger.error(f"Ошибка при выборе размера: {e}")
         await callback_query.message.edit_text("⚠ Произошла ошибка", reply_markup=None)
-        await state.clear()
+        await clear_request(state, callback_query.from_user.id)
         await callback_query.answer()
 
 # Обработчик удаления товара
-@dp.callback_query(lambda c: c.data.startswith('delete_product_') or c.data == 'clear_all')
 async def handle_delete_product(callback_query: types.CallbackQuery, state: FSMContext):
     try:
         data = await state.get_data()
@@ -689,315 +3052,238 @@ async def handle_delete_product(callback_query: types.CallbackQuery, state: FSMC
             await callback_query.answer()
             return
 
-        if callback_query.data.startswith('delete_product_'):
-            product_id_to_delete = callback_query.data.split('delete_product_')[1]
-            selected_products = [product for product in selected_products if product['id'] != product_id_to_delete]
-            await state.update_data(selected_products=selected_products)
+        product_id_to_delete = callback_query.data.split('delete_product_')[1]
+        selected_products = [product for product in selected_products if product['id'] != product_id_to_delete]
+        await state.update_data(selected_products=selected_products)
 
-            if not selected_products:
-                await callback_query.message.edit_text("Нет выбранных товаров.", reply_markup=None)
-            else:
-                product_names = [product['name'] for product in selected_products]
-                keyboard = InlineKeyboardMarkup(inline_keyboard=[])
-                for product in selected_products:
-                    keyboard.inline_keyboard.append([InlineKeyboardButton(text=f"Удалить {product['name']}", callback_data=f"delete_product_{product['id']}")])
-                keyboard.inline_keyboard.append([InlineKeyboardButton(text="Очистить все", callback_data="clear_all")])
-                await callback_query.message.edit_text("Выбранные товары:\n" + "\n".join(product_names), reply_markup=keyboard)
-            await callback_query.answer()
+        if not selected_products:
+            await callback_query.message.edit_text("Нет выбранных товаров.", reply_markup=None)
+        else:
+            product_names = [product['name'] for product in selected_products]
+            await callback_query.message.edit_text(
+                "Выбранные товары:\n" + "\n".join(product_names),
+                reply_markup=build_selected_products_keyboard(selected_products)
+            )
+        await callback_query.answer()
     except Exception as e:
         logger.error(f"Ошибка при удалении товара: {e}")
         await callback_query.message.edit_text("⚠ Произошла ошибка", reply_markup=None)
         await callback_query.answer()
 
 # Ввод количества
-@dp.message(StateFilter(CreateRequest.entering_quantity))
 async def enter_quantity(message: types.Message, state: FSMContext):
-    if message.text == "Начать заново":
-        await state.clear()
-        await create_request(message, state)
-        return
-    if message.text == "Вернуться назад":
-        keyboard = ReplyKeyboardMarkup(
-            keyboard=[
-                [KeyboardButton(text="Начать заново"), KeyboardButton(text="Вернуться назад")]
-            ],
-            resize_keyboard=True
-        )
-        await message.reply("Введите название или часть названия товара для поиска:", reply_markup=keyboard)
-        await state.set_state(CreateRequest.searching_product)
-        return
     data = await state.get_data()
     selected_products = data.get('selected_products', [])
     num_products = len(selected_products)
     quantities_str = message.text.strip().split(',')
     if len(quantities_str) != num_products or not all(q.strip().isdigit() for q in quantities_str):
-        keyboard = ReplyKeyboardMarkup(
-            keyboard=[
-                [KeyboardButton(text="Начать заново"), KeyboardButton(text="Вернуться назад")]
-            ],
-            resize_keyboard=True
-        )
         await message.reply(
             f"❌ Ошибка: нужно ввести ровно {num_products} чисел через запятую (например, 2,3). Попробуйте снова:",
-            reply_markup=keyboard
+            reply_markup=NAV_KEYBOARD
         )
         return
     quantities = [int(q.strip()) for q in quantities_str]
+    # Сверка с остатком и резерв на время заполнения заявки
+    shortages = tenant.stock_ledger.reserve(str(message.from_user.id), get_stock_demand(selected_products, quantities))
+    if shortages:
+        await message.reply(
+            format_stock_shortages(shortages, selected_products) + "\nВведите количество снова:",
+            reply_markup=NAV_KEYBOARD
+        )
+        return
     await state.update_data(quantities=quantities)
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="Начать заново"), KeyboardButton(text="Вернуться назад")]
-        ],
-        resize_keyboard=True
-    )
-    await message.reply("Введите ФИО получателя:", reply_markup=keyboard)
+    # Количество исправлено после нехватки при сохранении: остальные данные заявки уже введены
+    if data.get('save_after_quantity'):
+        await state.update_data(save_after_quantity=False)
+        await save_request(message, state)
+        return
+    await message.reply("Введите ФИО получателя:", reply_markup=NAV_KEYBOARD)
     await state.set_state(CreateRequest.entering_fio)
 
 # Ввод ФИО
-@dp.message(StateFilter(CreateRequest.entering_fio))
 async def enter_fio(message: types.Message, state: FSMContext):
-    if message.text == "Начать заново":
-        await state.clear()
-        await create_request(message, state)
-        return
-    if message.text == "Вернуться назад":
-        data = await state.get_data()
-        if 'selected_products' in data:
-            keyboard = ReplyKeyboardMarkup(
-                keyboard=[
-                    [KeyboardButton(text="Начать заново"), KeyboardButton(text="Вернуться назад")]
-                ],
-                resize_keyboard=True
-            )
-            num_products = len(data.get('selected_products', []))
-            await message.reply(
-                f"Введите {num_products} количеств через запятую (например, 2,3):",
-                reply_markup=keyboard
-            )
-            await state.set_state(CreateRequest.entering_quantity)
-        else:
-            keyboard = ReplyKeyboardMarkup(
-                keyboard=[
-                    [KeyboardButton(text="Начать заново"), KeyboardButton(text="Вернуться назад")]
-                ],
-                resize_keyboard=True
-            )
-            await message.reply("Введите название кастомного товара:", reply_markup=keyboard)
-            await state.set_state(CreateRequest.entering_custom_name)
-        return
     fio = message.text.strip()
     if not fio:
-        keyboard = ReplyKeyboardMarkup(
-            keyboard=[
-                [KeyboardButton(text="Начать заново"), KeyboardButton(text="Вернуться назад")]
-            ],
-            resize_keyboard=True
-        )
-        await message.reply("ФИО не может быть пустым. Попробуйте снова.", reply_markup=keyboard)
+        await message.reply("ФИО не может быть пустым. Попробуйте снова.", reply_markup=NAV_KEYBOARD)
         return
     await state.update_data(fio=fio)
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="Начать заново"), KeyboardButton(text="Вернуться назад")]
-        ],
-        resize_keyboard=True
-    )
-    await message.reply("Введите номер телефона:", reply_markup=keyboard)
+    await message.reply("Введите номер телефона:", reply_markup=NAV_KEYBOARD)
     await state.set_state(CreateRequest.entering_phone)
 
 # Ввод телефона
-@dp.message(StateFilter(CreateRequest.entering_phone))
 async def enter_phone(message: types.Message, state: FSMContext):
-    if message.text == "Начать заново":
-        await state.clear()
-        await create_request(message, state)
-        return
-    if message.text == "Вернуться назад":
-        keyboard = ReplyKeyboardMarkup(
-            keyboard=[
-                [KeyboardButton(text="Начать заново"), KeyboardButton(text="Вернуться назад")]
-            ],
-            resize_keyboard=True
-        )
-        await message.reply("Введите ФИО получателя:", reply_markup=keyboard)
-        await state.set_state(CreateRequest.entering_fio)
-        return
     phone = message.text.strip()
     if not phone or not any(c.isdigit() for c in phone):
-        keyboard = ReplyKeyboardMarkup(
-            keyboard=[
-                [KeyboardButton(text="Начать заново"), KeyboardButton(text="Вернуться назад")]
-            ],
-            resize_keyboard=True
-        )
-        await message.reply("Номер телефона должен содержать цифры. Попробуйте снова.", reply_markup=keyboard)
+        await message.reply("Номер телефона должен содержать цифры. Попробуйте снова.", reply_markup=NAV_KEYBOARD)
         return
     await state.update_data(phone=phone)
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="Начать заново"), KeyboardButton(text="Вернуться назад")]
-        ],
-        resize_keyboard=True
-    )
-    await message.reply("Введите адрес:", reply_markup=keyboard)
+    await message.reply("Введите адрес:", reply_markup=NAV_KEYBOARD)
     await state.set_state(CreateRequest.entering_address)
 
 # Ввод адреса
-@dp.message(StateFilter(CreateRequest.entering_address))
 async def enter_address(message: types.Message, state: FSMContext):
-    if message.text == "Начать заново":
-        await state.clear()
-        await create_request(message, state)
-        return
-    if message.text == "Вернуться назад":
-        keyboard = ReplyKeyboardMarkup(
-            keyboard=[
-                [KeyboardButton(text="Начать заново"), KeyboardButton(text="Вернуться назад")]
-            ],
-            resize_keyboard=True
-        )
-        await message.reply("Введите номер телефона:", reply_markup=keyboard)
-        await state.set_state(CreateRequest.entering_phone)
-        return
     address = message.text.strip()
     if not address:
-        keyboard = ReplyKeyboardMarkup(
-            keyboard=[
-                [KeyboardButton(text="Начать заново"), KeyboardButton(text="Вернуться назад")]
-            ],
-            resize_keyboard=True
-        )
-        await message.reply("Адрес не может быть пустым. Попробуйте снова.", reply_markup=keyboard)
+        await message.reply("Адрес не может быть пустым. Попробуйте снова.", reply_markup=NAV_KEYBOARD)
         return
     await state.update_data(address=address)
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="Начать заново"), KeyboardButton(text="Вернуться назад")]
-        ],
-        resize_keyboard=True
-    )
-    await message.reply("Введите индекс:", reply_markup=keyboard)
+    await message.reply("Введите индекс:", reply_markup=NAV_KEYBOARD)
     await state.set_state(CreateRequest.entering_index)
 
 # Ввод индекса
-@dp.message(StateFilter(CreateRequest.entering_index))
 async def enter_index(message: types.Message, state: FSMContext):
-    if message.text == "Начать заново":
-        await state.clear()
-        await create_request(message, state)
-        return
-    if message.text == "Вернуться назад":
-        keyboard = ReplyKeyboardMarkup(
-            keyboard=[
-                [KeyboardButton(text="Начать заново"), KeyboardButton(text="Вернуться назад")]
-            ],
-            resize_keyboard=True
-        )
-        await message.reply("Введите адрес:", reply_markup=keyboard)
-        await state.set_state(CreateRequest.entering_address)
-        return
     index = message.text.strip()
     if not index or not index.isdigit():
-        keyboard = ReplyKeyboardMarkup(
-            keyboard=[
-                [KeyboardButton(text="Начать заново"), KeyboardButton(text="Вернуться назад")]
-            ],
-            resize_keyboard=True
-        )
-        await message.reply("Индекс должен содержать только цифры. Попробуйте снова.", reply_markup=keyboard)
+        await message.reply("Индекс должен содержать только цифры. Попробуйте снова.", reply_markup=NAV_KEYBOARD)
         return
     await state.update_data(index=index)
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="Почта"), KeyboardButton(text="Курьер"), KeyboardButton(text="CDEK")],
-            [KeyboardButton(text="Свой вариант")],
-            [KeyboardButton(text="Начать заново"), KeyboardButton(text="Вернуться назад")]
-        ],
-        resize_keyboard=True
-    )
-    await message.reply("Выберите способ отправки:", reply_markup=keyboard)
+    await message.reply("Выберите способ отправки:", reply_markup=DELIVERY_KEYBOARD)
     await state.set_state(CreateRequest.choosing_delivery)
 
 # Выбор способа доставки
-@dp.message(StateFilter(CreateRequest.choosing_delivery))
 async def choose_delivery(message: types.Message, state: FSMContext):
-    if message.text == "Начать заново":
-        await state.clear()
-        await create_request(message, state)
-        return
-    if message.text == "Вернуться назад":
-        keyboard = ReplyKeyboardMarkup(
-            keyboard=[
-                [KeyboardButton(text="Начать заново"), KeyboardButton(text="Вернуться назад")]
-            ],
-            resize_keyboard=True
-        )
-        await message.reply("Введите индекс:", reply_markup=keyboard)
-        await state.set_state(CreateRequest.entering_index)
-        return
-    if message.text in ["Почта", "Курьер", "CDEK"]:
+    if message.text in DELIVERY_METHODS:
         await state.update_data(delivery_method=message.text)
         await save_request(message, state)
     elif message.text == "Свой вариант":
-        keyboard = ReplyKeyboardMarkup(
-            keyboard=[
-                [KeyboardButton(text="Начать заново"), KeyboardButton(text="Вернуться назад")]
-            ],
-            resize_keyboard=True
-        )
-        await message.reply("Введите свой способ доставки:", reply_markup=keyboard)
+        await message.reply("Введите свой способ доставки:", reply_markup=NAV_KEYBOARD)
         await state.set_state(CreateRequest.entering_custom_delivery)
     else:
-        keyboard = ReplyKeyboardMarkup(
-            keyboard=[
-                [KeyboardButton(text="Почта"), KeyboardButton(text="Курьер"), KeyboardButton(text="CDEK")],
-                [KeyboardButton(text="Свой вариант")],
-                [KeyboardButton(text="Начать заново"), KeyboardButton(text="Вернуться назад")]
-            ],
-            resize_keyboard=True
-        )
-        await message.reply("Пожалуйста, выберите один из предложенных вариантов.", reply_markup=keyboard)
+        await message.reply("Пожалуйста, выберите один из предложенных вариантов.", reply_markup=DELIVERY_KEYBOARD)
 
 # Ввод собственного способа доставки
-@dp.message(StateFilter(CreateRequest.entering_custom_delivery))
 async def enter_custom_delivery(message: types.Message, state: FSMContext):
-    if message.text == "Начать заново":
-        await state.clear()
-        await create_request(message, state)
-        return
-    if message.text == "Вернуться назад":
-        keyboard = ReplyKeyboardMarkup(
-            keyboard=[
-                [KeyboardButton(text="Почта"), KeyboardButton(text="Курьер"), KeyboardButton(text="CDEK")],
-                [KeyboardButton(text="Свой вариант")],
-                [KeyboardButton(text="Начать заново"), KeyboardButton(text="Вернуться назад")]
-            ],
-            resize_keyboard=True
-        )
-        await message.reply("Выберите способ отправки:", reply_markup=keyboard)
-        await state.set_state(CreateRequest.choosing_delivery)
-        return
     custom_delivery = message.text.strip()
     if not custom_delivery:
-        keyboard = ReplyKeyboardMarkup(
-            keyboard=[
-                [KeyboardButton(text="Начать заново"), KeyboardButton(text="Вернуться назад")]
-            ],
-            resize_keyboard=True
-        )
-        await message.reply("Способ доставки не может быть пустым. Попробуйте снова.", reply_markup=keyboard)
+        await message.reply("Способ доставки не может быть пустым. Попробуйте снова.", reply_markup=NAV_KEYBOARD)
         return
     await state.update_data(delivery_method=custom_delivery)
     await save_request(message, state)
 
+# Переход "Вернуться назад": повтор вопроса предыдущего шага
+def back_to(prompt, keyboard, target_state):
+    async def go_back(message: types.Message, state: FSMContext):
+        await message.reply(prompt, reply_markup=keyboard)
+        await state.set_state(target_state)
+    go_back.__name__ = f"back_to_{target_state.state.split(':')[-1]}"
+    return go_back
+
+# "Вернуться назад" с ввода ФИО зависит от типа заявки
+async def back_from_fio(message: types.Message, state: FSMContext):
+    data = await state.get_data()
+    if 'selected_products' in data:
+        num_products = len(data.get('selected_products', []))
+        await message.reply(f"Введите {num_products} количеств через запятую (например, 2,3):", reply_markup=NAV_KEYBOARD)
+        await state.set_state(CreateRequest.entering_quantity)
+    else:
+        await message.reply("Введите название кастомного товара:", reply_markup=NAV_KEYBOARD)
+        await state.set_state(CreateRequest.entering_custom_name)
+
+# Таблицы маршрутизации: точный текст кнопки, состояние FSM и префикс callback_data
+MENU_TEXT_ROUTES = {
+    "Создать заявку": handle_create_request,
+    "История": handle_history
+}
+
+STATE_MESSAGE_ROUTES = {
+    CreateRequest.choosing_type.state: process_type,
+    CreateRequest.entering_custom_name.state: enter_custom_name,
+    CreateRequest.searching_product.state: search_product,
+    CreateRequest.entering_quantity.state: enter_quantity,
+    CreateRequest.entering_fio.state: enter_fio,
+    CreateRequest.entering_phone.state: enter_phone,
+    CreateRequest.entering_address.state: enter_address,
+    CreateRequest.entering_index.state: enter_index,
+    CreateRequest.choosing_delivery.state: choose_delivery,
+    CreateRequest.entering_custom_delivery.state: enter_custom_delivery
+}
+
+BACK_ROUTES = {
+    CreateRequest.entering_custom_name.state: create_request,
+    CreateRequest.searching_product.state: create_request,
+    CreateRequest.entering_quantity.state: back_to(
+        "Введите название или часть названия товара для поиска:", NAV_KEYBOARD, CreateRequest.searching_product),
+    CreateRequest.entering_fio.state: back_from_fio,
+    CreateRequest.entering_phone.state: back_to("Введите ФИО получателя:", NAV_KEYBOARD, CreateRequest.entering_fio),
+    CreateRequest.entering_address.state: back_to("Введите номер телефона:", NAV_KEYBOARD, CreateRequest.entering_phone),
+    CreateRequest.entering_index.state: back_to("Введите адрес:", NAV_KEYBOARD, CreateRequest.entering_address),
+    CreateRequest.choosing_delivery.state: back_to("Введите индекс:", NAV_KEYBOARD, CreateRequest.entering_index),
+    CreateRequest.entering_custom_delivery.state: back_to(
+        "Выберите способ отправки:", DELIVERY_KEYBOARD, CreateRequest.choosing_delivery)
+}
+
+# callback_data -> (обработчик, требуемое состояние или None)
+CALLBACK_ROUTES = {
+    **{action: (select_product, CreateRequest.selecting_product.state) for action in SELECTION_ACTIONS},
+    "clear_all": (handle_delete_product, None)
+}
+
+# Префикс callback_data до первого "_" -> (обработчик, требуемое состояние или None)
+CALLBACK_PREFIX_ROUTES = {
+    "product": (select_product, CreateRequest.selecting_product.state),
+    "size": (select_size, None),
+    "delete": (handle_delete_product, None)
+}
+
+# Единая точка входа для текстовых сообщений (регистрируется после команд)
+@dp.message()
+async def route_message(message: types.Message, state: FSMContext):
+    handler = MENU_TEXT_ROUTES.get(message.text)
+    if handler is None:
+        current_state = await state.get_state()
+        if current_state not in STATE_MESSAGE_ROUTES:
+            return
+        if message.text == "Начать заново":
+            await clear_request(state, message.from_user.id)
+            handler = create_request
+        else:
+            handler = (message.text == "Вернуться назад" and BACK_ROUTES.get(current_state)) or STATE_MESSAGE_ROUTES[current_state]
+    with trace_span('route', handler=handler.__name__):
+        await handler(message, state)
+
+# Единая точка входа для inline-кнопок
+@dp.callback_query()
+async def route_callback(callback_query: types.CallbackQuery, state: FSMContext):
+    data = callback_query.data or ''
+    route = CALLBACK_ROUTES.get(data) or CALLBACK_PREFIX_ROUTES.get(data.split('_', 1)[0])
+    if route is not None and route[1] is not None and route[1] != await state.get_state():
+        route = None
+    if route is None:
+        logger.warning(f"Invalid callback data: {data}")
+        await callback_query.answer("Неверный выбор")
+        return
+    handler = route[0]
+    with trace_span('route', handler=handler.__name__):
+        await handler(callback_query, state)
+
+# Имена обработчиков из регистраций диспетчера и таблиц маршрутизации (для сторожа event loop)
+def get_handler_names():
+    handlers = [handler.callback for observer in (dp.message, dp.callback_query) for handler in observer.handlers]
+    handlers += list(MENU_TEXT_ROUTES.values()) + list(STATE_MESSAGE_ROUTES.values()) + list(BACK_ROUTES.values())
+    handlers += [route[0] for route in list(CALLBACK_ROUTES.values()) + list(CALLBACK_PREFIX_ROUTES.values())]
+    # Сравниваются имена кода кадров: переименованные через __name__ обработчики (back_to) видны как go_back
+    return {handler.__code__.co_name for handler in handlers if hasattr(handler, '__code__')}
+
 # Сохранение заявки
 async def save_request(message: types.Message, state: FSMContext):
     user_id = str(message.from_user.id)
     user_data = await state.get_data()
+    stock_demand = None
+    if 'selected_products' in user_data:
+        # Повторная сверка: резерв мог истечь, а остаток — обновиться, пока заполнялась заявка
+        stock_demand = get_stock_demand(user_data['selected_products'], user_data.get('quantities', []))
+        shortages = tenant.stock_ledger.reserve(user_id, stock_demand)
+        if shortages:
+            await message.reply(
+                format_stock_shortages(shortages, user_data['selected_products']) + "\nВведите количество заново:",
+                reply_markup=NAV_KEYBOARD
+            )
+            await state.update_data(save_after_quantity=True)
+            await state.set_state(CreateRequest.entering_quantity)
+            return
     try:
-        user_record_id = ALLOWED_USERS.get(user_id)['record_id']
+        user_record_id = tenant.allowed_users.get(user_id)['record_id']
         table_name = "Заявки" if 'selected_products' in user_data else "Кастомные_заказы"
-        headers = {'Authorization': f'Bearer {AIRTABLE_API_KEY}', 'Content-Type': 'application/json'}
         delivery_method = user_data.get('delivery_method', 'Не указано')
         if 'selected_products' in user_data:
             product_ids = [p['id'] for p in user_data['selected_products']]
@@ -1035,18 +3321,23 @@ async def save_request(message: types.Message, state: FSMContext):
                     }
                 }]
             }
-        url = f'https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{table_name}'
-        response = requests.post(url, headers=headers, json=payload)
+        response = await asyncio.to_thread(airtable_request, 'POST', table_name, json=payload)
         response.raise_for_status()
+        if stock_demand:
+            tenant.stock_ledger.commit(user_id, stock_demand)
         request_number = response.json()['records'][0]['fields'].get('Номер_заявки', 'Неизвестно')
         await message.reply(f"✅ Заявка {request_number} успешно создана!", reply_markup=get_main_menu())
-        await notify_teamlead(user_id, "Существующий товар" if 'selected_products' in user_data else "Кастомный товар", request_number)
-        record_id = response.json()['records'][0]['id']
-        REQUEST_STATUSES[record_id] = {
-            'status': "В обработке",
-            'tracking_number': None,
-            'request_number': request_number
-        }
+        await notify_teamlead(
+            user_id,
+            "Существующий товар" if 'selected_products' in user_data else "Кастомный товар",
+            request_number,
+            department=tenant.allowed_users[user_id]['department'],
+            urgent=is_urgent_request(user_data)
+        )
+        record = response.json()['records'][0]
+        record_id = record['id']
+        update_request_stats(record_id, record['fields'], record.get('createdTime'))
+        tenant.request_statuses.put(record_id, "В обработке", None)
         logger.info(f"Request {request_number} saved successfully for user {user_id}")
     except requests.exceptions.HTTPError as http_err:
         logger.error(f"HTTP ошибка: {http_err}, Ответ: {response.text}")
@@ -1054,15 +3345,74 @@ async def save_request(message: types.Message, state: FSMContext):
     except Exception as e:
         logger.error(f"Ошибка: {str(e)}")
         await message.reply(f"❌ Ошибка: {str(e)}. Попробуйте позже.", reply_markup=get_main_menu())
-    await state.clear()
-
-# Запуск бота
-async def main():
-    global ALLOWED_USERS, RECORD_ID_TO_TELEGRAM_ID, REQUEST_STATUSES
-    ALLOWED_USERS = load_users()
-    RECORD_ID_TO_TELEGRAM_ID = {data['record_id']: telegram_id for telegram_id, data in ALLOWED_USERS.items()}
+    await clear_request(state, user_id)
+
+# Загрузка данных и фоновые задачи одного тенанта (выполняется в его контексте)
+async def start_tenant():
+    tenant.allowed_users = await asyncio.to_thread(load_users)
+    tenant.record_id_to_telegram_id = {data['record_id']: telegram_id for telegram_id, data in tenant.allowed_users.items()}
+    if tenant.replica_db_path:
+        tenant.replica = AirtableReplica(tenant.replica_db_path)
+        # Состояние с прошлого запуска: изменения за время простоя будут отправлены пользователям
+        for record_id, fields, created_time in tenant.replica.iter_requests():
+            tenant.request_statuses.put(record_id, fields.get('Статус', 'Неизвестно'), fields.get('Трек-номер', None))
+            update_request_stats(record_id, fields, created_time)
     asyncio.create_task(check_request_updates())
-    await dp.start_polling(bot)
+    asyncio.create_task(refresh_users_loop())
+    load_teamlead_digest_spool()
+    if tenant.settings.TEAMLEAD_DIGEST_ENABLED:
+        asyncio.create_task(teamlead_digest_loop())
+    else:
+        await flush_teamlead_digest()
+
+# Приложение, собранное create_app: диспетчер и тенанты (их боты, клиенты и фоновые задачи)
+class App:
+    def __init__(self, dispatcher, tenants, settings):
+        self.dispatcher = dispatcher
+        self.tenants = tenants
+        self.settings = settings
+
+    # Загрузка данных и фоновые задачи всех тенантов, без получения апдейтов
+    async def start(self):
+        LOOP_WATCHDOG.start(get_handler_names())
+        for current in self.tenants.values():
+            await current.create_task(start_tenant())
+            logger.info(f"Тенант {current.name} запущен (база {current.airtable_base_id})")
+
+    # Запуск всех ботов процесса одним polling-циклом диспетчера
+    async def run(self):
+        await self.start()
+        try:
+            await self.dispatcher.start_polling(*(current.bot for current in self.tenants.values()))
+        finally:
+            # Не теряем накопленные заявки при остановке бота
+            for current in self.tenants.values():
+                await current.create_task(flush_teamlead_digest())
+            if TELEGRAM_SESSION is not None:
+                await TELEGRAM_SESSION.close()
+
+# Сборка приложения. config — настройки с именами переменных окружения; без него читаются
+# окружение и .env. Здесь же настраивается логирование, проверяются обязательные настройки
+# и создаются общие для тенантов компоненты обработки апдейтов
+def create_app(config=None):
+    global CAPTURE, UPDATE_SCHEDULER, LOOP_WATCHDOG
+    if config is None:
+        load_dotenv()
+        config = os.environ
+    settings = Settings(config)
+    configure_logging(settings)
+    CAPTURE = TrafficCapture(settings.CAPTURE_FILE, settings.CAPTURE_SALT) if settings.CAPTURE_FILE else None
+    UPDATE_SCHEDULER = UpdateScheduler(settings.UPDATE_MAX_CONCURRENCY, settings.CALLBACK_DEDUP_WINDOW)
+    LOOP_WATCHDOG = LoopWatchdog(settings.LOOP_WATCHDOG_INTERVAL, settings.LOOP_BLOCK_THRESHOLD)
+    tenants = load_tenants(settings)
+    TENANTS.clear()
+    TENANTS.update(tenants)
+    TENANTS_BY_BOT_ID.clear()
+    TENANTS_BY_BOT_ID.update({current.bot.id: current for current in TENANTS.values()})
+    return App(dp, TENANTS, settings)
+
+async def main(app=None):
+    await (app or create_app()).run()
 
 def start_bot():
     asyncio.run(main())